@@ -5,30 +5,86 @@
 //@menupath 
 //@toolbar 
 
+import java.io.BufferedOutputStream;
+import java.io.BufferedWriter;
+import java.io.ByteArrayOutputStream;
+import java.io.Closeable;
 import java.io.IOException;
+import java.io.OutputStream;
 import java.io.PrintWriter;
 import java.io.StringWriter;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.nio.charset.StandardCharsets;
 import java.nio.file.*;
+import java.nio.file.attribute.FileTime;
+import java.security.DigestInputStream;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
+import java.util.ArrayDeque;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.HexFormat;
 import java.util.List;
-import java.util.Objects;
-import java.util.concurrent.atomic.AtomicInteger;
+import java.util.Map;
+import java.util.concurrent.*;
 
-import ghidra.app.decompiler.flatapi.FlatDecompilerAPI;
+import com.google.gson.Gson;
+import com.google.gson.GsonBuilder;
+import com.google.gson.JsonObject;
+
+import ghidra.app.decompiler.DecompInterface;
+import ghidra.app.decompiler.DecompileOptions;
 import ghidra.app.script.GhidraScript;
 import ghidra.app.services.ConsoleService;
 import ghidra.app.util.importer.*;
+import ghidra.base.project.GhidraProject;
+import ghidra.framework.Application;
 import ghidra.framework.model.DomainFile;
 import ghidra.framework.model.DomainFolder;
 import ghidra.framework.model.Project;
+import ghidra.framework.model.ProjectLocator;
+import ghidra.program.model.listing.Function;
 import ghidra.program.model.listing.Program;
 import ghidra.util.InvalidNameException;
 import ghidra.util.Msg;
+import ghidra.util.task.ConsoleTaskMonitor;
+import ghidra.util.task.TaskMonitor;
 
 @SuppressWarnings("unused")
 public class BatchDecompile extends GhidraScript {
+    // Functions of each program are decompiled by this many threads (each with its own decompiler process).
+    // run.sh sets it so that the instances together use every core
+    private static final int NUM_DECOMPILE_THREADS = getEnvInt("DECOMPILE_THREADS", Runtime.getRuntime().availableProcessors());
+    // Functions which take longer than this many seconds to decompile are skipped
+    private static final int DECOMPILE_TIMEOUT_SECONDS = getEnvInt("DECOMPILE_TIMEOUT", 60);
+    // Decompiled functions waiting to be written per thread, so memory is bounded but threads don't wait on the writer
+    private static final int MAX_PENDING_PER_THREAD = 4;
+    // Files imported ahead of the one being analyzed and decompiled (each is an open program, so uses memory)
+    private static final int NUM_PREFETCHED_IMPORTS = getEnvInt("IMPORT_PREFETCH", 1);
+    // Worker mode: milliseconds between checks for new artifacts in the queue
+    private static final int QUEUE_POLL_INTERVAL_MILLIS = getEnvInt("QUEUE_POLL_INTERVAL", 1) * 1000;
+    // Project in each artifact (run.sh passes this to analyzeHeadless when it runs Ghidra per artifact)
+    private static final String ARTIFACT_PROJECT_NAME = "ghidra";
+    // "text" writes <binary>.o.c with "// FUNCTION <name>" before each function. "records" writes <binary>.o.records:
+    // one JSON record per function with its metadata, then an index of the records (read by code_type_c.py)
+    private static final String DECOMPILED_FORMAT = System.getenv().getOrDefault("DECOMPILED_FORMAT", "text");
+    private static final String DECOMPILED_EXTENSION = switch (DECOMPILED_FORMAT) {
+        case "text" -> ".c";
+        case "records" -> ".records";
+        default -> throw new IllegalArgumentException("Unknown DECOMPILED_FORMAT: " + DECOMPILED_FORMAT);
+    };
+    private static final byte[] RECORDS_MAGIC = "UBDECMP1".getBytes(StandardCharsets.US_ASCII);
+    // Decompiled files by their .o's content hash, shared between artifacts and runs (empty = don't deduplicate)
+    private static final String DECOMPILED_INDEX_DIR = System.getenv().getOrDefault("DECOMPILED_INDEX_DIR", "");
+    // Increment when the decompiled output changes (other than through the Ghidra version), so outputs indexed before
+    // aren't reused
+    private static final int DECOMPILED_INDEX_VERSION = 1;
+
     public void run() throws Exception {
+        var queueDir = this.getScriptArgs().length > 4 ? this.getScriptArgs()[4] : "";
         var srcDir = this.getScriptArgs().length > 0 ?
-                Path.of(this.getScriptArgs()[0]).normalize() :
+                (queueDir.isEmpty() ? Path.of(this.getScriptArgs()[0]).normalize() : null) :
                 this.askDirectory("Data (sources) root", "OK").toPath();
         var importExistingFiles = this.getScriptArgs().length > 1 ?
                 Boolean.parseBoolean(this.getScriptArgs()[1]) :
@@ -39,10 +95,86 @@ public class BatchDecompile extends GhidraScript {
         var statsDir = this.getScriptArgs().length > 3 ?
                 this.getScriptArgs()[3] :
                 this.askString("Stats dir for watch mode (empty otherwise)", "OK", "");
+        if (!queueDir.isEmpty()) {
+            this.runWorker(Path.of(queueDir), importExistingFiles, decompileExistingFiles);
+            return;
+        }
         var project = state.getProject();
         this.batchDecompile(project, srcDir, importExistingFiles, decompileExistingFiles, statsDir);
     }
 
+    /**
+     * Worker mode (see run.sh -p): processes the artifacts in queueDir/pending, each in its own project like when
+     * run.sh runs this script per artifact, until queueDir/.done exists and there are none left.
+     * This way Ghidra is only started once for many artifacts
+     */
+    public void runWorker(Path queueDir, boolean importExistingFiles, boolean decompileExistingFiles) throws Exception {
+        var workerName = state.getProject().getName();
+        this.logInfo("*** %s WAITING FOR ARTIFACTS IN %s", workerName, queueDir);
+        while (!monitor.isCancelled()) {
+            // Check before claiming, so that every artifact queued before the done marker is processed
+            var isDone = Files.exists(queueDir.resolve(".done"));
+            var claimedFile = this.claimNext(queueDir, workerName);
+            if (claimedFile == null) {
+                if (isDone) {
+                    break;
+                }
+                Thread.sleep(QUEUE_POLL_INTERVAL_MILLIS);
+                continue;
+            }
+            var artifactDir = Path.of(Files.readString(claimedFile)).normalize();
+            this.logInfo("*** PROCESSING %s...", artifactDir);
+            String marker;
+            try {
+                this.processArtifact(artifactDir, importExistingFiles, decompileExistingFiles);
+                this.logInfo("*** SUCCESS decompiling %s!", artifactDir);
+                marker = "ghidra.success";
+            } catch (Exception e) {
+                this.logError("*** ERROR: Decompiling " + artifactDir, e);
+                marker = "ghidra.fail";
+            }
+            // Like `touch`
+            var markerPath = artifactDir.resolve(marker);
+            if (!Files.exists(markerPath)) {
+                Files.createFile(markerPath);
+            }
+            Files.setLastModifiedTime(markerPath, FileTime.fromMillis(System.currentTimeMillis()));
+            Files.delete(claimedFile);
+        }
+        this.logInfo("*** %s DONE", workerName);
+    }
+
+    /** Moves the first queued artifact to queueDir/claimed, unless another worker does first. Returns null if there are none */
+    private Path claimNext(Path queueDir, String workerName) throws IOException {
+        List<Path> pending;
+        try (var pendingStream = Files.list(queueDir.resolve("pending"))) {
+            // Names starting with "." are being written
+            pending = pendingStream.filter(path -> !path.getFileName().toString().startsWith(".")).sorted().toList();
+        }
+        for (var queuedFile : pending) {
+            var claimedFile = queueDir.resolve("claimed").resolve(workerName + "-" + queuedFile.getFileName());
+            try {
+                Files.move(queuedFile, claimedFile, StandardCopyOption.ATOMIC_MOVE);
+                return claimedFile;
+            } catch (NoSuchFileException e) {
+                // Another worker claimed it
+            }
+        }
+        return null;
+    }
+
+    /** Opens or creates the artifact's project (artifactDir/ghidra, the same one analyzeHeadless uses per artifact) and decompiles it */
+    private void processArtifact(Path artifactDir, boolean importExistingFiles, boolean decompileExistingFiles) throws Exception {
+        var ghidraProject = Files.exists(artifactDir.resolve(ARTIFACT_PROJECT_NAME + ProjectLocator.getProjectExtension())) ?
+                GhidraProject.openProject(artifactDir.toString(), ARTIFACT_PROJECT_NAME, true) :
+                GhidraProject.createProject(artifactDir.toString(), ARTIFACT_PROJECT_NAME, false);
+        try {
+            this.batchDecompile(ghidraProject.getProject(), artifactDir, importExistingFiles, decompileExistingFiles, "");
+        } finally {
+            ghidraProject.close();
+        }
+    }
+
     public void batchDecompile(
             Project project,
             Path projectDir,
@@ -50,7 +182,8 @@ public class BatchDecompile extends GhidraScript {
             boolean decompileExistingFiles,
             String statsDir
     ) throws Exception {
-        // TODO: Watch mode, also refactor so that it decompiles vcpkg artifacts and handles apt artifact nesting properly
+        // Watch mode (statsDir) is implemented by run.sh, which runs this script on each artifact once it's marked
+        // TODO: refactor so that it decompiles vcpkg artifacts and handles apt artifact nesting properly
         // We can't decompile while searching (streaming) because it Files.find is kind of broken
         this.logInfo( "*** SEARCHING FILES IN %s...", projectDir);
         List<Path> paths;
@@ -62,47 +195,129 @@ public class BatchDecompile extends GhidraScript {
             paths = pathStream.toList();
         }
 
-        int numToImport;
-        if (importExistingFiles) {
-            numToImport = paths.size();
-            this.logInfo( "*** IMPORTING %d FILES", numToImport);
+        var toDecompile = decompileExistingFiles ? paths : paths.stream().filter(binaryPath ->
+                !Files.exists(getdecompiledPath(binaryPath))
+        ).toList();
+
+        // Files with the same content as one already decompiled (in the index) get its output instead of being
+        // decompiled again, and files with the same content as others in this artifact are only decompiled once.
+        // Unless we're redecompiling, in which case the index is only written to
+        var decompiledIndex = DECOMPILED_INDEX_DIR.isEmpty() ? null : DecompiledIndex.open(Path.of(DECOMPILED_INDEX_DIR), DECOMPILED_EXTENSION);
+        var hashes = new HashMap<Path, String>();
+        var duplicates = new HashMap<String, List<Path>>();
+        var dedupStats = new DedupStats();
+        List<Path> toProcess;
+        if (decompiledIndex == null) {
+            toProcess = toDecompile;
         } else {
-            var numToSkip = (int)paths.stream().filter(binaryPath ->
-                    getSerialDomainFile(binaryPath, project) != null
-            ).count();
-            numToImport = paths.size() - numToSkip;
-            this.logInfo("*** IMPORTING %d NEW FILES ( + SKIPPING %d)", numToImport, numToSkip);
-        }
-        var numImported = new AtomicInteger(0);
-        var importedPaths = paths.stream().map(binaryPath -> {
-            try {
-                return this.importPath(binaryPath, project, importExistingFiles, numToImport, numImported);
-            } catch (Exception e) {
-                this.logError("Error importing " + binaryPath, e);
-                return null;
+            toProcess = new ArrayList<>();
+            for (var binaryPath : toDecompile) {
+                String hash;
+                try {
+                    hash = DecompiledIndex.hash(binaryPath);
+                } catch (IOException e) {
+                    this.logError("Error hashing " + binaryPath + ", so it won't be deduplicated", e);
+                    toProcess.add(binaryPath);
+                    continue;
+                }
+                if (duplicates.containsKey(hash)) {
+                    duplicates.get(hash).add(binaryPath);
+                } else if (!decompileExistingFiles && this.linkDecompiled(decompiledIndex, hash, binaryPath, dedupStats)) {
+                    this.logInfo("Linked %s (same content as a previously decompiled file)", binaryPath);
+                } else {
+                    duplicates.put(hash, new ArrayList<>());
+                    hashes.put(binaryPath, hash);
+                    toProcess.add(binaryPath);
+                }
             }
-        }).filter(Objects::nonNull).toList();
+        }
+        var numToProcess = toProcess.size();
+        this.logInfo("*** PROCESSING %d FILES ( + SKIPPING %d ALREADY DECOMPILED, %d DUPLICATES)", numToProcess, paths.size() - toDecompile.size(), toDecompile.size() - numToProcess);
 
-        int numToDecompile;
-        if (decompileExistingFiles) {
-            numToDecompile = importedPaths.size();
-            this.logInfo( "*** DECOMPILING %d FILES", numToDecompile);
-        } else {
-            var numToSkip = (int)importedPaths.stream().filter(importedPath ->
-                    Files.exists(getdecompiledPath(importedPath.binaryPath))
-            ).count();
-            numToDecompile = importedPaths.size();
-            this.logInfo("*** DECOMPILING %d NEW FILES ( + SKIPPING %d)", numToDecompile, numToSkip);
-        }
-        var numDecompiled = new AtomicInteger(0);
-        for (var importedPath : importedPaths) {
-            var binaryPath = importedPath.binaryPath;
-            var program = importedPath.program;
-            var decompiledPath = getdecompiledPath(binaryPath);
-            try {
-                this.decompile(binaryPath, program, decompiledPath, decompileExistingFiles, numToDecompile, numDecompiled);
-            } catch (Exception e) {
-                this.logError("Error decompiling " + binaryPath, e);
+        // Each file is imported, analyzed, decompiled, and released before the next, so only a few programs are open
+        // at once, and memory depends on the largest file instead of the artifact. The next files are imported
+        // (prefetched) while the current one is analyzed and decompiled.
+        // Imports have their own monitor and consumer, so their cancellation and progress are separate from the script's.
+        // Imported programs are opened by importConsumer, so they're released by it
+        var importExecutor = Executors.newSingleThreadExecutor();
+        var importMonitor = new ConsoleTaskMonitor();
+        var importConsumer = new Object();
+        var imports = new ArrayDeque<PendingImport>();
+        var numSubmitted = 0;
+        try {
+            for (var index = 1; index <= numToProcess; index++) {
+                while (numSubmitted < numToProcess && imports.size() <= NUM_PREFETCHED_IMPORTS) {
+                    var binaryPath = toProcess.get(numSubmitted);
+                    var importIndex = ++numSubmitted;
+                    imports.add(new PendingImport(binaryPath, importExecutor.submit(() ->
+                            this.importPath(binaryPath, project, importExistingFiles, importIndex, numToProcess, importConsumer, importMonitor)
+                    )));
+                }
+                var pendingImport = imports.remove();
+                ImportedPath importedPath;
+                try {
+                    importedPath = pendingImport.imported.get();
+                } catch (ExecutionException e) {
+                    this.logError("Error importing " + pendingImport.binaryPath, e.getCause() instanceof Exception cause ? cause : e);
+                    continue;
+                }
+                var binaryPath = importedPath.binaryPath;
+                var startTime = System.nanoTime();
+                int numFailed;
+                try {
+                    numFailed = this.decompile(binaryPath, importedPath.program, importConsumer, getdecompiledPath(binaryPath), index, numToProcess);
+                } catch (Exception e) {
+                    this.logError("Error decompiling " + binaryPath, e);
+                    continue;
+                }
+                var hash = hashes.get(binaryPath);
+                if (hash != null && numFailed > 0) {
+                    // A function may only have timed out this time, so the output isn't reused in other artifacts and
+                    // runs. Duplicates in this artifact still get it, since they'd have been decompiled in its place
+                    this.logInfo("Not indexing %s (%d functions failed or timed out)", binaryPath, numFailed);
+                    for (var duplicatePath : duplicates.get(hash)) {
+                        try {
+                            linkOrCopy(getdecompiledPath(binaryPath), getdecompiledPath(duplicatePath));
+                        } catch (IOException e) {
+                            this.logError("Error linking decompiled " + duplicatePath, e);
+                            continue;
+                        }
+                        dedupStats.numLinked++;
+                        dedupStats.savedMillis += (System.nanoTime() - startTime) / 1_000_000;
+                        this.logInfo("Linked %s (same content as %s)", duplicatePath, binaryPath);
+                    }
+                } else if (hash != null) {
+                    try {
+                        decompiledIndex.add(hash, getdecompiledPath(binaryPath), (System.nanoTime() - startTime) / 1_000_000);
+                    } catch (IOException e) {
+                        this.logError("Error adding " + binaryPath + " to the decompiled index", e);
+                        continue;
+                    }
+                    for (var duplicatePath : duplicates.get(hash)) {
+                        if (this.linkDecompiled(decompiledIndex, hash, duplicatePath, dedupStats)) {
+                            this.logInfo("Linked %s (same content as %s)", duplicatePath, binaryPath);
+                        }
+                    }
+                }
+            }
+            if (decompiledIndex != null) {
+                this.logInfo("*** DEDUP: LINKED %d DUPLICATE FILES, SAVING ~%.1f SECONDS OF ANALYZING AND DECOMPILING", dedupStats.numLinked, dedupStats.savedMillis / 1000f);
+            }
+        } finally {
+            // If we failed, drop the queued imports and cancel the running one
+            importMonitor.cancel();
+            importExecutor.shutdownNow();
+            importExecutor.awaitTermination(DECOMPILE_TIMEOUT_SECONDS, TimeUnit.SECONDS);
+            // Release prefetched programs which were imported (queued imports never ran, so never finish)
+            for (var pendingImport : imports) {
+                if (!pendingImport.imported.isDone()) {
+                    continue;
+                }
+                try {
+                    pendingImport.imported.get().program.release(importConsumer);
+                } catch (ExecutionException | CancellationException e) {
+                    // Already logged or irrelevant, since we're failing anyway
+                }
             }
         }
     }
@@ -111,21 +326,21 @@ public class BatchDecompile extends GhidraScript {
             Path binaryPath,
             Project project,
             boolean importExistingFiles,
-            int numToImport,
-            AtomicInteger numImported
+            int index,
+            int numToProcess,
+            Object consumer,
+            TaskMonitor importMonitor
     ) throws Exception {
         if (!importExistingFiles) {
             var programFile = getSerialDomainFile(binaryPath, project);
             if (programFile != null) {
                 this.logInfo("Loading serialized imported %s", binaryPath);
-                var program = (Program) programFile.getDomainObject(this, false, false, monitor);
+                var program = (Program) programFile.getDomainObject(consumer, false, false, importMonitor);
                 return new ImportedPath(binaryPath, program);
             }
         }
-        var progress = (float)numImported.get() / (float)numToImport * 100f;
-        var index = numImported.incrementAndGet();
 
-        this.logInfo( "** IMPORTING %s... (%d/%d aka %.02f%% of phase 1/2)", binaryPath, index, numToImport, progress);
+        this.logInfo( "** IMPORTING %s... (%d/%d)", binaryPath, index, numToProcess);
         var createSerialDomainFile = this.prepareCreateSerialDomainFile(binaryPath, project);
         var existingFile = createSerialDomainFile.parent.getFile(createSerialDomainFile.name);
         if (existingFile != null) {
@@ -134,34 +349,45 @@ public class BatchDecompile extends GhidraScript {
         var program = AutoImporter.importByUsingBestGuess(
                 binaryPath.toFile(),
                 createSerialDomainFile.parent,
-                this,
+                consumer,
                 new MessageLog(),
-                monitor);
+                importMonitor);
         // AutoImporter automatically saves the file so we don't need to explicitly create it
         // (might not need to delete existing either but we do so just to be safe)
         return new ImportedPath(binaryPath, program);
     }
 
-    private void decompile(
+    /** Returns the number of functions which failed to decompile or timed out */
+    private int decompile(
             Path binaryPath,
             Program program,
+            Object consumer,
             Path decompiledPath,
-            boolean decompileExistingFiles,
-            int numToDecompile,
-            AtomicInteger numDecompiled
+            int index,
+            int numToProcess
     ) throws Exception {
-        if (!decompileExistingFiles && Files.exists(decompiledPath)) {
-            this.logInfo("Skipping %s (already decompiled)", binaryPath);
-            return;
+        try {
+            return this.analyzeAndDecompile(binaryPath, program, decompiledPath, index, numToProcess);
+        } finally {
+            program.release(consumer);
         }
-        var progress = (float)numDecompiled.get() / (float)numToDecompile * 100f;
-        var index = numDecompiled.incrementAndGet();
+    }
+
+    /** Returns the number of functions which failed to decompile or timed out */
+    private int analyzeAndDecompile(
+            Path binaryPath,
+            Program program,
+            Path decompiledPath,
+            int index,
+            int numToProcess
+    ) throws Exception {
+        var progress = (float)(index - 1) / (float)numToProcess * 100f;
 
         // Create empty file so that if we fail, we don't retry when we-running decompile without processExistingFiles
         Files.deleteIfExists(decompiledPath);
         Files.createFile(decompiledPath);
 
-        this.logInfo("** ANALYZING %s... (%d/%d aka %.02f%% of phase 2/2)", binaryPath, index, numToDecompile, progress);
+        this.logInfo("** ANALYZING %s... (%d/%d aka %.02f%%)", binaryPath, index, numToProcess, progress);
         var transaction = program.startTransaction("BatchDecompile analyze");
         try {
             // Analysis takes a lot of memory
@@ -176,34 +402,106 @@ public class BatchDecompile extends GhidraScript {
             throw exception;
         }
 
-        this.logInfo( "** DECOMPILING %s... (%d.5/%d aka %.02f%% of phase 2/2)", binaryPath, index, numToDecompile, progress + (0.5f / (float)numToDecompile * 100f));
-        var firstLog = true;
-        currentProgram = program;
-        var decompiler = new FlatDecompilerAPI(this);
-        try {
-            for (var func : program.getFunctionManager().getFunctions(true)) {
-                try {
-                    var decompiled = decompiler.decompile(func);
-                    if (decompiled.contains("Truncating control flow here")) {
-                        this.logWarn("Bad decompile: " + binaryPath.getFileName() + " function " + func.getName(true));
-                    } else {
-                        Files.writeString(decompiledPath, "// FUNCTION " + func.getName(), StandardOpenOption.APPEND);
-                        Files.writeString(decompiledPath, decompiled, StandardOpenOption.APPEND);
-                    }
-                } catch (Exception e) {
-                    if (firstLog) {
-                        // I have no idea how to check these functions
-                        this.logError("Error decompiling " + binaryPath.getFileName() + " function " + func.getName(), e);
-                        firstLog = false;
-                    }
+        this.logInfo( "** DECOMPILING %s... (%d.5/%d aka %.02f%%)", binaryPath, index, numToProcess, progress + (0.5f / (float)numToProcess * 100f));
+        var functions = new ArrayList<Function>();
+        program.getFunctionManager().getFunctions(true).forEach(functions::add);
+        var numThreads = Math.max(1, Math.min(NUM_DECOMPILE_THREADS, functions.size()));
+        // Each thread takes a decompiler from the pool, because a DecompInterface can only decompile one function at a time
+        var decompilers = new LinkedBlockingQueue<DecompInterface>();
+        var executor = Executors.newFixedThreadPool(numThreads);
+        var numFailed = 0;
+        try (DecompiledWriter writer = DECOMPILED_FORMAT.equals("records") ?
+                new RecordsDecompiledWriter(decompiledPath) :
+                new TextDecompiledWriter(decompiledPath)) {
+            for (var i = 0; i < numThreads; i++) {
+                decompilers.add(this.openDecompiler(program));
+            }
+            // Results are written in function order (the same order and output as decompiling serially)
+            var pending = new ArrayDeque<PendingFunction>();
+            for (var func : functions) {
+                if (pending.size() >= numThreads * MAX_PENDING_PER_THREAD) {
+                    numFailed = this.writeDecompiled(binaryPath, pending.remove(), writer, numFailed);
                 }
+                pending.add(new PendingFunction(func, executor.submit(() -> this.decompileFunction(func, decompilers))));
+            }
+            while (!pending.isEmpty()) {
+                numFailed = this.writeDecompiled(binaryPath, pending.remove(), writer, numFailed);
+            }
+            writer.finish();
+        } finally {
+            executor.shutdownNow();
+            // If we failed, functions may still be decompiling, and we can't dispose their decompilers until they're done
+            executor.awaitTermination(DECOMPILE_TIMEOUT_SECONDS, TimeUnit.SECONDS);
+            decompilers.forEach(DecompInterface::dispose);
+        }
+        return numFailed;
+    }
+
+    /** Gives the duplicate file the indexed output. Returns false (and logs if it's an error) if we couldn't */
+    private boolean linkDecompiled(DecompiledIndex decompiledIndex, String hash, Path binaryPath, DedupStats dedupStats) {
+        try {
+            var savedMillis = decompiledIndex.link(hash, getdecompiledPath(binaryPath));
+            if (savedMillis < 0) {
+                return false;
+            }
+            dedupStats.numLinked++;
+            dedupStats.savedMillis += savedMillis;
+            return true;
+        } catch (IOException e) {
+            this.logError("Error linking decompiled " + binaryPath, e);
+            return false;
+        }
+    }
+
+    private DecompInterface openDecompiler(Program program) {
+        var decompiler = new DecompInterface();
+        // The program's decompiler options, and the same output as FlatDecompilerAPI (C code)
+        var options = new DecompileOptions();
+        options.grabFromProgram(program);
+        decompiler.setOptions(options);
+        decompiler.toggleCCode(true);
+        decompiler.toggleSyntaxTree(true);
+        decompiler.setSimplificationStyle("decompile");
+        if (!decompiler.openProgram(program)) {
+            throw new IllegalStateException("Decompiler failed to open program: " + decompiler.getLastMessage());
+        }
+        return decompiler;
+    }
+
+    private DecompiledFunction decompileFunction(Function func, BlockingQueue<DecompInterface> decompilers) throws Exception {
+        var decompiler = decompilers.take();
+        try {
+            var startTime = System.nanoTime();
+            var results = decompiler.decompileFunction(func, DECOMPILE_TIMEOUT_SECONDS, monitor);
+            if (!results.decompileCompleted()) {
+                throw new Exception("Decompile failed or timed out: " + results.getErrorMessage());
             }
+            return new DecompiledFunction(results.getDecompiledFunction().getC(), (System.nanoTime() - startTime) / 1_000_000);
         } finally {
-            decompiler.dispose();
-            program.release(this);
+            decompilers.add(decompiler);
         }
     }
 
+    /** Waits for the function to be decompiled and writes it. Returns numFailed, plus 1 if it failed (only the first failure is logged) */
+    private int writeDecompiled(Path binaryPath, PendingFunction pending, DecompiledWriter writer, int numFailed) throws IOException, InterruptedException {
+        var func = pending.function;
+        try {
+            var decompiled = pending.decompiled.get();
+            if (decompiled.c.contains("Truncating control flow here")) {
+                this.logWarn("Bad decompile: " + binaryPath.getFileName() + " function " + func.getName(true));
+            } else {
+                writer.write(func, decompiled);
+            }
+        } catch (ExecutionException e) {
+            if (numFailed == 0) {
+                // I have no idea how to check these functions
+                this.logError("Error decompiling " + binaryPath.getFileName() + " function " + func.getName(), e.getCause() instanceof Exception cause ? cause : e);
+            }
+            numFailed++;
+        }
+        return numFailed;
+    }
+
     // project.getProjectLocator().getProjectDir() = a path to inside of the ghidra.rep folder
     // .relative(binaryPath) = ../<relative path> (because we go out of the ghidra.rep folder and then to the path)
     // We want to return the relative path *inside* of the ghidra.rep folder,
@@ -236,12 +534,27 @@ public class BatchDecompile extends GhidraScript {
         return new CreatingSerialDomainFile(parent, name);
     }
 
+    private static void linkOrCopy(Path sourcePath, Path decompiledPath) throws IOException {
+        // A hard link is safe because decompiled files are always deleted (not overwritten) before redecompiling
+        Files.deleteIfExists(decompiledPath);
+        try {
+            Files.createLink(decompiledPath, sourcePath);
+        } catch (IOException | UnsupportedOperationException e) {
+            Files.copy(sourcePath, decompiledPath);
+        }
+    }
+
     private Path getProjectPath(Project project) {
         return project.getProjectLocator().getProjectDir().toPath().toAbsolutePath().normalize();
     }
 
     private Path getdecompiledPath(Path binaryPath) {
-        return binaryPath.getParent().resolve(binaryPath.getFileName().toString() + ".c");
+        return binaryPath.getParent().resolve(binaryPath.getFileName().toString() + DECOMPILED_EXTENSION);
+    }
+
+    private static int getEnvInt(String name, int defaultValue) {
+        var value = System.getenv(name);
+        return value == null || value.isEmpty() ? defaultValue : Integer.parseInt(value);
     }
 
     private void logInfo(String msg, Object... args) {
@@ -276,5 +589,154 @@ public class BatchDecompile extends GhidraScript {
 
     private record ImportedPath(Path binaryPath, Program program) {}
 
+    private record PendingImport(Path binaryPath, Future<ImportedPath> imported) {}
+
+    private static class DedupStats {
+        int numLinked = 0;
+        long savedMillis = 0;
+    }
+
+    /**
+     * Decompiled files by the SHA-256 of their .o: &lt;hash&gt;.o&lt;extension&gt; and &lt;hash&gt;.ms (how long it took to analyze and
+     * decompile). Entries are written then renamed, so concurrent instances never see partial ones
+     */
+    private record DecompiledIndex(Path dir, String extension) {
+        /**
+         * The index in a subdirectory of baseDir for this Ghidra version and DECOMPILED_INDEX_VERSION, so outputs from
+         * another decompiler aren't reused
+         */
+        static DecompiledIndex open(Path baseDir, String extension) {
+            var tag = "ghidra-" + Application.getApplicationVersion() + "-v" + DECOMPILED_INDEX_VERSION;
+            return new DecompiledIndex(baseDir.resolve(tag), extension);
+        }
+
+        static String hash(Path binaryPath) throws IOException {
+            MessageDigest digest;
+            try {
+                digest = MessageDigest.getInstance("SHA-256");
+            } catch (NoSuchAlgorithmException e) {
+                throw new IllegalStateException("SHA-256 is always available", e);
+            }
+            try (var input = new DigestInputStream(Files.newInputStream(binaryPath), digest)) {
+                input.transferTo(OutputStream.nullOutputStream());
+            }
+            return HexFormat.of().formatHex(digest.digest());
+        }
+
+        /** Links (or copies if we can't) the indexed output to decompiledPath. Returns the millis it took to decompile, or -1 if it isn't indexed */
+        long link(String hash, Path decompiledPath) throws IOException {
+            var indexedPath = this.decompiledPath(hash);
+            if (!Files.exists(indexedPath)) {
+                return -1;
+            }
+            var millisPath = this.millisPath(hash);
+            var millis = Files.exists(millisPath) ? Long.parseLong(Files.readString(millisPath).strip()) : 0;
+            linkOrCopy(indexedPath, decompiledPath);
+            return millis;
+        }
+
+        void add(String hash, Path decompiledPath, long millis) throws IOException {
+            var indexedPath = this.decompiledPath(hash);
+            Files.createDirectories(indexedPath.getParent());
+            var tmpMillisPath = Files.createTempFile(indexedPath.getParent(), hash, ".ms.tmp");
+            Files.writeString(tmpMillisPath, Long.toString(millis));
+            Files.move(tmpMillisPath, this.millisPath(hash), StandardCopyOption.ATOMIC_MOVE, StandardCopyOption.REPLACE_EXISTING);
+            var tmpPath = Files.createTempFile(indexedPath.getParent(), hash, ".o" + this.extension + ".tmp");
+            Files.copy(decompiledPath, tmpPath, StandardCopyOption.REPLACE_EXISTING);
+            Files.move(tmpPath, indexedPath, StandardCopyOption.ATOMIC_MOVE, StandardCopyOption.REPLACE_EXISTING);
+        }
+
+        private Path decompiledPath(String hash) {
+            // Subdirectories so that no directory has too many files
+            return this.dir.resolve(hash.substring(0, 2)).resolve(hash + ".o" + this.extension);
+        }
+
+        private Path millisPath(String hash) {
+            return this.dir.resolve(hash.substring(0, 2)).resolve(hash + ".ms");
+        }
+    }
+
+    private record PendingFunction(Function function, Future<DecompiledFunction> decompiled) {}
+
+    private record DecompiledFunction(String c, long millis) {}
+
+    private interface DecompiledWriter extends Closeable {
+        void write(Function func, DecompiledFunction decompiled) throws IOException;
+
+        /** Called once every function is written (not if decompiling fails), before close */
+        default void finish() throws IOException {}
+    }
+
+    private static class TextDecompiledWriter implements DecompiledWriter {
+        private final BufferedWriter writer;
+
+        TextDecompiledWriter(Path decompiledPath) throws IOException {
+            this.writer = Files.newBufferedWriter(decompiledPath, StandardCharsets.UTF_8);
+        }
+
+        public void write(Function func, DecompiledFunction decompiled) throws IOException {
+            this.writer.write("// FUNCTION " + func.getName());
+            this.writer.write(decompiled.c);
+        }
+
+        public void close() throws IOException {
+            this.writer.close();
+        }
+    }
+
+    /**
+     * Layout (integers are little-endian):
+     * records: one UTF-8 JSON object per function followed by "\n"
+     * (name, qualified_name, entry, body_size (bytes of machine code), decompile_ms, c);
+     * index: per function, uint64 offset of its record, uint32 length, uint32 body size;
+     * footer: uint64 offset of the index, uint64 number of functions, RECORDS_MAGIC.
+     * The index and footer are only written by finish, so a file whose decompiling failed has no magic
+     */
+    private static class RecordsDecompiledWriter implements DecompiledWriter {
+        private static final Gson GSON = new GsonBuilder().disableHtmlEscaping().create();
+        private static final int INDEX_ENTRY_SIZE = 16;
+        private final OutputStream output;
+        private final ByteArrayOutputStream index = new ByteArrayOutputStream();
+        private long offset = 0;
+        private long numFunctions = 0;
+
+        RecordsDecompiledWriter(Path decompiledPath) throws IOException {
+            this.output = new BufferedOutputStream(Files.newOutputStream(decompiledPath));
+        }
+
+        public void write(Function func, DecompiledFunction decompiled) throws IOException {
+            var bodySize = func.getBody().getNumAddresses();
+            var record = new JsonObject();
+            record.addProperty("name", func.getName());
+            record.addProperty("qualified_name", func.getName(true));
+            record.addProperty("entry", func.getEntryPoint().toString());
+            record.addProperty("body_size", bodySize);
+            record.addProperty("decompile_ms", decompiled.millis);
+            record.addProperty("c", decompiled.c);
+            var bytes = (GSON.toJson(record) + "\n").getBytes(StandardCharsets.UTF_8);
+            this.output.write(bytes);
+            this.index.write(ByteBuffer.allocate(INDEX_ENTRY_SIZE).order(ByteOrder.LITTLE_ENDIAN)
+                    .putLong(this.offset)
+                    .putInt(bytes.length)
+                    .putInt((int) Math.min(bodySize, 0xFFFFFFFFL))
+                    .array());
+            this.offset += bytes.length;
+            this.numFunctions++;
+        }
+
+        public void finish() throws IOException {
+            this.index.writeTo(this.output);
+            this.output.write(ByteBuffer.allocate(16).order(ByteOrder.LITTLE_ENDIAN)
+                    .putLong(this.offset)
+                    .putLong(this.numFunctions)
+                    .array());
+            this.output.write(RECORDS_MAGIC);
+        }
+
+        public void close() throws IOException {
+            this.output.close();
+        }
+    }
+
     private record CreatingSerialDomainFile(DomainFolder parent, String name) {}
 }
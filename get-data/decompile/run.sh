@@ -4,7 +4,8 @@ NUM_INSTANCES=1
 PARENT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 DATASET_DIR=$PARENT_DIR/../../../UnderstandableBinary-data
 SCRIPT_LOG_DIR=$PARENT_DIR/../../local/ghidra-logs
-GHIDRA_DIR=$PARENT_DIR/ghidra
+# Can be overridden (e.g. test-watch.sh uses a fake Ghidra)
+GHIDRA_DIR=${GHIDRA_DIR:-$PARENT_DIR/ghidra}
 GHIDRA_SCRIPT_NAME="BatchDecompile.java"
 # Ghidra uses 'false' and 'true' instead of '0' and '1'
 IMPORT_EXISTING_FILES=false
@@ -12,10 +13,17 @@ DECOMPILE_EXISTING_FILES=false
 SKIP_SUCCESSES=true
 SKIP_FAILURES=false
 STATS_DIR=""
+USE_WORKERS=false
+# Worker mode: seconds between a worker's checks for new artifacts in the queue
+export QUEUE_POLL_INTERVAL=${QUEUE_POLL_INTERVAL:-1}
+# Watch mode: seconds between checks for new markers
+WATCH_INTERVAL=${WATCH_INTERVAL:-10}
+# Watch mode: once this is in STATS_DIR (created when there will be no more packages), we exit after processing the rest
+WATCH_DONE_MARKER=".done"
 
 # Show help if necessary
 function show_help() {
-  usage="Usage: $0 [-o DATASET_DIR] [-w STATS_DIR] [-l SCRIPT_LOG_DIR] [-j NUM_INSTANCES] [-s | -f | -F]
+  usage="Usage: $0 [-o DATASET_DIR] [-w STATS_DIR] [-l SCRIPT_LOG_DIR] [-j NUM_INSTANCES] [-p] [-s | -f | -F]
 
 decompile object files (.o) in DATASET_DIR using Ghidra, creating (.o.c) files and also Ghidra projects.
 DATASET_DIR should contain subdirectories containing artifacts; each artifact is processed separately.
@@ -25,20 +33,39 @@ DATASET_DIR should contain subdirectories containing artifacts; each artifact is
                       This changes the mode so that Ghidra will only decompile *.success marked files.
                       However it will attempt to decompile old *.success files, overwriting if -f or -F is passed,
                       else skipping unless the file actually needs to be decompiled. Default: \"\" (no watch mode).
-                      TODO: not currently implemented (does nothing)
+                      STATS_DIR/<package>.success marks the artifacts DATASET_DIR/<package> and DATASET_DIR/<package>-<version>
+                      (the version must start with a digit, so e.g. foo doesn't mark foo-utils-1.0).
+                      Checks every \$WATCH_INTERVAL seconds (default: 10). Runs until STATS_DIR/$WATCH_DONE_MARKER exists
+                      and every marked artifact is processed, then creates DATASET_DIR/ghidra.done
     -l SCRIPT_LOG_DIR Directory where the script logs are stored. Default: $PARENT_DIR/../../local/ghidra-logs
     -j NUM_INSTANCES  Number of processes to run in parallel, 0 for as many as possible. Default: 1
+    -p                Worker mode: instead of starting Ghidra for every artifact, start NUM_INSTANCES (0 = one per core)
+                      long-lived Ghidra workers, which take artifacts from a queue, so startup is only paid once per
+                      worker. Faster when there are many small artifacts. Default: false
     -s                Skip decompiling failures as well as successes (successes skipped unless -f or -F). Default: false
     -f                Decompile existing files and redo successes but DO NOT reimport and reanalyze cached Ghidra files.
                       Default: false
     -F                Decompile existing files, redo successes, and DO reimport and reanalyze cached Ghidra files.
-                      Default: false"
+                      Default: false
+
+Environment variables:
+    DECOMPILE_THREADS Threads each instance decompiles functions with. Default: cores / NUM_INSTANCES (at least 1)
+    DECOMPILE_TIMEOUT Seconds before giving up on decompiling a function. Default: 60
+    IMPORT_PREFETCH   Files each instance imports ahead of the one it's analyzing and decompiling. Default: 1
+    GHIDRA_MAXMEM     Heap size of each instance (JVM). Default: 2G
+    DECOMPILED_INDEX_DIR
+                      Where decompiled files are indexed by their .o's content, so that .o files identical to one
+                      already decompiled (in any artifact, in this run or a previous one) are linked to its output
+                      instead of decompiled again. Empty to disable. Default: $PARENT_DIR/../../local/decompiled-index
+    DECOMPILED_FORMAT \"text\" writes .o.c files (C, with \"// FUNCTION <name>\" before each function). \"records\"
+                      writes .o.records files: a JSON record per function with its name, qualified name, entry
+                      address, body size, decompile time, and C, then an index of the records. Default: text"
   echo "$usage"
 }
 
 # Process options
 OPTIND=1
-while getopts "h?o:w:l:j:sfF" opt; do
+while getopts "h?o:w:l:j:psfF" opt; do
   case "$opt" in
     h|\?)
       show_help
@@ -52,6 +79,8 @@ while getopts "h?o:w:l:j:sfF" opt; do
       ;;
     j)  NUM_INSTANCES=$OPTARG
       ;;
+    p)  USE_WORKERS=true
+      ;;
     s)  SKIP_FAILURES=true
       ;;
     f)  DECOMPILE_EXISTING_FILES=true
@@ -66,15 +95,31 @@ done
 shift $((OPTIND-1))
 [ "${1:-}" = "--" ] && shift
 
+# Each instance decompiles its functions in parallel: by default, split the cores between the instances
+if [ "${DECOMPILE_THREADS:-}" == "" ]; then
+  NUM_CORES=$(getconf _NPROCESSORS_ONLN)
+  if [ "$NUM_INSTANCES" -gt 0 ] && [ "$NUM_CORES" -gt "$NUM_INSTANCES" ]; then
+    DECOMPILE_THREADS=$((NUM_CORES / NUM_INSTANCES))
+  else
+    DECOMPILE_THREADS=1
+  fi
+fi
+export DECOMPILE_THREADS
+export DECOMPILE_TIMEOUT=${DECOMPILE_TIMEOUT:-60}
+export IMPORT_PREFETCH=${IMPORT_PREFETCH:-1}
+export DECOMPILED_INDEX_DIR=${DECOMPILED_INDEX_DIR-$PARENT_DIR/../../local/decompiled-index}
+# BatchDecompile only has a few programs open at once, so this only needs to fit the largest .o (not the artifact)
+GHIDRA_MAXMEM=${GHIDRA_MAXMEM:-2G}
+
 # Extract Ghidra dir if necessary
 if [ ! -d "$GHIDRA_DIR" ]; then
     echo "Ghidra dir not found, unzipping (first time)"
     tar -xzf "$GHIDRA_DIR.tar.gz" -C "$GHIDRA_DIR"
 fi
 
-# Patch analyzeHeadless, increase heap size
+# Patch analyzeHeadless, set heap size
 # (do this even if already done just to be safe and not cause confusing errors)
-sed -i '' 's/^MAXMEM=.*$/MAXMEM=6G/g' "$GHIDRA_DIR/support/analyzeHeadless"
+sed -i '' "s/^MAXMEM=.*$/MAXMEM=$GHIDRA_MAXMEM/g" "$GHIDRA_DIR/support/analyzeHeadless"
 
 # Create script log dir if necessary
 if [ "$SCRIPT_LOG_DIR" != "" ]; then
@@ -108,14 +153,23 @@ export -f preprocess_a
 find "$DATASET_DIR" -name "*.a" -print0 | xargs -0 -n 1 -P "$NUM_INSTANCES" -I {} bash -c 'preprocess_a "$@"' _ {}
 
 # Processing logic (for each subdirectory)
-function process_one() {
+function should_skip() {
   artifactDir=$1
 
   if [ "$SKIP_SUCCESSES" == true ] && [ -f "$artifactDir/ghidra.success" ] ; then
     echo "*** SKIPPING $artifactDir (previously processed)"
-    return
+    return 0
   elif [ "$SKIP_FAILURES" == true ] && [ -f "$artifactDir/ghidra.fail" ] ; then
     echo "*** SKIPPING $artifactDir (previously failed)"
+    return 0
+  fi
+  return 1
+}
+
+function process_one() {
+  artifactDir=$1
+
+  if should_skip "$artifactDir"; then
     return
   fi
 
@@ -156,10 +210,169 @@ export DECOMPILE_EXISTING_FILES
 export STATS_DIR
 export SKIP_SUCCESSES
 export SKIP_FAILURES
+export -f should_skip
 export -f process_one
 
-# Process each subdirectory (artifact), but process $NUM_INSTANCES simultaneously
-# `exec` also means that this must be the last command
-echo "*** PROCESSING ALL IN $DATASET_DIR ($NUM_INSTANCES instances)"
-find "$DATASET_DIR"/* -type d -prune -print0 |
-  exec xargs -P "$NUM_INSTANCES" -0 -n 1 -I {} bash -c 'process_one "$@"' _ {}
+# Worker mode: BatchDecompile takes artifact paths from QUEUE_DIR/pending (claiming each by moving it to
+# QUEUE_DIR/claimed), and processes them until QUEUE_DIR/.done exists and the queue is empty.
+# It creates ghidra.success or ghidra.fail in each artifact like process_one
+if [ "$USE_WORKERS" == true ]; then
+  if [ "$NUM_INSTANCES" -eq 0 ]; then
+    NUM_INSTANCES=$(getconf _NPROCESSORS_ONLN)
+  fi
+  # Only needs to last this run: artifacts which weren't processed (e.g. because it was interrupted) are requeued
+  # by the next, because they don't have a marker
+  QUEUE_DIR=$(mktemp -d)
+  mkdir "$QUEUE_DIR/pending" "$QUEUE_DIR/claimed" "$QUEUE_DIR/projects"
+  trap 'rm -rf "$QUEUE_DIR"' EXIT
+  NUM_QUEUED=0
+fi
+
+function enqueue() {
+  artifactDir=$1
+  if should_skip "$artifactDir"; then
+    return
+  fi
+  NUM_QUEUED=$((NUM_QUEUED + 1))
+  # Names are zero-padded so that workers take artifacts in order. Written then renamed so workers never read partial
+  queueFile="$QUEUE_DIR/pending/$(printf '%010d' "$NUM_QUEUED")"
+  printf '%s' "$artifactDir" > "$QUEUE_DIR/pending/.tmp"
+  mv "$QUEUE_DIR/pending/.tmp" "$queueFile"
+}
+
+function run_worker() {
+  workerName="worker-$1"
+  if [ "$SCRIPT_LOG_DIR" != "" ]; then
+    scriptLogFile="$SCRIPT_LOG_DIR/$workerName.log"
+  else
+    scriptLogFile="/dev/null"
+  fi
+
+  while true; do
+    # The worker's own project is empty: it opens each artifact's project itself
+    "$GHIDRA_DIR/support/analyzeHeadless" \
+      "$QUEUE_DIR/projects" "$workerName" \
+      -scriptPath "$PARENT_DIR" \
+      -scriptLog "$scriptLogFile" \
+      -preScript "$PARENT_DIR/$GHIDRA_SCRIPT_NAME" "" "$IMPORT_EXISTING_FILES" "$DECOMPILE_EXISTING_FILES" "" "$QUEUE_DIR"
+    # shellcheck disable=SC2181
+    exit=$?
+
+    if [ $exit -eq 0 ]; then
+      return
+    fi
+    # The worker crashed, so the artifact it was processing failed. Restart it to process the rest
+    for claimedFile in "$QUEUE_DIR/claimed/$workerName"-*; do
+      if [ -f "$claimedFile" ]; then
+        artifactDir=$(cat "$claimedFile")
+        echo "*** ERROR: Decompiling $artifactDir exited with code $exit"
+        touch "$artifactDir/ghidra.fail"
+        rm "$claimedFile"
+      fi
+    done
+    if [ $exit -gt 127 ]; then
+      echo "*** ABORT: $workerName exited with code $exit"
+      return 1
+    fi
+  done
+}
+
+function start_workers() {
+  echo "*** STARTING $NUM_INSTANCES GHIDRA WORKERS"
+  WORKER_PIDS=()
+  for i in $(seq 1 "$NUM_INSTANCES"); do
+    run_worker "$i" &
+    WORKER_PIDS+=($!)
+  done
+}
+
+function finish_workers() {
+  touch "$QUEUE_DIR/.done"
+  status=0
+  for pid in "${WORKER_PIDS[@]}"; do
+    wait "$pid" || status=1
+  done
+  return $status
+}
+
+if [ "$STATS_DIR" == "" ]; then
+  if [ "$USE_WORKERS" == true ]; then
+    echo "*** PROCESSING ALL IN $DATASET_DIR ($NUM_INSTANCES workers)"
+    start_workers
+    while IFS= read -r -d '' artifactDir; do
+      enqueue "$artifactDir"
+    done < <(find "$DATASET_DIR"/* -type d -prune -print0)
+    finish_workers
+    exit $?
+  fi
+  # Process each subdirectory (artifact), but process $NUM_INSTANCES simultaneously
+  # `exec` also means that this must be the last command
+  echo "*** PROCESSING ALL IN $DATASET_DIR ($NUM_INSTANCES instances)"
+  find "$DATASET_DIR"/* -type d -prune -print0 |
+    exec xargs -P "$NUM_INSTANCES" -0 -n 1 -I {} bash -c 'process_one "$@"' _ {}
+fi
+
+# Watch mode: process the artifacts of each package as soon as it's marked built
+function marked_artifacts() {
+  package=$(basename "$1" .success)
+  find "$DATASET_DIR" -mindepth 1 -maxdepth 1 -type d \( -name "$package" -o -name "$package-[0-9]*" \) -print0
+}
+
+echo "*** WATCHING $STATS_DIR, PROCESSING MARKED IN $DATASET_DIR ($NUM_INSTANCES instances)"
+rm -f "$DATASET_DIR/ghidra.done"
+if [ "$USE_WORKERS" == true ]; then
+  start_workers
+fi
+# Newline-separated (and surrounded) list, since macOS bash doesn't have associative arrays
+HANDLED_MARKERS=$'\n'
+while true; do
+  # Check before looking for markers, so that every marker created before the done marker is handled
+  if [ -f "$STATS_DIR/$WATCH_DONE_MARKER" ]; then
+    is_done=true
+  else
+    is_done=false
+  fi
+
+  new_artifacts=()
+  for marker in "$STATS_DIR"/*.success; do
+    if [ ! -f "$marker" ] || [[ "$HANDLED_MARKERS" == *$'\n'"$marker"$'\n'* ]]; then
+      continue
+    fi
+    marker_artifacts=()
+    while IFS= read -r -d '' artifactDir; do
+      marker_artifacts+=("$artifactDir")
+    done < <(marked_artifacts "$marker")
+    # The package's artifacts may not have been copied into DATASET_DIR yet, in which case we check again later
+    if [ ${#marker_artifacts[@]} -gt 0 ]; then
+      HANDLED_MARKERS+="$marker"$'\n'
+      new_artifacts+=("${marker_artifacts[@]}")
+    fi
+  done
+
+  if [ ${#new_artifacts[@]} -gt 0 ]; then
+    echo "*** PROCESSING ${#new_artifacts[@]} NEWLY MARKED ARTIFACTS"
+    find "${new_artifacts[@]}" -name "*.a" -print0 | xargs -0 -n 1 -P "$NUM_INSTANCES" -I {} bash -c 'preprocess_a "$@"' _ {}
+    if [ "$USE_WORKERS" == true ]; then
+      for artifactDir in "${new_artifacts[@]}"; do
+        enqueue "$artifactDir"
+      done
+    else
+      printf '%s\0' "${new_artifacts[@]}" | xargs -P "$NUM_INSTANCES" -0 -n 1 -I {} bash -c 'process_one "$@"' _ {}
+    fi
+  elif [ "$is_done" == true ]; then
+    for marker in "$STATS_DIR"/*.success; do
+      if [ -f "$marker" ] && [[ "$HANDLED_MARKERS" != *$'\n'"$marker"$'\n'* ]]; then
+        echo "*** WARNING: no artifacts in $DATASET_DIR for $marker"
+      fi
+    done
+    if [ "$USE_WORKERS" == true ]; then
+      echo "*** WAITING FOR GHIDRA WORKERS"
+      finish_workers || exit 1
+    fi
+    echo "*** DONE WATCHING $STATS_DIR"
+    touch "$DATASET_DIR/ghidra.done"
+    exit 0
+  else
+    sleep "$WATCH_INTERVAL"
+  fi
+done
@@ -0,0 +1,141 @@
+#!/usr/bin/env bash
+
+PARENT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+USE_REAL_GHIDRA=false
+RUN_ARGS=()
+
+# Show help if necessary
+function show_help() {
+  usage="Usage: $0 [-r] [-p]
+
+Locally test run.sh's watch mode (-w): creates a dataset of prebuilt .o fixtures in a temporary directory,
+marks packages built one at a time with fake STATS_DIR/*.success markers, and checks that each is decompiled.
+
+    -r  Use the real Ghidra. Otherwise uses a fake analyzeHeadless which writes a .o.c per .o (fast). Default: false
+    -p  Use worker mode (run.sh -p, with 2 workers). Default: false"
+  echo "$usage"
+}
+
+# Process options
+OPTIND=1
+while getopts "h?rp" opt; do
+  case "$opt" in
+    h|\?)
+      show_help
+      exit 0
+      ;;
+    r)  USE_REAL_GHIDRA=true
+      ;;
+    p)  RUN_ARGS=(-p -j 2)
+      ;;
+  esac
+done
+
+TEST_DIR=$(mktemp -d)
+DATASET_DIR=$TEST_DIR/data
+STATS_DIR=$TEST_DIR/stats
+mkdir -p "$DATASET_DIR" "$STATS_DIR"
+trap 'rm -rf "$TEST_DIR"; kill $(jobs -p) 2> /dev/null' EXIT
+
+# Prebuilt .o fixtures (package-version directories, like apt's). foo-utils is never marked built, but starts with foo
+for package in foo bar baz foo-utils; do
+  artifactDir="$DATASET_DIR/$package-1.0"
+  mkdir -p "$artifactDir"
+  printf 'int %s_add(int a, int b) {\n  return a + b;\n}\n' "${package//-/_}" > "$artifactDir/$package.c"
+  cc -c "$artifactDir/$package.c" -o "$artifactDir/$package.o" || exit 1
+done
+
+if [ "$USE_REAL_GHIDRA" == false ]; then
+  export GHIDRA_DIR=$TEST_DIR/fake-ghidra
+  mkdir -p "$GHIDRA_DIR/support"
+  # Called like analyzeHeadless: <project dir> <project name> ... -preScript <script> <artifact dir> <import existing>
+  # <decompile existing> <stats dir> [<queue dir>]. In worker mode, claims queued artifacts like BatchDecompile.runWorker
+  cat > "$GHIDRA_DIR/support/analyzeHeadless" << 'EOF'
+#!/usr/bin/env bash
+workerName=$2
+while [ "$1" != "-preScript" ]; do
+  shift
+done
+artifactDir=$3
+queueDir=${7:-}
+
+function fake_decompile() {
+  find "$1" -name "*.o" | while read -r binaryPath; do
+    printf '// FUNCTION fake\nvoid fake(void) {\n}\n' > "$binaryPath.c"
+  done
+}
+
+if [ "$queueDir" == "" ]; then
+  fake_decompile "$artifactDir"
+  exit 0
+fi
+while true; do
+  if [ -f "$queueDir/.done" ]; then
+    isDone=true
+  else
+    isDone=false
+  fi
+  claimedFile=""
+  for queuedFile in "$queueDir"/pending/*; do
+    candidate="$queueDir/claimed/$workerName-$(basename "$queuedFile")"
+    if [ -f "$queuedFile" ] && mv "$queuedFile" "$candidate" 2> /dev/null; then
+      claimedFile=$candidate
+      break
+    fi
+  done
+  if [ "$claimedFile" == "" ]; then
+    if [ "$isDone" == true ]; then
+      exit 0
+    fi
+    sleep 1
+    continue
+  fi
+  artifactDir=$(cat "$claimedFile")
+  fake_decompile "$artifactDir"
+  touch "$artifactDir/ghidra.success"
+  rm "$claimedFile"
+done
+EOF
+  chmod +x "$GHIDRA_DIR/support/analyzeHeadless"
+fi
+
+echo "*** STARTING WATCH MODE"
+WATCH_INTERVAL=1 "$PARENT_DIR/run.sh" -o "$DATASET_DIR" -w "$STATS_DIR" -l "" "${RUN_ARGS[@]}" &
+WATCH_PID=$!
+
+function wait_for() {
+  file=$1
+  for _ in $(seq 1 600); do
+    if [ -f "$file" ]; then
+      return 0
+    fi
+    sleep 1
+  done
+  echo "*** FAIL: timed out waiting for $file"
+  exit 1
+}
+
+for package in foo bar; do
+  echo "*** MARKING $package BUILT"
+  touch "$STATS_DIR/$package.success"
+  wait_for "$DATASET_DIR/$package-1.0/ghidra.success"
+  wait_for "$DATASET_DIR/$package-1.0/$package.o.c"
+done
+if [ -f "$DATASET_DIR/baz-1.0/ghidra.success" ]; then
+  echo "*** FAIL: baz was decompiled before it was marked"
+  exit 1
+fi
+
+echo "*** MARKING baz BUILT AND DONE"
+touch "$STATS_DIR/baz.success" "$STATS_DIR/.done"
+wait_for "$DATASET_DIR/ghidra.done"
+wait "$WATCH_PID" || { echo "*** FAIL: watch mode exited with an error"; exit 1; }
+if [ ! -f "$DATASET_DIR/baz-1.0/baz.o.c" ]; then
+  echo "*** FAIL: baz wasn't decompiled"
+  exit 1
+fi
+if [ -f "$DATASET_DIR/foo-utils-1.0/ghidra.success" ]; then
+  echo "*** FAIL: foo-utils was decompiled, but only foo was marked"
+  exit 1
+fi
+echo "*** SUCCESS"
@@ -19,7 +19,12 @@ Create the dataset by downloading and building packages, then decompile using Gh
     -j NUM_GHIDRA_INSTANCES    Number of Ghidra instances to run in parallel from each repo (so we actually do up to 3x
                                this). Default: $NUM_GHIDRA_INSTANCES
     -f                         Recreate the entire dataset.
-                               Otherwise we will resume and skip already-processed (e.g. if it exited early) Default: false"
+                               Otherwise we will resume and skip already-processed (e.g. if it exited early) Default: false
+
+Environment variables:
+    DECOMPILE_THREADS          Threads each Ghidra instance decompiles functions with.
+                               Default: cores / (3 * NUM_GHIDRA_INSTANCES) (at least 1), since the 3 repos are
+                               decompiled at the same time"
   echo "$usage"
 }
 
@@ -58,16 +63,44 @@ if [ ! -d "$DATASET_DIR" ]; then
   mkdir -p "$DATASET_DIR"
 fi
 
-# Run everything simultaneously, and run Ghidra in watch mode (Ghidra doesn't need to force because it will only process new files)
+# The 3 repos' Ghidra instances run at the same time, so split the cores between all of them
+# (decompile/run.sh would split them between only its own instances)
+if [ "${DECOMPILE_THREADS:-}" == "" ]; then
+  NUM_CORES=$(getconf _NPROCESSORS_ONLN)
+  if [ "$NUM_GHIDRA_INSTANCES" -gt 0 ] && [ "$NUM_CORES" -gt $((3 * NUM_GHIDRA_INSTANCES)) ]; then
+    DECOMPILE_THREADS=$((NUM_CORES / (3 * NUM_GHIDRA_INSTANCES)))
+  else
+    DECOMPILE_THREADS=1
+  fi
+fi
+export DECOMPILE_THREADS
+
+# Run everything simultaneously, and run Ghidra in watch mode, so each package is decompiled as soon as it's built
+# (Ghidra doesn't need to force because it will only process new files).
+# Each repo's STATS_DIR/.done tells Ghidra that repo won't build any more packages.
+# apt's packages are only copied out of its container at the end, and its stats are copied with them (in no particular
+# order), so Ghidra watches a separate dir which gets apt's markers after every artifact is copied
+APT_STATS_DIR="$DATASET_DIR/apt-stats"
+VCPKG_STATS_DIR="$DATASET_DIR/vcpkg-stats"
+CONAN_STATS_DIR="$DATASET_DIR/conan/stats"
+mkdir -p "$APT_STATS_DIR" "$VCPKG_STATS_DIR" "$CONAN_STATS_DIR"
+rm -f "$APT_STATS_DIR/.done" "$VCPKG_STATS_DIR/.done" "$CONAN_STATS_DIR/.done" "$DATASET_DIR/ghidra.done"
 (
   "$PARENT_DIR/apt/run.sh" -o "$DATASET_DIR/apt" -n "$NUM_PACKAGES" "$FORCE";
-  "$PARENT_DIR/ghidra/run.sh" -o "$DATASET_DIR/apt" -n "$NUM_PACKAGES" -l "$GHIDRA_SCRIPT_LOG_DIR" -j "$NUM_GHIDRA_INSTANCES"
+  find "$DATASET_DIR/apt/stats" -maxdepth 1 -name "*.success" -exec cp {} "$APT_STATS_DIR" \;
+  touch "$APT_STATS_DIR/.done"
 ) &
+"$PARENT_DIR/decompile/run.sh" -o "$DATASET_DIR/apt" -w "$APT_STATS_DIR" -l "$GHIDRA_SCRIPT_LOG_DIR" -j "$NUM_GHIDRA_INSTANCES" &
 (
   "$PARENT_DIR/vcpkg/run.sh" -o "$DATASET_DIR/vcpkg" -n "$NUM_PACKAGES" "$FORCE";
-  "$PARENT_DIR/ghidra/run.sh" -o "$DATASET_DIR/vcpkg/buildtrees" -n "$NUM_PACKAGES" -l "$GHIDRA_SCRIPT_LOG_DIR" -j "$NUM_GHIDRA_INSTANCES"
+  touch "$VCPKG_STATS_DIR/.done"
 ) &
+"$PARENT_DIR/decompile/run.sh" -o "$DATASET_DIR/vcpkg/buildtrees" -w "$VCPKG_STATS_DIR" -l "$GHIDRA_SCRIPT_LOG_DIR" -j "$NUM_GHIDRA_INSTANCES" &
 (
   "$PARENT_DIR/conan/run.sh" -o "$DATASET_DIR/conan" -n "$NUM_PACKAGES" "$FORCE";
-  "$PARENT_DIR/ghidra/run.sh" -o "$DATASET_DIR/conan/data" -n "$NUM_PACKAGES" -l "$GHIDRA_SCRIPT_LOG_DIR" -j "$NUM_GHIDRA_INSTANCES"
+  touch "$CONAN_STATS_DIR/.done"
 ) &
+"$PARENT_DIR/decompile/run.sh" -o "$DATASET_DIR/conan/data" -w "$CONAN_STATS_DIR" -l "$GHIDRA_SCRIPT_LOG_DIR" -j "$NUM_GHIDRA_INSTANCES" &
+wait
+# Tells `gen-examples --follow` that no more artifacts will be decompiled
+touch "$DATASET_DIR/ghidra.done"
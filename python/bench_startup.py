@@ -0,0 +1,75 @@
+"""
+Benchmarks how long short CLI invocations take, and fails if they're too slow or cmdline.py imports heavy modules
+at startup (they must only be imported by the command which needs them).
+
+Usage: python bench_startup.py [-n RUNS] [--max-seconds SECONDS]
+"""
+import subprocess
+import sys
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+CMDLINE_PATH = Path(__file__).parent / "cmdline.py"
+# Invocations which shouldn't load a model or dataset, so should start quickly
+STARTUP_COMMANDS = [
+    ["--help"],
+    ["gen-examples", "--help"],
+    ["inspect", "--help"],
+    ["train", "--help"],
+    ["transform", "--help"],
+]
+# Modules which take seconds to import, so must not be imported by `import cmdline`
+HEAVY_MODULES = ["torch", "transformers", "tokenizers", "evaluate", "tree_sitter", "numpy"]
+
+
+def heavy_imports() -> list[str]:
+    """heavy modules imported by `import cmdline`, run in a fresh interpreter"""
+    check = f"import sys, cmdline; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-c", check],
+        cwd=CMDLINE_PATH.parent,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return result.stdout.split()
+
+
+def time_command(args: list[str], num_runs: int) -> float:
+    """median wall-clock seconds to run cmdline.py with args"""
+    times = []
+    for _ in range(num_runs):
+        start_time = perf_counter()
+        subprocess.run([sys.executable, str(CMDLINE_PATH), *args], stdout=subprocess.DEVNULL, check=True)
+        times.append(perf_counter() - start_time)
+    return median(times)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, help="number of runs of each command (default = 5)", default=5)
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        help="fail if the median time of any command exceeds this (default = 1.0)",
+        default=1.0
+    )
+    args = parser.parse_args()
+
+    failed = False
+    imported = heavy_imports()
+    if len(imported) > 0:
+        print(f"FAIL: `import cmdline` imports {', '.join(imported)}")
+        failed = True
+    for command in STARTUP_COMMANDS:
+        seconds = time_command(command, args.n)
+        too_slow = seconds > args.max_seconds
+        print(f"{'FAIL' if too_slow else 'ok'}: cmdline.py {' '.join(command)}: {seconds:.3f}s")
+        failed = failed or too_slow
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,11 @@
 from pathlib import Path
 from sys import argv
 
-from code_types import ALL_LANGS
-from generate import generate
-from inspect_ import inspect
-from train import train
-from transform_ir import transform_ir
-from transform import transform
-from utils import DEFAULT_DATASET_PATH, DEFAULT_MODEL_PATH, INT32_MAX, path_or_float, DEFAULT_EXAMPLES_PATH, run_script
+# Commands are imported in their *_cmd function, since some import torch and transformers, which take seconds.
+# Only import cheap modules at the top (bench_startup.py checks this)
+from inference_cache import DEFAULT_INFERENCE_CACHE_PATH
+from utils import DEFAULT_DATASET_PATH, DEFAULT_MODEL_PATH, INT32_MAX, path_or_float, DEFAULT_EXAMPLES_PATH, \
+    run_script, ALL_LANGS, BACKENDS
 
 
 def get_data_cmd(_args):
@@ -16,23 +14,57 @@ def get_data_cmd(_args):
 
 
 def generate_cmd(args):
-    generate(args.i, args.o, args.l, args.n, args.f)
+    from generate import generate
+    generate(args.i, args.o, args.l, args.n, args.f, args.j, args.rescan, args.dedup, args.follow)
+
+
+def convert_examples_cmd(args):
+    from convert import convert_examples
+    convert_examples(args.i, args.o, args.f)
 
 
 def inspect_cmd(args):
-    inspect(args.i, args.l, args.n, args.skip, args.seed)
+    from inspect_ import inspect
+    inspect(args.i, args.l, args.n, args.skip, args.seed, args.ident)
 
 
 def train_cmd(args):
-    train(args.i, args.eval, args.o, args.l, args.n, args.f, args.resume)
+    from train import train
+    train(args.i, args.eval, args.o, args.l, args.n, args.f, args.resume, args.batch_tokens)
 
 
 def transform_ir_cmd(args):
-    transform_ir(args.i, args.o, args.m, args.l, args.n, args.f)
+    from transform_ir import transform_ir
+    transform_ir(
+        args.i,
+        args.o,
+        args.m,
+        args.l,
+        args.n,
+        args.f,
+        args.b,
+        None if args.no_cache else args.cache,
+        args.j,
+        args.incremental,
+        args.backend
+    )
 
 
 def transform_cmd(args):
-    transform(args.i, args.o, args.m, args.l, args.n, args.f)
+    from transform import transform
+    transform(
+        args.i,
+        args.o,
+        args.m,
+        args.l,
+        args.n,
+        args.f,
+        args.b,
+        None if args.no_cache else args.cache,
+        args.j,
+        args.incremental,
+        args.backend
+    )
 
 
 def main():
@@ -83,8 +115,62 @@ def main():
         help="number of examples to add (default = all)",
         default=INT32_MAX
     )
+    generate_parser.add_argument(
+        "-j",
+        type=int,
+        help="number of processes to scrape artifacts in parallel (default = 1, 0 = one per CPU)."
+             "Examples are the same regardless of the number of processes",
+        default=1
+    )
+    generate_parser.add_argument(
+        "--rescan",
+        help="rescan the dataset directory instead of using the saved manifest of its files."
+             "The manifest is rescanned automatically when artifacts are added or removed, "
+             "but not when files change within an artifact",
+        action="store_true"
+    )
+    generate_parser.add_argument(
+        "--dedup",
+        type=float,
+        metavar="THRESHOLD",
+        help="remove examples which are duplicates of earlier ones: exact duplicates (ignoring whitespace, literals "
+             "and decompiler-generated names), and if THRESHOLD < 1, near-duplicates whose estimated similarity "
+             "(Jaccard similarity of token shingles, via MinHash) is at least THRESHOLD, e.g. 0.9. "
+             "Memory is bounded by only comparing with recent examples (see DEDUP_GENERATION_SIZE in dedup.py)"
+    )
+    generate_parser.add_argument(
+        "--follow",
+        help="add artifacts as they're decompiled (get ghidra.success, e.g. from get-data/run.sh), saving the output "
+             "every FOLLOW_SAVE_INTERVAL seconds (default: 600) and when stopped, until the dataset directory gets "
+             "ghidra.done. If the output exists and -f isn't given, resumes adding to it (which first reads all of "
+             "its examples into memory)",
+        action="store_true"
+    )
     generate_parser.set_defaults(func=generate_cmd)
 
+    convert_examples_parser = subparsers.add_parser(
+        "convert-examples",
+        help="convert a legacy .pickle model examples file, or one in an older format, into the current format"
+    )
+    convert_examples_parser.add_argument(
+        "-i",
+        type=Path,
+        help="legacy model examples file",
+        required=True
+    )
+    convert_examples_parser.add_argument(
+        "-o",
+        type=Path,
+        help=f"output file (default: {DEFAULT_EXAMPLES_PATH})",
+        default=DEFAULT_EXAMPLES_PATH
+    )
+    convert_examples_parser.add_argument(
+        "-f",
+        help="force overwrite output file",
+        action="store_true"
+    )
+    convert_examples_parser.set_defaults(func=convert_examples_cmd)
+
     inspect_parser = subparsers.add_parser(
         "inspect",
         help="print model examples to stdout"
@@ -119,6 +205,12 @@ def main():
         help="if present, shuffles the dataset with the given seed before (taking -n and --skip and) printing",
         default=0
     )
+    inspect_parser.add_argument(
+        "--ident",
+        type=str,
+        help="only print examples with this ident, or whose ident matches it if it's a glob (e.g. 'inflate::inflate*'). "
+             "Looking up an ident (or glob with a literal prefix) only reads the matching examples"
+    )
     inspect_parser.set_defaults(func=inspect_cmd)
 
     train_parser = subparsers.add_parser(
@@ -169,6 +261,14 @@ def main():
         action="store_true",
         help="resume training from the last checkpoint"
     )
+    train_parser.add_argument(
+        "--batch-tokens",
+        type=int,
+        help="maximum number of tokens (including padding) in each batch. "
+             "Examples are batched with others of similar length, so batches of short examples are larger "
+             "(default = 4096)",
+        default=4096
+    )
     train_parser.set_defaults(func=train_cmd)
 
     transform_ir_parser = subparsers.add_parser(
@@ -193,6 +293,12 @@ def main():
         help="force overwrite of output directory",
         action="store_true"
     )
+    transform_ir_parser.add_argument(
+        "--incremental",
+        help="keep the existing output directory, and only transform files which are new or changed since the last "
+             "run (or transformed with a different model). Use to resume an interrupted run. Overrides -f",
+        action="store_true"
+    )
     transform_ir_parser.add_argument(
         "-m",
         type=Path,
@@ -211,6 +317,40 @@ def main():
         help="number of files to transform (default = all files)",
         default=INT32_MAX
     )
+    transform_ir_parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        help="how to run the model: torch (full precision), int8 (dynamically quantized) or onnx (onnxruntime, "
+             "requires optimum). int8 and onnx are faster on CPU, and are exported and cached in the model directory "
+             "on first use (default = torch)",
+        default="torch"
+    )
+    transform_ir_parser.add_argument(
+        "-b",
+        type=int,
+        help="number of functions to run the model on at once. "
+             "Functions are batched across files, with others of similar length (default = 8)",
+        default=8
+    )
+    transform_ir_parser.add_argument(
+        "--cache",
+        type=Path,
+        help="cache of model outputs, so that functions already transformed by the same model are reused. "
+             "Size is limited by the INFERENCE_CACHE_SIZE environment variable (bytes) "
+             f"(default = {DEFAULT_INFERENCE_CACHE_PATH})",
+        default=DEFAULT_INFERENCE_CACHE_PATH
+    )
+    transform_ir_parser.add_argument(
+        "--no-cache",
+        help="don't read or write the cache of model outputs",
+        action="store_true"
+    )
+    transform_ir_parser.add_argument(
+        "-j",
+        type=int,
+        help="number of processes to read (parse) files in parallel with the model (default = 1, 0 = one per CPU)",
+        default=1
+    )
     transform_ir_parser.set_defaults(func=transform_ir_cmd)
 
     transform_parser = subparsers.add_parser(
@@ -234,6 +374,12 @@ def main():
         help="force overwrite of output directory",
         action="store_true"
     )
+    transform_parser.add_argument(
+        "--incremental",
+        help="keep the existing output directory, and only transform files which are new or changed since the last "
+             "run (or transformed with a different model). Use to resume an interrupted run. Overrides -f",
+        action="store_true"
+    )
     transform_parser.add_argument(
         "-m",
         type=Path,
@@ -252,6 +398,40 @@ def main():
         help="number of files to transform (default = all files)",
         default=INT32_MAX
     )
+    transform_parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        help="how to run the model: torch (full precision), int8 (dynamically quantized) or onnx (onnxruntime, "
+             "requires optimum). int8 and onnx are faster on CPU, and are exported and cached in the model directory "
+             "on first use (default = torch)",
+        default="torch"
+    )
+    transform_parser.add_argument(
+        "-b",
+        type=int,
+        help="number of functions to run the model on at once. "
+             "Functions are batched across files, with others of similar length (default = 8)",
+        default=8
+    )
+    transform_parser.add_argument(
+        "--cache",
+        type=Path,
+        help="cache of model outputs, so that functions already transformed by the same model are reused. "
+             "Size is limited by the INFERENCE_CACHE_SIZE environment variable (bytes) "
+             f"(default = {DEFAULT_INFERENCE_CACHE_PATH})",
+        default=DEFAULT_INFERENCE_CACHE_PATH
+    )
+    transform_parser.add_argument(
+        "--no-cache",
+        help="don't read or write the cache of model outputs",
+        action="store_true"
+    )
+    transform_parser.add_argument(
+        "-j",
+        type=int,
+        help="number of processes to read (parse) files in parallel with the model (default = 1, 0 = one per CPU)",
+        default=1
+    )
     transform_parser.set_defaults(func=transform_cmd)
 
     func_and_args = parser.parse_args()
@@ -1,16 +1,33 @@
+import json
+import mmap
+import struct
 import traceback
 from abc import ABC
 from itertools import islice
+from os import environ
 from pathlib import Path
 import re
-from typing import Iterator, Iterable
+from typing import Iterator, Iterable, NamedTuple
 
+import numpy as np
 from tree_sitter import Parser, Language
 from tree_sitter_langs import scrape_functions, C_LANGUAGE, CPP_LANGUAGE, TreeSitterFunction
 
 from code_type import CodeType, ModelStr, ExampleDb, TransformStr
 from log import log
-from utils import chunk2
+
+_FUNCTION_MARKER_REGEX = re.compile(rb"^// FUNCTION (.+)$", flags=re.MULTILINE)
+# Decompiled records (written by BatchDecompile with DECOMPILED_FORMAT=records) layout (integers are little-endian):
+#   records: one UTF-8 JSON object per function (see DecompiledFunction) followed by "\n"
+#   index: per function, uint64 offset of its record, uint32 length, uint32 body size (bytes of machine code)
+#   footer: uint64 offset of the index, uint64 number of functions, RECORDS_MAGIC
+DECOMPILED_RECORDS_EXTENSION = ".o.records"
+RECORDS_MAGIC = b"UBDECMP1"
+_RECORDS_FOOTER = struct.Struct("<QQ8s")
+_RECORDS_INDEX_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("body_size", "<u4")])
+# Decompiled functions with more bytes of machine code than this are skipped, if their size is known
+# (in decompiled records) so they're skipped without reading. 0 = no limit
+MAX_DECOMPILED_BODY_SIZE = int(environ.get("MAX_DECOMPILED_BODY_SIZE", 0))
 
 
 class _CExampleDb(ExampleDb):
@@ -25,8 +42,8 @@ class _CExampleDb(ExampleDb):
         try:
             functions = _scrape_functions(path, self.language, self.parser)
             for function in functions:
-                if '{' in function.text:
-                    _, function_text, _ = _split_function(function.text)
+                if function.has_body:
+                    function_text = function.body()
                     function_id = self._get_function_id(path, function.name)
                     if function_id not in self.source_functions:
                         num_examples_added += 1
@@ -44,22 +61,48 @@ class _CExampleDb(ExampleDb):
             # Some files are empty (file existence tells Ghidra to ignore, but there is nothing extractable)
             log.debug(f"Skipping empty file {path}")
             return 0
-        with path.open("rb") as decompiled_file:
-            # We don't want to fail on non-utf8 files (which do exist in the data for some reason)
-            decompiled_text = decompiled_file.read().decode("utf-8", errors="ignore")
-        # Functions in decompiled code are already denoted
-        decompiled_components = re.split(r"^// FUNCTION (.+)$", decompiled_text, flags=re.MULTILINE)
-        if len(decompiled_components) % 2 != 1:
-            log.warning(f"Bad decompiled data format in {path} ({len(decompiled_components)} components):\n" +
-                        "\n---\n".join(decompiled_components))
-            return 0
+        if path.name.endswith(DECOMPILED_RECORDS_EXTENSION):
+            return self._add_decompiled_records(path)
         num_examples_added = 0
-        for function_name, function_text in chunk2(decompiled_components[1:]):
-            _, function_text, _ = _split_function(function_text)
-            function_id = self._get_function_id(path, function_name)
-            if function_id not in self.decompiled_functions:
-                num_examples_added += 1
-            self.decompiled_functions[function_id] = function_text
+        # Functions in decompiled code are already denoted.
+        # Files can be huge, so we scan a mmap and only decode each function
+        with path.open("rb") as decompiled_file, \
+                mmap.mmap(decompiled_file.fileno(), 0, access=mmap.ACCESS_READ) as decompiled_bytes:
+            for function_name, start, end in scan_decompiled_functions(decompiled_bytes):
+                # Only the body (between the first "{" and last "}") is decoded
+                body_start = decompiled_bytes.find(b"{", start, end)
+                if body_start == -1:
+                    log.debug(f"Skipping function without body {function_name} in {path}")
+                    continue
+                body_end = decompiled_bytes.rfind(b"}", body_start + 1, end)
+                if body_end == -1:
+                    body_end = end
+                # We don't want to fail on non-utf8 files (which do exist in the data for some reason)
+                function_text = str(decompiled_bytes[body_start + 1:body_end], "utf-8", errors="ignore")
+                function_id = self._get_function_id(path, function_name)
+                if function_id not in self.decompiled_functions:
+                    num_examples_added += 1
+                self.decompiled_functions[function_id] = function_text
+        return num_examples_added
+
+    def _add_decompiled_records(self, path: Path) -> int:
+        num_examples_added = 0
+        try:
+            with DecompiledRecords(path) as records:
+                # Only the selected functions' records are read and parsed
+                for i in records.select(MAX_DECOMPILED_BODY_SIZE):
+                    function = records[i]
+                    body = _decompiled_body(function.c)
+                    if body is None:
+                        log.debug(f"Skipping function without body {function.name} in {path}")
+                        continue
+                    function_id = self._get_function_id(path, function.name)
+                    if function_id not in self.decompiled_functions:
+                        num_examples_added += 1
+                    self.decompiled_functions[function_id] = body
+        except ValueError as e:
+            # e.g. Ghidra crashed while writing it
+            log.warning(f"Failed to read decompiled records {path}: {e}")
         return num_examples_added
 
     def build_examples(self) -> Iterator[tuple[str, ModelStr, ModelStr]]:
@@ -107,12 +150,15 @@ class _CCodeType(CodeType, ABC):
 
     def process_decompiled(self, decompiled_path: Path) -> Iterator[TransformStr]:
         self._assert_decompiled_suffix(decompiled_path)
+        if decompiled_path.name.endswith(DECOMPILED_RECORDS_EXTENSION):
+            yield from _process_decompiled_records(decompiled_path)
+            return
         # TODO: Do this properly - walk through *every* node using Cursor, but TransformStr.regular iff the node matches
         #   the query and body has "{" and TransformStr.pass_through otherwise
         decompiled_functions = _scrape_functions(decompiled_path, self.language, self.parser)
         for function in decompiled_functions:
-            if '{' in function.text:
-                head, body, tail = _split_function(function.text)
+            if function.has_body:
+                head, body, tail = function.split()
                 yield TransformStr.pass_through(head)
                 yield TransformStr.regular(body)
                 yield TransformStr.pass_through(tail)
@@ -135,18 +181,111 @@ def _scrape_functions(path: Path, language: Language, parser: Parser) -> Iterabl
     return scrape_functions(path, language if path.suffix != "c" else C_LANGUAGE, parser)
 
 
-def _split_function(node_text: str) -> tuple[str, str, str]:
-    head, body_foot = node_text.split("{", 1)
-    if '}' in body_foot:
-        body, foot = body_foot.rsplit("}", 1)
-        return head + "{", body, "}" + foot
-    else:
-        return head + "{", body_foot, ""
+def scan_decompiled_functions(decompiled_bytes: bytes | mmap.mmap) -> Iterator[tuple[str, int, int]]:
+    """
+    (name, start, end) of each function in decompiled code (Ghidra output), where decompiled_bytes[start:end] is the
+    function's text. Functions are denoted by a "// FUNCTION <name>" line before them, anything before the first
+    is ignored. Functions are yielded as they are found, so this doesn't hold more than one in memory
+    """
+    name = None
+    start = 0
+    for marker in _FUNCTION_MARKER_REGEX.finditer(decompiled_bytes):
+        if name is not None:
+            yield name, start, marker.start()
+        name = str(marker.group(1), "utf-8", errors="ignore")
+        start = marker.end()
+    if name is not None:
+        yield name, start, len(decompiled_bytes)
+
+
+class DecompiledFunction(NamedTuple):
+    """a function in decompiled records"""
+    name: str
+    qualified_name: str
+    # Address of the function's entry point (hex)
+    entry: str
+    # Bytes of machine code
+    body_size: int
+    decompile_ms: int
+    c: str
+
+
+class DecompiledRecords:
+    """
+    Reads decompiled records. The file is memory-mapped and only the index is read up front,
+    so functions can be selected (e.g. by size) and read individually without reading the rest
+    """
+    def __init__(self, path: Path):
+        self._file = path.open("rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("empty file")
+        if len(self._mmap) < _RECORDS_FOOTER.size or self._mmap[-len(RECORDS_MAGIC):] != RECORDS_MAGIC:
+            self.close()
+            raise ValueError("not decompiled records, or they're incomplete")
+        index_offset, num_functions, _ = _RECORDS_FOOTER.unpack_from(self._mmap, len(self._mmap) - _RECORDS_FOOTER.size)
+        # Copied so the mmap can be closed (it can't while arrays reference it)
+        self.index = np.frombuffer(self._mmap, dtype=_RECORDS_INDEX_DTYPE, count=num_functions, offset=index_offset).copy()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> DecompiledFunction:
+        offset, length = int(self.index["offset"][i]), int(self.index["length"][i])
+        return DecompiledFunction(**json.loads(self._mmap[offset:offset + length]))
+
+    def __iter__(self) -> Iterator[DecompiledFunction]:
+        return (self[i] for i in range(len(self)))
+
+    def select(self, max_body_size: int = 0) -> np.ndarray:
+        """indices of the functions with at most max_body_size bytes of machine code (0 = all)"""
+        if max_body_size <= 0:
+            return np.arange(len(self))
+        return np.flatnonzero(self.index["body_size"] <= max_body_size)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "DecompiledRecords":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _decompiled_body(function_text: str) -> str | None:
+    """text between the first "{" and last "}" (or the end if there's no "}" after it). None if there's no "{" """
+    body_start = function_text.find("{")
+    if body_start == -1:
+        return None
+    body_end = function_text.rfind("}", body_start + 1)
+    if body_end == -1:
+        body_end = len(function_text)
+    return function_text[body_start + 1:body_end]
+
+
+def _process_decompiled_records(decompiled_path: Path) -> Iterator[TransformStr]:
+    """like text output, each function is preceded by "// FUNCTION <name>" (passed through) and only bodies transformed"""
+    with DecompiledRecords(decompiled_path) as records:
+        for function in records:
+            yield TransformStr.pass_through(f"// FUNCTION {function.name}")
+            body = _decompiled_body(function.c)
+            if body is None:
+                yield TransformStr.pass_through(function.c)
+                continue
+            body_start = function.c.index("{") + 1
+            body_end = body_start + len(body)
+            yield TransformStr.pass_through(function.c[:body_start])
+            yield TransformStr.regular(body)
+            yield TransformStr.pass_through(function.c[body_end:])
 
 
 class CCodeType(_CCodeType):
     def __init__(self):
-        super().__init__(C_LANGUAGE, [".c"], [".o.c"])
+        super().__init__(C_LANGUAGE, [".c"], [".o.c", DECOMPILED_RECORDS_EXTENSION])
 
     def __str__(self):
         return "C"
@@ -160,7 +299,7 @@ class CppCodeType(_CCodeType):
         super().__init__(
             CPP_LANGUAGE,
             [".c", ".cpp", ".cc", ".cxx", ".c++"],
-            [".o.c", ".o.cpp", ".o.cc", ".o.cxx", ".o.c++"]
+            [".o.c", ".o.cpp", ".o.cc", ".o.cxx", ".o.c++", DECOMPILED_RECORDS_EXTENSION]
         )
 
     def __str__(self):
@@ -4,6 +4,3 @@ CODE_TYPES = {
     "c": CCodeType(),
     "cpp": CppCodeType()
 }
-
-
-ALL_LANGS = "cpp"
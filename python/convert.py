@@ -0,0 +1,18 @@
+from pathlib import Path
+
+from dataset import ModelData
+from log import log
+from utils import mk_empty_binary_file
+
+
+def convert_examples(pickle_path: Path, examples_path: Path, force: bool):
+    """
+    converts a legacy pickled examples file, or an example store in an older version of the format (e.g. without the
+    ident index), into an example store
+    """
+    if not pickle_path.exists():
+        raise ValueError(f"Examples path {pickle_path} does not exist")
+    data = ModelData.load(pickle_path)
+    log.info(f"** converting {len(data)} examples")
+    with mk_empty_binary_file(examples_path, force) as examples_file:
+        data.save(examples_file)
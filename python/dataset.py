@@ -1,20 +1,24 @@
 import pickle
+from array import array
 from io import TextIOWrapper
 from itertools import count
+from multiprocessing import Pool
 from pathlib import Path
-from random import Random
 from time import time
-from typing import BinaryIO, Dict, Optional
+from typing import BinaryIO, Dict, Iterator, Optional
 
 from code_type import CodeType, ExampleDb, ModelStr
+from dedup import Deduplicator, Fingerprint, MinHasher
+from example_store import ExampleStore, is_example_store, write_example_store, print_examples
 from log import log, logging_progress_bar, WithLoggingPbar, Pbar
-from model import tokenize
+from manifest import RepoManifest, ManifestFile
+from token_cache import load_or_tokenize_store, tokenize_examples
+from tree_sitter_langs import INCLUDE_CACHE, IncludeCacheStats, clear_include_index
 from tokenizers import Tokenizer
 
+import numpy as np
 import torch
 
-from utils import walk_files
-
 
 class _ModelDataRepoPbars:
     def __init__(
@@ -63,52 +67,174 @@ class _WithModelDataRepoPbars:
         self.decompiled_files.__exit__(exc_type, exc_val, exc_tb)
 
 
+class _ArtifactExamples:
+    """examples scraped from one artifact, which may have been scraped in a worker process"""
+    def __init__(
+            self,
+            artifact_name: str,
+            examples: list[tuple[str, ModelStr, ModelStr, CodeType]],
+            fingerprints: Optional[list[Fingerprint]],
+            num_source_files: int,
+            num_decompiled_files: int,
+            include_cache_stats: IncludeCacheStats):
+        self.artifact_name = artifact_name
+        self.examples = examples
+        # If deduplicating, fingerprint of each example
+        self.fingerprints = fingerprints
+        self.num_source_files = num_source_files
+        self.num_decompiled_files = num_decompiled_files
+        self.include_cache_stats = include_cache_stats
+
+
+def _scrape_artifact(
+        code_types: list[CodeType],
+        artifact_dir: Path,
+        files: list[ManifestFile],
+        max_len: int,
+        hasher: Optional[MinHasher],
+        pbars: Optional[_ModelDataRepoPbars]) -> _ArtifactExamples:
+    """
+    scrapes an artifact (self-contained directory of source and decompiled files) into examples.
+    If hasher is given, also fingerprints the examples (so that in parallel, they are fingerprinted in parallel).
+    If pbars is None (e.g. we are in a worker process), the caller is responsible for updating progress
+    """
+    if not artifact_dir.exists():
+        raise ValueError(f"artifact dir {str(artifact_dir)} does not exist")
+
+    dbs: Dict[CodeType, ExampleDb] = {code_type: code_type.ExampleDb() for code_type in code_types}
+    num_processed_source_examples = 0
+    num_processed_decompiled_examples = 0
+    num_source_files = 0
+    num_decompiled_files = 0
+
+    log.info(f"* adding artifact {artifact_dir.name}")
+    start_time = time()
+    start_include_cache_stats = INCLUDE_CACHE.stats()
+    try:
+        for relative_path, source_code_type_idxs, decompiled_code_type_idxs in files:
+            file = artifact_dir / relative_path
+            for code_type_idx in source_code_type_idxs:
+                code_type = code_types[code_type_idx]
+                if not (0 < max_len <= num_processed_source_examples):
+                    new_source_examples = dbs[code_type].add_source(file)
+                    num_processed_source_examples += new_source_examples
+                    num_source_files += 1
+                    if pbars is not None:
+                        pbars.source_files.update(1)
+            for code_type_idx in decompiled_code_type_idxs:
+                code_type = code_types[code_type_idx]
+                if not (0 < max_len <= num_processed_decompiled_examples):
+                    new_decompiled_examples = dbs[code_type].add_decompiled(file)
+                    num_processed_decompiled_examples += new_decompiled_examples
+                    num_decompiled_files += 1
+                    if pbars is not None:
+                        pbars.decompiled_files.update(1)
+    except KeyboardInterrupt:
+        log.info(f"* interrupted, not adding any more examples for artifact {artifact_dir.name}")
+        for db in dbs.values():
+            db.process_interrupt()
+        raise KeyboardInterrupt
+    except Exception as e:
+        log.exception(f"* error while adding artifact {artifact_dir.name}")
+        for db in dbs.values():
+            db.process_interrupt()
+        raise e
+    finally:
+        examples = []
+        num_examples_added_for_code_type = {}
+        for code_type, db in dbs.items():
+            num_examples_added = 0
+            for ident, source, decompiled in db.build_examples():
+                source_empty = source.strip() == ""
+                decompiled_empty = decompiled.strip() == ""
+                if source_empty and not decompiled_empty:
+                    log.warning(f"source is empty but not decompiled: {ident}")
+                    continue
+                elif decompiled_empty and not source_empty:
+                    log.warning(f"decompiled is empty but not source: {ident}")
+                    continue
+                examples.append((ident, source, decompiled, code_type))
+                num_examples_added += 1
+            num_examples_added_for_code_type[code_type] = num_examples_added
+        num_examples_added_for_code_type_str = ", ".join(
+            f"{str(code_type)}: {num_examples_added}"
+            for code_type, num_examples_added in num_examples_added_for_code_type.items()
+        )
+        duration = time() - start_time
+        log.info(f"* added {len(examples)} [{num_examples_added_for_code_type_str}] examples from "
+                 f"artifact {artifact_dir.name} ({'%.2f' % duration} seconds)")
+        include_cache_stats = INCLUDE_CACHE.stats() - start_include_cache_stats
+        fingerprints = [hasher.fingerprint(source, decompiled) for _, source, decompiled, _ in examples] \
+            if hasher is not None else None
+        return _ArtifactExamples(
+            artifact_dir.name,
+            examples,
+            fingerprints,
+            num_source_files,
+            num_decompiled_files,
+            include_cache_stats
+        )
+
+
+def _scrape_artifact_in_worker(args: tuple[list[CodeType], Path, list[ManifestFile], int, Optional[MinHasher]]) \
+        -> _ArtifactExamples:
+    """_scrape_artifact for Pool.imap: each worker process unpickles its own code types, so it has its own Parser"""
+    code_types, artifact_dir, files, max_len, hasher = args
+    return _scrape_artifact(code_types, artifact_dir, files, max_len, hasher, None)
+
+
 class ModelData:
-    def add_repo(self, code_types: list[CodeType], repo_dir: Path):
+    def add_repo(
+            self,
+            code_types: list[CodeType],
+            repo_dir: Path,
+            num_workers: int = 1,
+            rescan: bool = False,
+            dedup_threshold: Optional[float] = None,
+            artifact_names: Optional[list[str]] = None):
         """
         adds an repo (directory of artifacts;
-        each artifact is a self-contained directory of source and decompiled files)
+        each artifact is a self-contained directory of source and decompiled files).
+        If num_workers != 1, artifacts are scraped in that many worker processes (0 = one per CPU).
+        The examples are the same (and in the same order) regardless of num_workers.
+        The repo's files are listed in a saved manifest (see RepoManifest.load_or_scan).
+        If dedup_threshold is given, examples which are duplicates or near-duplicates (estimated similarity >=
+        dedup_threshold) of earlier examples in the repo aren't added (see Deduplicator).
+        If artifact_names is given, only adds those artifacts (relative paths, which may be nested), and they are
+        scanned without a saved manifest. Then this may be called repeatedly to add a repo incrementally, and examples
+        are also deduplicated against the previous calls' (if they had the same dedup_threshold)
         """
         if not repo_dir.exists():
             raise ValueError(f"repo dir {str(repo_dir)} does not exist")
 
-        # noinspection PyShadowingNames
-        def get_artifact(file: Path):
-            # artifact = <child of root dir which is ancestor of file>
-            artifact = file
-            while artifact.parent != repo_dir:
-                artifact = artifact.parent
-            return artifact
-
-        log.info(f"** calculating size of repo {str(repo_dir)}")
-        artifacts = set()
-        num_source_files = 0
-        num_decompiled_files = 0
-        for file in walk_files(repo_dir):
-            artifact = get_artifact(file)
-
-            for code_type in code_types:
-                if any(file.name.endswith(extension) for extension in code_type.decompiled_extensions):
-                    num_decompiled_files += 1
-                    artifacts.add(artifact)
-                elif any(file.name.endswith(extension) for extension in code_type.source_extensions):
-                    num_source_files += 1
-                    artifacts.add(artifact)
+        if artifact_names is None:
+            manifest = RepoManifest.load_or_scan(repo_dir, code_types, rescan)
+        else:
+            manifest = RepoManifest.scan(repo_dir, code_types, artifact_names)
 
         log.info(f"** adding repo {str(repo_dir)}")
         original_num_examples = len(self)
+        self._include_cache_stats = IncludeCacheStats()
+        # Worker processes are forked after this, so they don't inherit stale listings either
+        clear_include_index()
+        if dedup_threshold is None:
+            self._deduplicator = None
+        elif artifact_names is None or self._deduplicator is None or \
+                self._deduplicator.threshold != dedup_threshold:
+            self._deduplicator = Deduplicator(dedup_threshold)
         start_time = time()
         try:
-            with _WithModelDataRepoPbars(len(artifacts), num_source_files, num_decompiled_files, self.max_len) \
-                    as pbars:
+            with _WithModelDataRepoPbars(
+                    len(manifest.artifacts),
+                    manifest.num_source_files,
+                    manifest.num_decompiled_files,
+                    self.max_len
+            ) as pbars:
                 pbars.examples.update(len(self))
-                for artifact_dir in sorted(artifacts):
-                    num_new_examples = self._add_artifact(code_types, artifact_dir, pbars)
-                    pbars.artifacts.update(1)
-                    pbars.examples.update(num_new_examples)
-                    if 0 < self.max_len < len(self):
-                        log.info("** max_len reached, not adding any more examples")
-                        break
+                if num_workers == 1:
+                    self._add_artifacts_serial(code_types, manifest, pbars)
+                else:
+                    self._add_artifacts_parallel(code_types, manifest, pbars, num_workers)
         except KeyboardInterrupt:
             log.info(f"** interrupted, not adding any more examples for repo {str(repo_dir)}")
             raise KeyboardInterrupt
@@ -119,179 +245,325 @@ class ModelData:
             num_new_examples = len(self) - original_num_examples
             duration = time() - start_time
             log.info(f"** added {num_new_examples} examples from repo {str(repo_dir)} ({'%.2f' % duration} seconds)")
+            log.info(f"** {str(self._include_cache_stats)}")
+            if self._deduplicator is not None:
+                log.info(f"** {str(self._deduplicator)}")
 
-    def _add_artifact(self, code_types: list[CodeType], artifact_dir: Path, pbars: _ModelDataRepoPbars) -> int:
-        """
-        adds an artifact (self-contained directory of source and decompiled files).
-        This is private because of pbar: we could create a public version which creates a pbar for one artifact
-        and call this within the with _WithModelDataArtifactPbars as pbars clause (then make pbars type a Union)
-        """
-        if not artifact_dir.exists():
-            raise ValueError(f"artifact dir {str(artifact_dir)} does not exist")
-
-        dbs: Dict[CodeType, ExampleDb] = {code_type: code_type.ExampleDb() for code_type in code_types}
-        num_processed_source_examples = 0
-        num_processed_decompiled_examples = 0
+    def _add_artifacts_serial(
+            self,
+            code_types: list[CodeType],
+            manifest: RepoManifest,
+            pbars: _ModelDataRepoPbars):
+        for artifact_name, files in manifest.artifacts.items():
+            artifact_examples = _scrape_artifact(
+                code_types,
+                manifest.repo_dir / artifact_name,
+                files,
+                self.max_len,
+                self._hasher(),
+                pbars
+            )
+            if self._add_artifact_examples(artifact_examples, pbars):
+                break
 
-        log.info(f"* adding artifact {artifact_dir.name}")
-        start_time = time()
-        try:
-            for file in walk_files(artifact_dir):
-                for code_type in code_types:
-                    if not (0 < self.max_len <= num_processed_source_examples) and \
-                            any(file.name.endswith(e) for e in code_type.source_extensions) and \
-                            not any(file.name.endswith(e) for e in code_type.decompiled_extensions):
-                        new_source_examples = dbs[code_type].add_source(file)
-                        num_processed_source_examples += new_source_examples
-                        pbars.source_files.update(1)
-                    if not (0 < self.max_len <= num_processed_decompiled_examples) and \
-                            any(file.name.endswith(e) for e in code_type.decompiled_extensions):
-                        new_decompiled_examples = dbs[code_type].add_decompiled(file)
-                        num_processed_decompiled_examples += new_decompiled_examples
-                        pbars.decompiled_files.update(1)
-        except KeyboardInterrupt:
-            log.info(f"* interrupted, not adding any more examples for artifact {artifact_dir.name}")
-            for db in dbs.values():
-                db.process_interrupt()
-            raise KeyboardInterrupt
-        except Exception as e:
-            log.exception(f"* error while adding artifact {artifact_dir.name}")
-            for db in dbs.values():
-                db.process_interrupt()
-            raise e
-        finally:
-            total_num_examples_added = 0
-            num_examples_added_for_code_type = {}
-            for code_type, db in dbs.items():
-                num_examples_added = 0
-                for ident, source, decompiled in db.build_examples():
-                    source_empty = source.strip() == ""
-                    decompiled_empty = decompiled.strip() == ""
-                    if source_empty and not decompiled_empty:
-                        log.warning(f"source is empty but not decompiled: {ident}")
-                        continue
-                    elif decompiled_empty and not source_empty:
-                        log.warning(f"decompiled is empty but not source: {ident}")
-                        continue
-                    self.source_decompiled_code_types.append(code_type)
-                    self.idents.append(ident)
-                    self.sources.append(source)
-                    self.decompileds.append(decompiled)
-                    num_examples_added += 1
-                total_num_examples_added += num_examples_added
-                num_examples_added_for_code_type[code_type] = num_examples_added
-            num_examples_added_for_code_type_str = ", ".join(
-                f"{str(code_type)}: {num_examples_added}"
-                for code_type, num_examples_added in num_examples_added_for_code_type.items()
+    def _add_artifacts_parallel(
+            self,
+            code_types: list[CodeType],
+            manifest: RepoManifest,
+            pbars: _ModelDataRepoPbars,
+            num_workers: int):
+        # imap returns results in submission order, so examples are merged in the same order as _add_artifacts_serial.
+        # Exiting the with block terminates the workers, so we stop scraping once max_len is reached
+        with Pool(num_workers if num_workers > 0 else None) as pool:
+            jobs = (
+                (code_types, manifest.repo_dir / artifact_name, files, self.max_len, self._hasher())
+                for artifact_name, files in manifest.artifacts.items()
             )
-            duration = time() - start_time
-            log.info(f"* added {total_num_examples_added} [{num_examples_added_for_code_type_str}] examples from "
-                     f"artifact {artifact_dir.name} ({'%.2f' % duration} seconds)")
-            return total_num_examples_added
+            for artifact_examples in pool.imap(_scrape_artifact_in_worker, jobs):
+                pbars.source_files.update(artifact_examples.num_source_files)
+                pbars.decompiled_files.update(artifact_examples.num_decompiled_files)
+                if self._add_artifact_examples(artifact_examples, pbars):
+                    break
+
+    def _add_artifact_examples(self, artifact_examples: _ArtifactExamples, pbars: _ModelDataRepoPbars) -> bool:
+        """adds the examples scraped from an artifact. Returns true iff max_len was reached"""
+        num_examples = self._num_stored()
+        fingerprints = artifact_examples.fingerprints or [None] * len(artifact_examples.examples)
+        num_duplicates = 0
+        for (ident, source, decompiled, code_type), fingerprint in zip(artifact_examples.examples, fingerprints):
+            if self._deduplicator is not None and self._deduplicator.add(fingerprint) is not None:
+                num_duplicates += 1
+                continue
+            self._append(code_type, ident, source, decompiled)
+        if self._deduplicator is not None:
+            log.info(f"* removed {num_duplicates} duplicate examples from artifact {artifact_examples.artifact_name}")
+        if self._order is not None:
+            self._order = np.concatenate([self._order, np.arange(num_examples, self._num_stored())])
+        self._include_cache_stats += artifact_examples.include_cache_stats
+        pbars.artifacts.update(1)
+        pbars.examples.update(len(artifact_examples.examples) - num_duplicates)
+        if 0 < self.max_len < len(self):
+            log.info("** max_len reached, not adding any more examples")
+            return True
+        return False
+
+    def _hasher(self) -> Optional[MinHasher]:
+        return self._deduplicator.hasher if self._deduplicator is not None else None
+
+    def _append(self, code_type: CodeType, ident: str, source: ModelStr, decompiled: ModelStr):
+        """stores an example. Doesn't add it to _order"""
+        if self._store is not None:
+            self._detach_store()
+        if code_type not in self._code_type_idxs:
+            if len(self._code_type_table) == 256:
+                raise ValueError("Too many code types")
+            self._code_type_idxs[code_type] = len(self._code_type_table)
+            self._code_type_table.append(code_type)
+        self._code_type_ids.append(self._code_type_idxs[code_type])
+        self._idents.append(ident)
+        self._sources.append(source)
+        self._decompileds.append(decompiled)
+        self._lengths.append(max(len(source), len(decompiled)))
+
+    def _num_stored(self) -> int:
+        return len(self._sources)
+
+    def _detach_store(self):
+        """decodes the stored examples from the example store, so more can be appended"""
+        log.info(f"** reading all examples from {str(self.store_path)} to add more")
+        self._idents = list(self._idents)
+        self._sources = list(self._sources)
+        self._decompileds = list(self._decompileds)
+        self._store = None
+        # The stored examples are no longer (only) the store's
+        self.store_path = None
+
+    def _indices(self) -> np.ndarray:
+        """indices of this data's examples in the stored examples, in order"""
+        return self._order if self._order is not None else np.arange(self._num_stored())
 
     def split_off_end(self, interval: float):
         split_index = int(len(self) * interval)
+        indices = self._indices()
         rhs = ModelData()
-        rhs.source_decompiled_code_types = self.source_decompiled_code_types[split_index:]
-        rhs.idents = self.idents[split_index:]
-        rhs.sources = self.sources[split_index:]
-        rhs.decompileds = self.decompileds[split_index:]
-        self.source_decompiled_code_types = self.source_decompiled_code_types[:split_index]
-        self.idents = self.idents[:split_index]
-        self.sources = self.sources[:split_index]
-        self.decompileds = self.decompileds[:split_index]
+        # Both share the stored examples, which is ok since they're only appended to and each has its own _order
+        rhs.__dict__.update(self.__dict__)
+        rhs.max_len = 0
+        rhs._include_cache_stats = IncludeCacheStats()
+        rhs._deduplicator = None
+        rhs._order = indices[split_index:]
+        self._order = indices[:split_index]
         return rhs
 
     def limit_code_types(self, code_types: list[CodeType]):
-        i = 0
-        while i < len(self):
-            if self.source_decompiled_code_types[i] not in code_types:
-                self.source_decompiled_code_types.pop(i)
-                self.idents.pop(i)
-                self.sources.pop(i)
-                self.decompileds.pop(i)
-            else:
-                i += 1
+        code_type_ids = [i for i, code_type in enumerate(self._code_type_table) if code_type in code_types]
+        indices = self._indices()
+        self._order = indices[np.isin(np.frombuffer(self._code_type_ids, dtype=np.uint8)[indices], code_type_ids)]
 
     # noinspection PyShadowingNames
     def limit_count(self, count: int, skip: int = 0):
-        start = skip
-        end = min(len(self), start + count)
-        self.source_decompiled_code_types = self.source_decompiled_code_types[start:end]
-        self.idents = self.idents[start:end]
-        self.sources = self.sources[start:end]
-        self.decompileds = self.decompileds[start:end]
+        self._order = self._indices()[skip:skip + count]
 
     def shuffle(self, seed: int):
-        # Need to create separate Random instance since Random has state
-        Random(seed).shuffle(self.sources)
-        Random(seed).shuffle(self.decompileds)
-        Random(seed).shuffle(self.idents)
-        Random(seed).shuffle(self.source_decompiled_code_types)
+        indices = self._indices()
+        self._order = indices[np.random.default_rng(seed).permutation(len(indices))]
 
     def __len__(self):
-        return len(self.sources)
+        return len(self._order) if self._order is not None else self._num_stored()
 
     def __init__(self, max_len: int = 0):
         self.max_len = max_len
-        self.source_decompiled_code_types: list[CodeType] = []
-        self.idents: list[str] = []
-        self.sources: list[ModelStr] = []
-        self.decompileds: list[ModelStr] = []
+        # Examples in the order they were added. These are only appended to: other operations just change _order
+        self._code_type_table: list[CodeType] = []
+        self._code_type_idxs: dict[CodeType, int] = {}
+        self._code_type_ids = array("B")
+        self._idents: list[str] = []
+        self._sources: list[ModelStr] = []
+        self._decompileds: list[ModelStr] = []
+        # max(len(source), len(decompiled)) of each example, which postprocess sorts by
+        self._lengths = array("q")
+        # Indices of this data's examples in the above, in order. None = all of them in the order they were added
+        self._order: Optional[np.ndarray] = None
+        # If loaded from an example store, the store (the stored examples are in the same order as in it, so their
+        # indices are the indices in the store, which are used to cache tokens).
+        # It's kept open and the stored examples are its lazily decoded columns, until more are appended
+        self.store_path: Optional[Path] = None
+        self._store: Optional[ExampleStore] = None
+        # stats of the last add_repo, and its deduplicator (which incremental add_repo calls reuse)
+        self._include_cache_stats = IncludeCacheStats()
+        self._deduplicator: Optional[Deduplicator] = None
+
+    def __setstate__(self, state: dict):
+        if "_order" in state:
+            self.__dict__.update(state)
+            return
+        # Legacy pickle, which stored the examples in parallel lists
+        self.__init__(state.get("max_len", 0))
+        for example in zip(
+                state["source_decompiled_code_types"],
+                state["idents"],
+                state["sources"],
+                state["decompileds"]):
+            self._append(*example)
+
+    @property
+    def source_decompiled_code_types(self) -> list[CodeType]:
+        code_type_ids = np.frombuffer(self._code_type_ids, dtype=np.uint8)[self._indices()]
+        return [self._code_type_table[code_type_id] for code_type_id in code_type_ids]
+
+    @property
+    def idents(self) -> list[str]:
+        return [self._idents[i] for i in self._indices()]
+
+    @property
+    def sources(self) -> list[ModelStr]:
+        return [self._sources[i] for i in self._indices()]
+
+    @property
+    def decompileds(self) -> list[ModelStr]:
+        return [self._decompileds[i] for i in self._indices()]
+
+    @property
+    def store_indices(self) -> np.ndarray:
+        """index of each example in the example store it was loaded from. Meaningless if store_path is None"""
+        return self._indices()
+
+    def _examples(self) -> Iterator[tuple[CodeType, str, ModelStr, ModelStr]]:
+        for i in self._indices():
+            yield self._code_type_table[self._code_type_ids[i]], self._idents[i], self._sources[i], self._decompileds[i]
 
     def postprocess(self):
-        if len(self) > 0:
-            items = list(zip(self.sources, self.decompileds, self.idents, self.source_decompiled_code_types))
-            items.sort(key=lambda x: max(len(x[0]), len(x[1])))
-            self.sources, self.decompileds, self.idents, self.source_decompiled_code_types = \
-                [list(s) for s in zip(*items)]
+        indices = self._indices()
+        self._order = indices[np.argsort(np.frombuffer(self._lengths, dtype=np.int64)[indices], kind="stable")]
 
     PICKLE_PROTOCOL = 5
 
     def save(self, path_or_file: Path | BinaryIO):
+        """saves as an example store (see example_store.py)"""
         self.postprocess()
         if isinstance(path_or_file, Path):
             with path_or_file.open("wb") as file:
                 self.save(file)
         else:
-            pickle.dump(self, path_or_file, protocol=self.PICKLE_PROTOCOL)
+            indices = self._indices()
+            write_example_store(
+                path_or_file,
+                self.source_decompiled_code_types,
+                (self._idents[i] for i in indices),
+                (self._sources[i] for i in indices),
+                (self._decompileds[i] for i in indices)
+            )
 
     @staticmethod
     def load(path: Path) -> "ModelData":
+        """
+        loads an example store, or a legacy pickled ModelData.
+        The store is memory-mapped, so examples are only read and decoded when accessed
+        """
+        if not is_example_store(path):
+            return ModelData.load_pickle(path)
+        data = ModelData()
+        store = ExampleStore(path)
+        data._code_type_table = list(store.code_type_table)
+        data._code_type_idxs = {code_type: i for i, code_type in enumerate(data._code_type_table)}
+        data._code_type_ids = array("B", store.code_type_ids)
+        data._idents = store.idents
+        data._sources = store.sources
+        data._decompileds = store.decompileds
+        # UTF-8 lengths, which are close enough to sort by and don't need decoding
+        data._lengths = array("q", np.maximum(
+            np.diff(np.frombuffer(store.sources.offsets, dtype=np.uint64)),
+            np.diff(np.frombuffer(store.decompileds.offsets, dtype=np.uint64))
+        ).astype(np.int64).tobytes())
+        data._store = store
+        data.store_path = path
+        return data
+
+    @staticmethod
+    def load_pickle(path: Path) -> "ModelData":
+        """loads a legacy pickled ModelData (examples files used to be these)"""
         with path.open("rb") as file:
-            return pickle.load(file)
+            data: ModelData = pickle.load(file)
+        # Legacy pickles don't have these
+        data.store_path = None
+        data._store = None
+        return data
 
     def print(
             self,
             sep: Optional[str] = ' ',
             end: Optional[str] = '\n',
             file: Optional[TextIOWrapper] = None):
-        def _print(*values, flush: bool = False):
-            print(*values, sep=sep, end=end, file=file, flush=flush)
-
-        _print(f"ModelData")
-        for i, (code_type, ident, source, decompiled) in \
-                enumerate(zip(self.source_decompiled_code_types, self.idents, self.sources, self.decompileds)):
-            _print(f"  {i}: {ident} ({code_type})")
-            _print(f"    source:")
-            _print("      " + source.replace("\n", "\n      "), flush=True)
-            _print(f"    decompiled:")
-            _print("      " + decompiled.replace("\n", "\n      "), flush=True)
+        print_examples(self._examples(), sep=sep, end=end, file=file)
 
 
 # (idk why but IntelliJ can't find torch.utils.data)
 # noinspection PyUnresolvedReferences
 class ModelDataset(torch.utils.data.Dataset):
+    """
+    Tokenized examples. Tokens are cached on disk if the data was loaded from an example store (see token_cache.py),
+    and examples aren't padded (use a collator which pads each batch, e.g. DataCollatorForSeq2Seq)
+    """
     def __init__(self, data: ModelData, tokenizer: Tokenizer):
         if len(data) == 0:
             raise ValueError("Cannot create dataset from no data")
-        self.encodings = tokenize(tokenizer, data.decompileds)
-        self.labels = tokenize(tokenizer, data.sources)
+        if data.store_path is not None:
+            # Only the tokens are read, not the examples' text
+            self.tokens = load_or_tokenize_store(tokenizer, data.store_path).select(data.store_indices)
+        else:
+            self.tokens = tokenize_examples(tokenizer, data.decompileds, data.sources)
 
     def __len__(self):
-        return len(self.labels.input_ids)
+        return len(self.tokens)
+
+    def lengths(self) -> np.ndarray:
+        """number of tokens in each example (the longer of its input and labels)"""
+        return np.maximum(self.tokens.inputs.lengths(), self.tokens.labels.lengths())
 
     def __getitem__(self, idx):
-        item = {key: torch.tensor(val[idx]) for key, val in self.encodings.items()}
-        item["labels"] = torch.tensor(self.labels.input_ids[idx])
-        return item
+        input_ids = self.tokens.input_ids(idx)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": np.ones_like(input_ids),
+            "labels": self.tokens.label_ids(idx)
+        }
+
+
+# noinspection PyUnresolvedReferences
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of similar-length examples, so little of each batch is padding.
+    Batches are sized so that (number of examples * longest example) <= max_tokens,
+    except that an example longer than max_tokens is its own batch.
+    If shuffle, the order of the batches (not the examples within) is shuffled by epoch: call set_epoch before each
+    epoch, so a resumed run gets the same order as the interrupted one
+    """
+    def __init__(self, lengths: np.ndarray, max_tokens: int, seed: int, shuffle: bool):
+        # Examples are usually already ordered by length (ModelData.postprocess), so this stable sort is ~linear
+        order = np.argsort(lengths, kind="stable")
+        self.batches: list[np.ndarray] = []
+        batch_start = 0
+        for i, length in enumerate(lengths[order]):
+            # lengths are ascending, so the current example is the longest in the batch
+            if i > batch_start and (i - batch_start + 1) * length > max_tokens:
+                self.batches.append(order[batch_start:i])
+                batch_start = i
+        if batch_start < len(order):
+            self.batches.append(order[batch_start:])
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[list[int]]:
+        if self.shuffle:
+            batch_order = np.random.default_rng(self.seed + self.epoch).permutation(len(self.batches))
+        else:
+            batch_order = range(len(self.batches))
+        for i in batch_order:
+            yield self.batches[i].tolist()
+
+    def __len__(self):
+        return len(self.batches)
@@ -0,0 +1,153 @@
+import hashlib
+import re
+import zlib
+from os import environ
+from typing import Optional
+
+import numpy as np
+
+from code_type import ModelStr
+
+# Examples are only compared with this many to this many * 2 of the most recent examples,
+# so memory is bounded (~2KB per remembered example) regardless of the number of examples
+DEDUP_GENERATION_SIZE = int(environ.get("DEDUP_GENERATION_SIZE", 500_000))
+NUM_PERMUTATIONS = 128
+SHINGLE_SIZE = 5
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# Identifiers, numbers, or single punctuation characters
+_TOKEN_REGEX = re.compile(r"[A-Za-z_]\w*|\d\w*|\S")
+# Decompiler-generated names which differ between otherwise-identical functions (e.g. FUN_00101234, local_10)
+_GENERATED_NAME_REGEX = re.compile(r"^(FUN|DAT|LAB|PTR|local|param|uVar|iVar|lVar|bVar|cVar|sVar|pvVar|auVar|in_stack)"
+                                   r"_?[0-9a-fA-F]*$")
+
+# (hash of the normalized tokens, MinHash signature or None if only deduplicating exact matches)
+Fingerprint = tuple[bytes, Optional[np.ndarray]]
+
+
+def normalize_tokens(code: ModelStr) -> list[str]:
+    """tokens of the code, ignoring whitespace, literal values, and decompiler-generated names"""
+    tokens = []
+    for token in _TOKEN_REGEX.findall(code):
+        if token[0].isdigit():
+            tokens.append("0")
+        elif _GENERATED_NAME_REGEX.match(token):
+            tokens.append(token.split("_")[0].rstrip("0123456789"))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+class MinHasher:
+    """
+    Computes fingerprints of examples. Picklable so that fingerprints can be computed in worker processes;
+    fingerprints computed by MinHashers with the same parameters are comparable
+    """
+    def __init__(self, near: bool, num_permutations: int = NUM_PERMUTATIONS, shingle_size: int = SHINGLE_SIZE):
+        self.near = near
+        self.shingle_size = shingle_size
+        # Fixed seed, so fingerprints are deterministic. a and b are < 2^31 and hashes are < 2^32,
+        # so a * hash + b doesn't overflow uint64
+        rng = np.random.default_rng(0)
+        self.a = rng.integers(1, 1 << 31, size=num_permutations, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, size=num_permutations, dtype=np.uint64)
+
+    def fingerprint(self, source: ModelStr, decompiled: ModelStr) -> Fingerprint:
+        # The separator token can't be produced by normalize_tokens, so it separates the source and decompiled
+        tokens = normalize_tokens(source) + ["\0"] + normalize_tokens(decompiled)
+        exact_hash = hashlib.blake2b("\1".join(tokens).encode("utf-8"), digest_size=16).digest()
+        if not self.near:
+            return exact_hash, None
+        num_shingles = max(1, len(tokens) - self.shingle_size + 1)
+        # crc32 is a fast, deterministic 32-bit hash (unlike hash(), which is salted per process)
+        shingle_hashes = np.fromiter(
+            (zlib.crc32("\1".join(tokens[i:i + self.shingle_size]).encode("utf-8")) for i in range(num_shingles)),
+            dtype=np.uint64,
+            count=num_shingles
+        )
+        permuted = (np.outer(shingle_hashes, self.a) + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return exact_hash, permuted.min(axis=0).astype(np.uint32)
+
+
+def _lsh_bands(num_permutations: int, threshold: float) -> int:
+    """
+    number of LSH bands (of num_permutations / bands rows each) such that examples with Jaccard similarity about
+    threshold have a ~50% chance to share a band. More similar examples are very likely to, less similar unlikely
+    """
+    divisors = [bands for bands in range(1, num_permutations + 1) if num_permutations % bands == 0]
+    return min(divisors, key=lambda bands: abs((1 / bands) ** (bands / num_permutations) - threshold))
+
+
+class _Generation:
+    def __init__(self, num_bands: int):
+        self.exact_hashes: set[bytes] = set()
+        # Per band, the indices (in signatures) of the examples with each band key
+        self.bands: list[dict[bytes, list[int]]] = [{} for _ in range(num_bands)]
+        self.signatures: list[np.ndarray] = []
+
+
+class Deduplicator:
+    """
+    Streaming deduplication: each example is a duplicate if its normalized tokens are the same as a previous example,
+    or (if threshold < 1) its MinHash signature's estimated Jaccard similarity with one is >= threshold.
+    Candidate near-duplicates are found with LSH. Only the recent examples are remembered, in 2 generations of
+    DEDUP_GENERATION_SIZE each: when the current one is full, the previous one is forgotten
+    """
+    def __init__(self, threshold: float, generation_size: int = DEDUP_GENERATION_SIZE):
+        if not 0 < threshold <= 1:
+            raise ValueError(f"Dedup threshold must be in (0, 1], got {threshold}")
+        self.threshold = threshold
+        self.hasher = MinHasher(threshold < 1)
+        self.num_bands = _lsh_bands(len(self.hasher.a), threshold)
+        self.rows_per_band = len(self.hasher.a) // self.num_bands
+        self.generation_size = generation_size
+        self.generations = [_Generation(self.num_bands)]
+        self.num_exact_duplicates = 0
+        self.num_near_duplicates = 0
+
+    def add(self, fingerprint: Fingerprint) -> Optional[str]:
+        """
+        if the example is a duplicate of a previous one, returns "exact" or "near". Otherwise remembers it and
+        returns None
+        """
+        exact_hash, signature = fingerprint
+        if any(exact_hash in generation.exact_hashes for generation in self.generations):
+            self.num_exact_duplicates += 1
+            return "exact"
+        band_keys = [] if signature is None else [
+            signature[band * self.rows_per_band:(band + 1) * self.rows_per_band].tobytes()
+            for band in range(self.num_bands)
+        ]
+        if self._has_near_duplicate(signature, band_keys):
+            self.num_near_duplicates += 1
+            return "near"
+
+        current = self.generations[-1]
+        if len(current.exact_hashes) >= self.generation_size:
+            current = _Generation(self.num_bands)
+            self.generations = [self.generations[-1], current]
+        current.exact_hashes.add(exact_hash)
+        if signature is not None:
+            for band_key, band in zip(band_keys, current.bands):
+                band.setdefault(band_key, []).append(len(current.signatures))
+            current.signatures.append(signature)
+        return None
+
+    def _has_near_duplicate(self, signature: Optional[np.ndarray], band_keys: list[bytes]) -> bool:
+        if signature is None:
+            return False
+        for generation in self.generations:
+            checked = set()
+            for band_key, band in zip(band_keys, generation.bands):
+                for candidate in band.get(band_key, ()):
+                    if candidate in checked:
+                        continue
+                    checked.add(candidate)
+                    num_equal = np.count_nonzero(generation.signatures[candidate] == signature)
+                    if num_equal >= self.threshold * len(signature):
+                        return True
+        return False
+
+    def __str__(self):
+        return f"dedup (threshold {self.threshold}): removed {self.num_exact_duplicates} exact and " \
+               f"{self.num_near_duplicates} near duplicates"
@@ -0,0 +1,231 @@
+import fnmatch
+import mmap
+import pickle
+import re
+import struct
+from array import array
+from io import TextIOWrapper
+from itertools import takewhile
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+from code_type import CodeType, ModelStr
+
+# Layout (integers are little-endian / native uint64, sections are 8-byte aligned):
+#   header: MAGIC, number of examples, then the offset of each section in _SECTIONS
+#   code-types: pickled list of the distinct code types
+#   code-type-ids: 1 byte per example, index into code-types
+#   <column>-buf: concatenated UTF-8 strings of the column
+#   <column>-offsets: number of examples + 1 offsets into <column>-buf (string i = buf[offsets[i]:offsets[i + 1]])
+#   ident-order: indices of the examples sorted by ident (UTF-8 bytes), to look up examples by ident.
+#     Not in version 1 stores (MAGIC_V1), which are still readable but look up idents by scanning
+MAGIC = b"UBEXMPL2"
+MAGIC_V1 = b"UBEXMPL1"
+_COLUMNS = ["idents", "sources", "decompileds"]
+_SECTIONS_V1 = \
+    ["code-types", "code-type-ids"] + [f"{column}-{part}" for column in _COLUMNS for part in ["buf", "offsets"]]
+_SECTIONS = _SECTIONS_V1 + ["ident-order"]
+_HEADERS = {
+    MAGIC: struct.Struct(f"<8sQ{len(_SECTIONS)}Q"),
+    MAGIC_V1: struct.Struct(f"<8sQ{len(_SECTIONS_V1)}Q")
+}
+_HEADER = _HEADERS[MAGIC]
+PICKLE_PROTOCOL = 5
+# Characters which make an ident pattern a glob (see fnmatch)
+_GLOB_CHARS = "*?["
+
+
+def is_example_store(path: Path) -> bool:
+    """whether the file is an example store (as opposed to e.g. a legacy pickled ModelData)"""
+    with path.open("rb") as file:
+        return file.read(len(MAGIC)) in _HEADERS
+
+
+def write_example_store(
+        file: BinaryIO,
+        code_types: list[CodeType],
+        idents: Iterable[str],
+        sources: Iterable[ModelStr],
+        decompileds: Iterable[ModelStr]):
+    """writes examples (given as columns) to file, which must be seekable"""
+    start = file.tell()
+    section_offsets = {}
+
+    def begin_section(section: str):
+        padding = -(file.tell() - start) % 8
+        file.write(b"\0" * padding)
+        section_offsets[section] = file.tell() - start
+
+    # Header is written last, once we know the section offsets
+    file.write(b"\0" * _HEADER.size)
+
+    code_type_table = list(dict.fromkeys(code_types))
+    if len(code_type_table) > 256:
+        raise ValueError("Too many code types")
+    code_type_ids = {code_type: i for i, code_type in enumerate(code_type_table)}
+    begin_section("code-types")
+    pickle.dump(code_type_table, file, protocol=PICKLE_PROTOCOL)
+    begin_section("code-type-ids")
+    file.write(bytes(code_type_ids[code_type] for code_type in code_types))
+
+    ident_bytes = []
+    for column, strings in zip(_COLUMNS, [idents, sources, decompileds]):
+        offsets = array("Q", [0])
+        begin_section(f"{column}-buf")
+        for string in strings:
+            string_bytes = string.encode("utf-8")
+            if column == "idents":
+                ident_bytes.append(string_bytes)
+            offsets.append(offsets[-1] + file.write(string_bytes))
+        if len(offsets) != len(code_types) + 1:
+            raise ValueError(f"Column {column} has {len(offsets) - 1} examples, expected {len(code_types)}")
+        begin_section(f"{column}-offsets")
+        offsets.tofile(file)
+
+    # Sorted stably, so examples with the same ident are in store order
+    begin_section("ident-order")
+    array("Q", sorted(range(len(ident_bytes)), key=ident_bytes.__getitem__)).tofile(file)
+
+    end = file.tell()
+    file.seek(start)
+    file.write(_HEADER.pack(MAGIC, len(code_types), *(section_offsets[section] for section in _SECTIONS)))
+    file.seek(end)
+
+
+class _StrColumn:
+    """lazily decoded strings backed by a buffer and offset array"""
+    def __init__(self, buf: memoryview, offsets: memoryview):
+        self.buf = buf
+        self.offsets = offsets
+
+    def raw(self, i: int) -> memoryview:
+        """the UTF-8 bytes of string i, without copying"""
+        return self.buf[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, i: int) -> str:
+        return str(self.raw(i), "utf-8")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[i] for i in range(len(self)))
+
+    def release(self):
+        self.offsets.release()
+        self.buf.release()
+
+
+class ExampleStore:
+    """
+    Memory-mapped examples file written by write_example_store.
+    Examples are only read (and decoded) when accessed, so opening is O(1) regardless of the file size
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = path.open("rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        magic = self._mmap[:len(MAGIC)]
+        if magic not in _HEADERS:
+            self.close()
+            raise ValueError(f"{str(path)} is not an examples file (maybe it's a legacy .pickle, which can be "
+                             f"converted with convert-examples)")
+        _, self._len, *offsets = _HEADERS[magic].unpack_from(self._mmap)
+        sections = dict(zip(_SECTIONS if magic == MAGIC else _SECTIONS_V1, offsets))
+        self.code_type_table: list[CodeType] = pickle.loads(
+            self._view[sections["code-types"]:sections["code-type-ids"]]
+        )
+        self.code_type_ids = self._view[sections["code-type-ids"]:sections["code-type-ids"] + self._len]
+        self.columns: dict[str, _StrColumn] = {}
+        for column in _COLUMNS:
+            buf_offset = sections[f"{column}-buf"]
+            offsets_offset = sections[f"{column}-offsets"]
+            offsets = self._view[offsets_offset:offsets_offset + (self._len + 1) * 8].cast("Q")
+            self.columns[column] = _StrColumn(self._view[buf_offset:buf_offset + offsets[-1]], offsets)
+        self.ident_order = self._view[sections["ident-order"]:sections["ident-order"] + self._len * 8].cast("Q") \
+            if "ident-order" in sections else None
+
+    @property
+    def idents(self) -> _StrColumn:
+        return self.columns["idents"]
+
+    @property
+    def sources(self) -> _StrColumn:
+        return self.columns["sources"]
+
+    @property
+    def decompileds(self) -> _StrColumn:
+        return self.columns["decompileds"]
+
+    def code_type(self, i: int) -> CodeType:
+        return self.code_type_table[self.code_type_ids[i]]
+
+    def find_idents(self, pattern: str) -> Iterator[int]:
+        """
+        indices of examples whose ident is pattern, or matches it if it's a glob (see fnmatch), in ident order.
+        Uses binary search on the ident index, so only the part of the glob before the first wildcard is scanned
+        """
+        glob_start = min((pattern.find(c) for c in _GLOB_CHARS if c in pattern), default=-1)
+        prefix = (pattern if glob_start == -1 else pattern[:glob_start]).encode("utf-8")
+        if self.ident_order is None:
+            # Version 1 store, so scan all idents
+            candidates = (i for i in range(len(self)) if self.idents.raw(i)[:len(prefix)] == prefix)
+        else:
+            candidates = (self.ident_order[j] for j in range(self._ident_lower_bound(prefix), len(self)))
+            candidates = takewhile(lambda i: self.idents.raw(i)[:len(prefix)] == prefix, candidates)
+        if glob_start == -1:
+            return (i for i in candidates if len(self.idents.raw(i)) == len(prefix))
+        matcher = re.compile(fnmatch.translate(pattern)).match
+        return (i for i in candidates if matcher(self.idents[i]))
+
+    def _ident_lower_bound(self, ident: bytes) -> int:
+        """first position in ident_order whose ident is >= ident"""
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            # memoryviews can only be compared for equality
+            if bytes(self.idents.raw(self.ident_order[mid])) < ident:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def __len__(self):
+        return self._len
+
+    def close(self):
+        # memoryviews must be released before the mmap can be closed
+        for column in getattr(self, "columns", {}).values():
+            column.release()
+        if hasattr(self, "code_type_ids"):
+            self.code_type_ids.release()
+        if getattr(self, "ident_order", None) is not None:
+            self.ident_order.release()
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "ExampleStore":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def print_examples(
+        examples: Iterable[tuple[CodeType, str, ModelStr, ModelStr]],
+        sep: Optional[str] = ' ',
+        end: Optional[str] = '\n',
+        file: Optional[TextIOWrapper] = None):
+    """prints (code type, ident, source, decompiled) examples as they are iterated"""
+    def _print(*values, flush: bool = False):
+        print(*values, sep=sep, end=end, file=file, flush=flush)
+
+    _print(f"ModelData")
+    for i, (code_type, ident, source, decompiled) in enumerate(examples):
+        _print(f"  {i}: {ident} ({code_type})")
+        _print(f"    source:")
+        _print("      " + source.replace("\n", "\n      "), flush=True)
+        _print(f"    decompiled:")
+        _print("      " + decompiled.replace("\n", "\n      "), flush=True)
@@ -1,19 +1,165 @@
+import json
+import os
+from os import environ
 from pathlib import Path
+from time import sleep, time
+from typing import Optional
 
+from code_type import CodeType
 from code_types import CODE_TYPES
 from dataset import ModelData
 from log import log
-from utils import mk_empty_binary_file
+from utils import mk_empty_binary_file, write_atomic
 
+# Seconds between checks for newly decompiled artifacts in follow mode
+FOLLOW_INTERVAL = float(environ.get("FOLLOW_INTERVAL", 30))
+# Minimum seconds between saves in follow mode. Each save rewrites the whole store, so saving after every batch would
+# take time quadratic in the number of examples. The examples are also saved when done, interrupted, or on error
+FOLLOW_SAVE_INTERVAL = float(environ.get("FOLLOW_SAVE_INTERVAL", 600))
+# Created in an artifact by get-data/decompile/run.sh after it's decompiled
+DECOMPILED_MARKER = "ghidra.success"
+# Created in the dataset dir by get-data/run.sh after every artifact is decompiled
+DECOMPILE_DONE_MARKER = "ghidra.done"
+# Artifacts are at most this deep in the dataset dir (e.g. vcpkg/buildtrees/<package>)
+MAX_ARTIFACT_DEPTH = 3
 
-def generate(dataset_dir: Path, examples_path: Path, langs: str, count: int, force: bool):
+
+def generate(
+        dataset_dir: Path,
+        examples_path: Path,
+        langs: str,
+        count: int,
+        force: bool,
+        num_workers: int = 1,
+        rescan: bool = False,
+        dedup_threshold: Optional[float] = None,
+        follow: bool = False):
     code_types = [CODE_TYPES[lang] for lang in langs.split(",")]
+    if follow:
+        _generate_follow(dataset_dir, examples_path, code_types, count, force, num_workers, dedup_threshold)
+        return
     with mk_empty_binary_file(examples_path, force) as examples_file:
         train_data = ModelData(count)
         try:
-            train_data.add_repo(code_types, dataset_dir)
+            train_data.add_repo(code_types, dataset_dir, num_workers, rescan, dedup_threshold)
         except KeyboardInterrupt:
             # explicitly don't print traceback on this exception
             log.info("** Interrupted")
         finally:
             train_data.save(examples_file)
+
+
+def _generate_follow(
+        dataset_dir: Path,
+        examples_path: Path,
+        code_types: list[CodeType],
+        count: int,
+        force: bool,
+        num_workers: int,
+        dedup_threshold: Optional[float]):
+    """
+    Adds artifacts as they're decompiled (when they get DECOMPILED_MARKER), saving the examples at most every
+    FOLLOW_SAVE_INTERVAL seconds, until count examples are added or the dataset dir gets DECOMPILE_DONE_MARKER and every
+    artifact is added.
+    The examples are always a complete store, and the artifacts in it are listed in a sidecar file, so this can be
+    interrupted and rerun (without force) to resume. Deduplication only compares examples added in the same run.
+    Resuming reads (decodes) every saved example into memory before adding more, since each save rewrites the store
+    """
+    artifacts_path = _artifacts_path(examples_path)
+    if examples_path.exists() and not force:
+        if not artifacts_path.exists():
+            raise ValueError(f"Path {examples_path} already exists and wasn't generated by --follow "
+                             f"(no {artifacts_path.name}), so it can't be resumed")
+        train_data = ModelData.load(examples_path)
+        added_artifacts = json.loads(artifacts_path.read_text(encoding="utf8"))
+        log.info(f"** resuming {str(examples_path)}: {len(train_data)} examples from {len(added_artifacts)} artifacts")
+    else:
+        examples_path.unlink(missing_ok=True)
+        artifacts_path.unlink(missing_ok=True)
+        train_data = ModelData()
+        added_artifacts = []
+    train_data.max_len = count
+    added_artifact_set = set(added_artifacts)
+    # Examples from the batches which were completely added (a batch is partially added if adding it is interrupted)
+    num_complete_examples = len(train_data)
+    num_saved_artifacts = len(added_artifacts)
+    last_save_time = time()
+
+    log.info(f"** following {str(dataset_dir)} (checking every {FOLLOW_INTERVAL} seconds)")
+    try:
+        while True:
+            if 0 < count <= len(train_data):
+                log.info("** max_len reached, done following")
+                break
+            # Check before finding artifacts, so we don't miss any decompiled right before done
+            done = (dataset_dir / DECOMPILE_DONE_MARKER).exists()
+            new_artifacts = [artifact for artifact in _find_decompiled_artifacts(dataset_dir)
+                             if artifact not in added_artifact_set]
+            if len(new_artifacts) > 0:
+                log.info(f"** adding {len(new_artifacts)} newly decompiled artifacts")
+                train_data.add_repo(
+                    code_types,
+                    dataset_dir,
+                    num_workers,
+                    dedup_threshold=dedup_threshold,
+                    artifact_names=new_artifacts
+                )
+                added_artifacts += new_artifacts
+                added_artifact_set.update(new_artifacts)
+                num_complete_examples = len(train_data)
+                if time() - last_save_time >= FOLLOW_SAVE_INTERVAL:
+                    _save_follow(train_data, examples_path, added_artifacts)
+                    num_saved_artifacts = len(added_artifacts)
+                    last_save_time = time()
+            elif done:
+                log.info("** every artifact is decompiled and added, done following")
+                break
+            else:
+                sleep(FOLLOW_INTERVAL)
+    except KeyboardInterrupt:
+        # explicitly don't print traceback on this exception
+        log.info("** Interrupted")
+    finally:
+        # Saves the batches added since the last save. A partially added batch isn't saved, and will be added again on
+        # resume. If nothing was decompiled, the output should still be a (empty) store
+        if len(train_data) > num_complete_examples:
+            train_data.limit_count(num_complete_examples)
+        if len(added_artifacts) > num_saved_artifacts or not examples_path.exists():
+            _save_follow(train_data, examples_path, added_artifacts)
+
+
+def _save_follow(train_data: ModelData, examples_path: Path, added_artifacts: list[str]):
+    # Write then rename, so an interruption doesn't leave a truncated store. The store is replaced before the
+    # artifact list, so if we crash in between we'll re-add (duplicate) the batch instead of losing it
+    tmp_path = examples_path.with_name(f".{examples_path.name}.tmp")
+    train_data.save(tmp_path)
+    os.replace(tmp_path, examples_path)
+    write_atomic(_artifacts_path(examples_path), json.dumps(added_artifacts))
+
+
+def _artifacts_path(examples_path: Path) -> Path:
+    """sidecar file which lists the artifacts in examples generated with --follow"""
+    return examples_path.with_name(f"{examples_path.name}.artifacts.json")
+
+
+def _find_decompiled_artifacts(dataset_dir: Path) -> list[str]:
+    """paths (relative to dataset_dir) of the directories with DECOMPILED_MARKER, in sorted order"""
+    artifacts = []
+    _find_decompiled_artifacts_in(str(dataset_dir), "", 1, artifacts)
+    return artifacts
+
+
+def _find_decompiled_artifacts_in(dir_path: str, relative_dir: str, depth: int, artifacts: list[str]):
+    try:
+        with os.scandir(dir_path) as entries:
+            subdirs = sorted((entry for entry in entries if entry.is_dir() and not entry.is_symlink()),
+                             key=lambda entry: entry.name)
+    except OSError:
+        # e.g. a package's build dir was removed while we were scanning
+        return
+    for subdir in subdirs:
+        relative_path = relative_dir + subdir.name
+        if os.path.exists(os.path.join(subdir.path, DECOMPILED_MARKER)):
+            artifacts.append(relative_path)
+        elif depth < MAX_ARTIFACT_DEPTH:
+            _find_decompiled_artifacts_in(subdir.path, relative_path + "/", depth + 1, artifacts)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import sqlite3
+from os import environ
+from pathlib import Path
+from time import time_ns
+from typing import Optional
+
+from utils import PROJECT_PATH
+
+DEFAULT_INFERENCE_CACHE_PATH = PROJECT_PATH / "local/inference-cache.sqlite"
+INFERENCE_CACHE_SIZE = int(environ.get("INFERENCE_CACHE_SIZE", str(1024 * 1024 * 1024)))
+
+
+def normalize_code(code: str) -> str:
+    """code with whitespace differences which don't matter (line endings, trailing whitespace) removed"""
+    return "\n".join(line.rstrip() for line in code.replace("\r\n", "\n").strip().split("\n"))
+
+
+class InferenceCache:
+    """
+    On-disk cache of model outputs, keyed by the model fingerprint, generation parameters, and normalized input.
+    When it's larger than max_size bytes, the least recently used outputs are evicted
+    """
+    def __init__(self, path: Path, model_fingerprint: str, generation_params: dict, max_size: int):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS outputs (
+                key BLOB PRIMARY KEY,
+                output TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used INTEGER NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)")
+        self.connection.commit()
+        self.key_prefix = hashlib.sha256(
+            json.dumps({"model": model_fingerprint, "generation": generation_params}, sort_keys=True)
+            .encode("utf-8")
+        ).digest()
+        self.max_size = max_size
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM outputs").fetchone()[0]
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    def key(self, code: str) -> bytes:
+        return hashlib.sha256(self.key_prefix + normalize_code(code).encode("utf-8")).digest()
+
+    def get(self, code: str) -> Optional[str]:
+        key = self.key(code)
+        row = self.connection.execute("SELECT output FROM outputs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        self.connection.execute("UPDATE outputs SET last_used = ? WHERE key = ?", (time_ns(), key))
+        return row[0]
+
+    def put(self, code: str, output: str):
+        key = self.key(code)
+        size = len(key) + len(output.encode("utf-8"))
+        old_row = self.connection.execute("SELECT size FROM outputs WHERE key = ?", (key,)).fetchone()
+        if old_row is not None:
+            self.size -= old_row[0]
+        self.connection.execute(
+            "INSERT OR REPLACE INTO outputs (key, output, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, output, size, time_ns())
+        )
+        self.size += size
+
+    def commit(self):
+        """evicts if over max_size, then saves changes"""
+        if self.size > self.max_size:
+            evicted_keys = []
+            for key, size in self.connection.execute("SELECT key, size FROM outputs ORDER BY last_used"):
+                if self.size <= self.max_size:
+                    break
+                evicted_keys.append((key,))
+                self.size -= size
+            self.connection.executemany("DELETE FROM outputs WHERE key = ?", evicted_keys)
+            self.num_evictions += len(evicted_keys)
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def __str__(self):
+        num_lookups = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / num_lookups * 100 if num_lookups > 0 else 0
+        return f"{self.num_hits}/{num_lookups} inference cache hits ({'%.2f' % hit_rate}%), " \
+               f"{self.num_evictions} evictions, {self.size} bytes cached"
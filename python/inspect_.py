@@ -1,15 +1,83 @@
 """Cannot be named inspect because it causes an import error, what? :("""
+import fnmatch
+import re
+from itertools import islice
 from pathlib import Path
+from random import Random
+from typing import Iterable, Optional
 
+import numpy as np
+
+from code_type import CodeType
 from code_types import CODE_TYPES
-from dataset import ModelData
+from example_store import ExampleStore, is_example_store, print_examples
 
 
-def inspect(examples_path: Path, langs: str, count: int, skip: int, shuffle_seed: int):
+def inspect(
+        examples_path: Path,
+        langs: str,
+        count: int,
+        skip: int,
+        shuffle_seed: int,
+        ident_pattern: Optional[str] = None):
+    """
+    Prints examples of the given languages (and whose ident is ident_pattern or matches it if it's a glob).
+    Only the printed examples are read, and they are printed as they are read
+    """
     code_types = [CODE_TYPES[lang] for lang in langs.split(",")]
-    data = ModelData.load(examples_path)
+    if not is_example_store(examples_path):
+        _inspect_legacy(examples_path, code_types, count, skip, shuffle_seed, ident_pattern)
+        return
+    with ExampleStore(examples_path) as store:
+        code_type_ids = [i for i, code_type in enumerate(store.code_type_table) if code_type in code_types]
+        filter_code_types = len(code_type_ids) < len(store.code_type_table)
+        if ident_pattern is not None:
+            indices = store.find_idents(ident_pattern)
+            if filter_code_types:
+                indices = (i for i in indices if store.code_type_ids[i] in code_type_ids)
+        elif filter_code_types:
+            if shuffle_seed != 0:
+                # We need all matching indices to sample, so find them vectorized (1 byte per example)
+                indices = np.flatnonzero(np.isin(np.frombuffer(store.code_type_ids, dtype=np.uint8), code_type_ids))
+            else:
+                indices = (i for i, code_type_id in enumerate(store.code_type_ids) if code_type_id in code_type_ids)
+        else:
+            indices = range(len(store))
+        if shuffle_seed != 0:
+            indices = _sample(indices, count, skip, shuffle_seed)
+        else:
+            indices = islice(indices, skip, skip + count)
+        print_examples(
+            (store.code_type(i), store.idents[i], store.sources[i], store.decompileds[i]) for i in indices
+        )
+
+
+def _sample(indices: Iterable[int], count: int, skip: int, seed: int) -> list[int]:
+    """
+    the indices in [skip:skip + count] of a random permutation, without generating the rest of the permutation.
+    Samples are taken from the range of positions, which (like a range of indices) doesn't need to be materialized
+    """
+    if not isinstance(indices, (range, np.ndarray)):
+        indices = list(indices)
+    positions = Random(seed).sample(range(len(indices)), min(len(indices), skip + count))
+    return [int(indices[position]) for position in positions[skip:]]
+
+
+def _inspect_legacy(
+        examples_path: Path,
+        code_types: list[CodeType],
+        count: int,
+        skip: int,
+        shuffle_seed: int,
+        ident_pattern: Optional[str]):
+    # Only imported here because it imports torch, which is slow, and example stores don't need it
+    from dataset import ModelData
+    data = ModelData.load_pickle(examples_path)
     if shuffle_seed != 0:
         data.shuffle(shuffle_seed)
-    data.limit_code_types(code_types)
-    data.limit_count(count, skip)
-    data.print()
+    examples = zip(data.source_decompiled_code_types, data.idents, data.sources, data.decompileds)
+    examples = (example for example in examples if example[0] in code_types)
+    if ident_pattern is not None:
+        matcher = re.compile(fnmatch.translate(ident_pattern)).match
+        examples = (example for example in examples if matcher(example[1]))
+    print_examples(islice(examples, skip, skip + count))
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Optional
+
+from code_type import CodeType
+from log import log
+from utils import PROJECT_PATH
+
+MANIFESTS_PATH = PROJECT_PATH / "local/manifests"
+
+# (path relative to the artifact dir, indices of code types it's a source for, indices it's decompiled for)
+ManifestFile = tuple[str, tuple[int, ...], tuple[int, ...]]
+
+
+class _SuffixTable:
+    """Classifies file names by source and decompiled extensions, using dict lookups instead of endswith checks"""
+    def __init__(self, code_types: list[CodeType]):
+        self.source: dict[str, list[int]] = {}
+        self.decompiled: dict[str, list[int]] = {}
+        for i, code_type in enumerate(code_types):
+            for extension in code_type.source_extensions:
+                self.source.setdefault(extension, []).append(i)
+            for extension in code_type.decompiled_extensions:
+                self.decompiled.setdefault(extension, []).append(i)
+        # Classification only depends on the part of the name from the first "."
+        self._classified: dict[str, Optional[tuple[tuple[int, ...], tuple[int, ...]]]] = {}
+
+    def classify(self, name: str) -> Optional[tuple[tuple[int, ...], tuple[int, ...]]]:
+        """(source code type indices, decompiled code type indices), or None if the file is neither"""
+        first_dot = name.find(".")
+        if first_dot == -1:
+            return None
+        extensions = name[first_dot:]
+        if extensions not in self._classified:
+            source = set()
+            decompiled = set()
+            dot = 0
+            while dot != -1:
+                suffix = extensions[dot:]
+                source.update(self.source.get(suffix, ()))
+                decompiled.update(self.decompiled.get(suffix, ()))
+                dot = extensions.find(".", dot + 1)
+            # A file is only a source for a code type if it isn't also decompiled for it (e.g. .o.c is not .c)
+            source -= decompiled
+            self._classified[extensions] = \
+                (tuple(sorted(source)), tuple(sorted(decompiled))) if source or decompiled else None
+        return self._classified[extensions]
+
+
+class RepoManifest:
+    """
+    Every source and decompiled file in a repo (directory of artifacts), grouped by artifact.
+    Built with a single scandir pass, and saved so that reruns don't walk the repo again
+    """
+    VERSION = 1
+
+    def __init__(self, repo_dir: Path, code_types: list[str], repo_mtime_ns: int):
+        self.version = self.VERSION
+        self.repo_dir = repo_dir
+        self.code_types = code_types
+        self.repo_mtime_ns = repo_mtime_ns
+        self.artifacts: dict[str, list[ManifestFile]] = {}
+
+    @property
+    def num_source_files(self) -> int:
+        return sum(len(source) for files in self.artifacts.values() for _, source, _ in files)
+
+    @property
+    def num_decompiled_files(self) -> int:
+        return sum(len(decompiled) for files in self.artifacts.values() for _, _, decompiled in files)
+
+    @staticmethod
+    def scan(
+            repo_dir: Path,
+            code_types: list[CodeType],
+            artifact_names: Optional[list[str]] = None) -> "RepoManifest":
+        """
+        scans every directory in the repo as an artifact, or only artifact_names if given.
+        artifact_names are relative paths, so they may be nested (e.g. "apt/foo-1.0")
+        """
+        suffix_table = _SuffixTable(code_types)
+        manifest = RepoManifest(repo_dir, [str(code_type) for code_type in code_types], repo_dir.stat().st_mtime_ns)
+        if artifact_names is None:
+            # Files directly in the repo dir aren't in an artifact, so they are ignored
+            with os.scandir(repo_dir) as entries:
+                artifact_names = sorted(entry.name for entry in entries if entry.is_dir())
+        for artifact_name in artifact_names:
+            files = []
+            _scan_artifact_dir(str(repo_dir / artifact_name), "", suffix_table, files)
+            if len(files) > 0:
+                manifest.artifacts[artifact_name] = files
+        return manifest
+
+    @staticmethod
+    def load_or_scan(repo_dir: Path, code_types: list[CodeType], rescan: bool) -> "RepoManifest":
+        """
+        loads the saved manifest for the repo, unless rescan or it's outdated, in which case scans and saves.
+        A manifest is outdated if artifacts were added or removed from the repo, but not if files were added or
+        removed within an existing artifact (pass rescan for that)
+        """
+        manifest_path = _manifest_path(repo_dir)
+        if not rescan and manifest_path.exists():
+            with manifest_path.open("rb") as manifest_file:
+                manifest: RepoManifest = pickle.load(manifest_file)
+            if manifest.version == RepoManifest.VERSION and \
+                    manifest.code_types == [str(code_type) for code_type in code_types] and \
+                    manifest.repo_mtime_ns == repo_dir.stat().st_mtime_ns:
+                log.info(f"** using saved manifest {str(manifest_path)}")
+                # The repo may have been passed as a different (e.g. relative) path
+                manifest.repo_dir = repo_dir
+                return manifest
+            log.info(f"** saved manifest {str(manifest_path)} is outdated")
+        log.info(f"** scanning repo {str(repo_dir)}")
+        manifest = RepoManifest.scan(repo_dir, code_types)
+        manifest.save(manifest_path)
+        return manifest
+
+    PICKLE_PROTOCOL = 5
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so an interrupted save doesn't leave a truncated manifest
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("wb") as file:
+            pickle.dump(self, file, protocol=self.PICKLE_PROTOCOL)
+        tmp_path.replace(path)
+
+
+def _manifest_path(repo_dir: Path) -> Path:
+    repo_hash = hashlib.sha1(str(repo_dir.resolve()).encode("utf-8")).hexdigest()[:16]
+    return MANIFESTS_PATH / f"{repo_dir.name}-{repo_hash}.pickle"
+
+
+def _scan_artifact_dir(dir_path: str, relative_dir: str, suffix_table: _SuffixTable, files: list[ManifestFile]):
+    try:
+        with os.scandir(dir_path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+    except OSError as e:
+        # Like os.walk, skip unreadable directories
+        log.warning(f"Failed to scan {dir_path}: {e}")
+        return
+    # Like os.walk, we don't follow symlinks to directories
+    for entry in entries:
+        relative_path = relative_dir + entry.name
+        if entry.is_dir():
+            if not entry.is_symlink():
+                _scan_artifact_dir(entry.path, relative_path + "/", suffix_table, files)
+        else:
+            classification = suffix_table.classify(entry.name)
+            if classification is not None:
+                files.append((relative_path, *classification))
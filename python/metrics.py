@@ -0,0 +1,45 @@
+from typing import Optional
+
+import numpy as np
+import torch
+from transformers import EvalPrediction
+
+# Label id of padding in batches (from DataCollatorForSeq2Seq, and how Trainer pads across batches)
+IGNORE_INDEX = -100
+
+
+def preprocess_logits_for_metrics(logits: torch.Tensor | tuple[torch.Tensor, ...], _labels: torch.Tensor) \
+        -> torch.Tensor:
+    """Only keep the predicted token ids, so evaluation doesn't accumulate the full logits"""
+    if isinstance(logits, tuple):
+        # T5 also returns the encoder's hidden state
+        logits = logits[0]
+    return logits.argmax(dim=-1)
+
+
+def compute_metrics(eval_pred: EvalPrediction, pad_token_id: Optional[int] = None) -> dict[str, float]:
+    """
+    Token-level metrics over the whole evaluation set at once (predictions are token ids, see
+    preprocess_logits_for_metrics):
+
+    - token_accuracy: ratio of correctly predicted label tokens
+    - sequence_accuracy: average of each example's token accuracy, so long examples don't dominate
+    - exact_match: ratio of examples where every label token is predicted correctly
+
+    Padding labels are ignored
+    """
+    predictions, labels = eval_pred.predictions, eval_pred.label_ids
+    mask = labels != IGNORE_INDEX
+    if pad_token_id is not None:
+        mask &= labels != pad_token_id
+    correct = (predictions == labels) & mask
+    num_tokens = mask.sum(axis=-1)
+    num_correct = correct.sum(axis=-1)
+    has_tokens = num_tokens > 0
+    if not has_tokens.any():
+        return {"token_accuracy": 0.0, "sequence_accuracy": 0.0, "exact_match": 0.0}
+    return {
+        "token_accuracy": float(num_correct.sum() / num_tokens.sum()),
+        "sequence_accuracy": float(np.mean(num_correct[has_tokens] / num_tokens[has_tokens])),
+        "exact_match": float(np.mean(num_correct[has_tokens] == num_tokens[has_tokens]))
+    }
@@ -1,10 +1,20 @@
+import hashlib
+import json
 import os
 from typing import Optional
 
+import torch
 from transformers import AutoTokenizer, T5ForConditionalGeneration
 from pathlib import Path
 
+from log import log
+from utils import PROJECT_PATH, BACKENDS
+
 USE_SMALL = True
+# Passed to model.generate
+GENERATION_PARAMS = {"max_new_tokens": 512}
+# Where exported pretrained models are cached (exported checkpoints are cached in the checkpoint directory)
+EXPORTED_PRETRAINED_PATH = PROJECT_PATH / "local/exported-models"
 
 
 def get_pretrained_id() -> str:
@@ -22,16 +32,25 @@ def get_tokenizer():
     return AutoTokenizer.from_pretrained(get_pretrained_id())
 
 
-def tokenize(tokenizer, data):
-    return tokenizer(data, truncation=True, padding="longest", return_tensors="pt")
-
-
-def tokenize_encode(tokenizer, code):
-    return tokenizer.encode(code, truncation=True, padding="longest", return_tensors="pt")
-
-
-def tokenize_decode(tokenizer, code):
-    return tokenizer.decode(code, skip_special_tokens=True)
+def generate_batch(tokenizer, model, codes: list[str], batch_size: int) -> list[str]:
+    """
+    Runs the model on each code, batching codes of similar length together (so batches have little padding).
+    Returns the outputs in the same order as the codes
+    """
+    outputs: list[Optional[str]] = [None] * len(codes)
+    order = sorted(range(len(codes)), key=lambda i: len(codes[i]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        inputs = tokenizer(
+            [codes[i] for i in batch],
+            truncation=True,
+            padding="longest",
+            return_tensors="pt"
+        )
+        generated = model.generate(**inputs, **GENERATION_PARAMS)
+        for i, output in zip(batch, tokenizer.batch_decode(generated, skip_special_tokens=True)):
+            outputs[i] = output
+    return outputs
 
 
 def get_real_model_dir(model_dir: Path) -> Path:
@@ -44,8 +63,100 @@ def get_real_model_dir(model_dir: Path) -> Path:
         return checkpoint_paths[-1]
 
 
-def get_model(model_dir: Optional[Path]):
-    if model_dir is None or not any(os.scandir(model_dir)):
-        return get_default_model()
+def _is_pretrained(model_dir: Optional[Path]) -> bool:
+    return model_dir is None or not any(os.scandir(model_dir))
+
+
+def get_model(model_dir: Optional[Path], backend: str = "torch"):
+    """
+    Loads the model to run with the backend (see BACKENDS). All backends support model.generate,
+    so the other model functions work with any of them. Exported (int8 and onnx) models are cached
+    """
+    if backend == "torch":
+        if _is_pretrained(model_dir):
+            return get_default_model()
+        else:
+            return T5ForConditionalGeneration.from_pretrained(get_real_model_dir(model_dir))
+    elif backend == "int8":
+        return _get_int8_model(model_dir)
+    elif backend == "onnx":
+        return _get_onnx_model(model_dir)
+    else:
+        raise ValueError(f"Unknown backend {backend} (expected one of {', '.join(BACKENDS)})")
+
+
+def _get_export_dir(model_dir: Optional[Path], backend: str) -> Path:
+    """
+    Where the model exported for backend is cached. It's in a subdirectory of the checkpoint,
+    which isn't part of the model fingerprint, since only files are
+    """
+    if _is_pretrained(model_dir):
+        return EXPORTED_PRETRAINED_PATH / get_pretrained_id().replace("/", "--") / backend
+    else:
+        return get_real_model_dir(model_dir) / f"{backend}-export"
+
+
+def _is_export_current(export_dir: Path, model_dir: Optional[Path]) -> bool:
+    """whether the export exists and is of the current model (not e.g. one since overwritten by train -f)"""
+    fingerprint_path = export_dir / "fingerprint.txt"
+    return fingerprint_path.exists() and fingerprint_path.read_text() == get_model_fingerprint(model_dir)
+
+
+def _mark_export_current(export_dir: Path, model_dir: Optional[Path]):
+    (export_dir / "fingerprint.txt").write_text(get_model_fingerprint(model_dir))
+
+
+def _get_int8_model(model_dir: Optional[Path]):
+    export_dir = _get_export_dir(model_dir, "int8")
+    model_path = export_dir / "model.pt"
+    if _is_export_current(export_dir, model_dir):
+        log.info(f"** using quantized model {str(model_path)}")
+        # Quantized modules can't be loaded with from_pretrained, so the whole model is pickled
+        return torch.load(model_path, weights_only=False)
+    log.info(f"** quantizing model to int8, saving in {str(model_path)}")
+    model = torch.quantization.quantize_dynamic(get_model(model_dir, "torch"), {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    export_dir.mkdir(parents=True, exist_ok=True)
+    torch.save(model, model_path)
+    _mark_export_current(export_dir, model_dir)
+    return model
+
+
+def _get_onnx_model(model_dir: Optional[Path]):
+    try:
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    except ImportError as e:
+        raise ImportError("The onnx backend requires optimum with onnxruntime "
+                          "(install with `pip install optimum[onnxruntime]`)") from e
+    export_dir = _get_export_dir(model_dir, "onnx")
+    if _is_export_current(export_dir, model_dir):
+        log.info(f"** using ONNX model {str(export_dir)}")
+        return ORTModelForSeq2SeqLM.from_pretrained(export_dir, use_cache=True)
+    log.info(f"** exporting model to ONNX, saving in {str(export_dir)}")
+    model = ORTModelForSeq2SeqLM.from_pretrained(
+        get_pretrained_id() if _is_pretrained(model_dir) else get_real_model_dir(model_dir),
+        export=True,
+        use_cache=True
+    )
+    export_dir.mkdir(parents=True, exist_ok=True)
+    model.save_pretrained(export_dir)
+    _mark_export_current(export_dir, model_dir)
+    return model
+
+
+def get_model_fingerprint(model_dir: Optional[Path], backend: str = "torch") -> str:
+    """
+    identifies the model get_model would return (changes when a new checkpoint is saved).
+    Other backends' outputs may differ slightly from torch's, so they have different fingerprints
+    """
+    if _is_pretrained(model_dir):
+        fingerprint = f"pretrained:{get_pretrained_id()}"
     else:
-        return T5ForConditionalGeneration.from_pretrained(get_real_model_dir(model_dir))
+        real_model_dir = get_real_model_dir(model_dir)
+        # Hashing the weights would be slow, and they are rewritten (changing mtime) whenever they change
+        files = sorted(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in os.scandir(real_model_dir) if entry.is_file()
+        )
+        fingerprint = hashlib.sha256(json.dumps(files).encode("utf-8")).hexdigest()
+    return fingerprint if backend == "torch" else f"{backend}:{fingerprint}"
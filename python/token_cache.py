@@ -0,0 +1,197 @@
+import hashlib
+import json
+import shutil
+from itertools import chain
+from os import environ
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+from tokenizers import Tokenizer
+
+from code_type import ModelStr
+from example_store import ExampleStore
+from log import log, logging_progress
+from utils import PROJECT_PATH
+
+TOKEN_CACHE_PATH = PROJECT_PATH / "local/token-cache"
+# Bump when the cache format or how we tokenize changes
+TOKEN_CACHE_VERSION = 2
+TOKENIZE_CHUNK_SIZE = 1024
+# Least recently used cached stores are deleted when there are more than this many
+TOKEN_CACHE_MAX_ENTRIES = int(environ.get("TOKEN_CACHE_MAX_ENTRIES", 4))
+
+
+class RaggedTokens:
+    """
+    token ids of many sequences, concatenated: sequence i is ids[offsets[i]:offsets[i + 1]].
+    If indices is given, only those sequences (in that order)
+    """
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray, indices: Optional[np.ndarray] = None):
+        self.ids = ids
+        self.offsets = offsets
+        self.indices = indices
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        if self.indices is not None:
+            i = self.indices[i]
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.indices) if self.indices is not None else len(self.offsets) - 1
+
+    def lengths(self) -> np.ndarray:
+        lengths = np.diff(self.offsets)
+        return lengths[self.indices] if self.indices is not None else lengths
+
+    def select(self, indices: np.ndarray) -> "RaggedTokens":
+        """the sequences at indices, without copying"""
+        return RaggedTokens(self.ids, self.offsets, indices if self.indices is None else self.indices[indices])
+
+    def save(self, path: Path, name: str):
+        if self.indices is not None:
+            raise ValueError("Can't save selected tokens")
+        self.ids.tofile(path / f"{name}.ids")
+        self.offsets.tofile(path / f"{name}.offsets")
+
+    @staticmethod
+    def load(path: Path, name: str, dtype: str) -> "RaggedTokens":
+        """memory-maps the saved tokens, so they are only read when accessed"""
+        offsets = np.memmap(path / f"{name}.offsets", dtype=np.int64, mode="r")
+        # np.memmap can't map empty files
+        ids = np.memmap(path / f"{name}.ids", dtype=dtype, mode="r") if offsets[-1] > 0 else np.zeros(0, dtype)
+        return RaggedTokens(ids, offsets)
+
+
+class TokenizedExamples:
+    """tokenized decompiled (inputs) and source (labels) code of each example, without padding"""
+    def __init__(self, inputs: RaggedTokens, labels: RaggedTokens):
+        self.inputs = inputs
+        self.labels = labels
+
+    def input_ids(self, i: int) -> np.ndarray:
+        return self.inputs[i].astype(np.int64)
+
+    def label_ids(self, i: int) -> np.ndarray:
+        return self.labels[i].astype(np.int64)
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def select(self, indices: np.ndarray) -> "TokenizedExamples":
+        """the examples at indices, without copying"""
+        return TokenizedExamples(self.inputs.select(indices), self.labels.select(indices))
+
+    def save(self, path: Path):
+        """saves to a new directory, atomically (so an interrupted save doesn't leave a corrupt cache)"""
+        tmp_path = path.with_name(path.name + ".tmp")
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+        tmp_path.mkdir(parents=True)
+        self.inputs.save(tmp_path, "inputs")
+        self.labels.save(tmp_path, "labels")
+        with (tmp_path / "meta.json").open("w") as meta_file:
+            json.dump({"dtype": self.inputs.ids.dtype.name, "len": len(self)}, meta_file)
+        tmp_path.rename(path)
+
+    @staticmethod
+    def load(path: Path) -> "TokenizedExamples":
+        with (path / "meta.json").open() as meta_file:
+            meta = json.load(meta_file)
+        return TokenizedExamples(
+            RaggedTokens.load(path, "inputs", meta["dtype"]),
+            RaggedTokens.load(path, "labels", meta["dtype"])
+        )
+
+
+def load_or_tokenize_store(tokenizer: Tokenizer, store_path: Path) -> TokenizedExamples:
+    """
+    Every example in the example store, tokenized and truncated to the tokenizer's max length. The tokens are cached
+    by the store's hash, the tokenizer and truncation, so later runs memory-map instead of re-tokenizing
+    (regardless of which of the store's examples they use: select them from the result by their store indices)
+    """
+    cache_path = TOKEN_CACHE_PATH / _cache_key(tokenizer, store_path)
+    if cache_path.exists():
+        log.info(f"** using cached tokens {str(cache_path)}")
+        # Marks it recently used
+        cache_path.touch()
+    else:
+        with ExampleStore(store_path) as store:
+            tokenize_examples(tokenizer, store.decompileds, store.sources).save(cache_path)
+        log.info(f"** cached tokens in {str(cache_path)}")
+        _evict_old_entries()
+    return TokenizedExamples.load(cache_path)
+
+
+def tokenize_examples(tokenizer: Tokenizer, decompileds: Sequence[ModelStr], sources: Sequence[ModelStr]) \
+        -> TokenizedExamples:
+    """Tokenizes the examples (without caching), truncating each to the tokenizer's max length"""
+    # codet5's vocab fits in 16 bits, which halves the size of the cache
+    dtype = np.uint16 if len(tokenizer) <= 2 ** 16 else np.int32
+    return TokenizedExamples(
+        _tokenize(tokenizer, decompileds, dtype, "tokenize-inputs"),
+        _tokenize(tokenizer, sources, dtype, "tokenize-labels")
+    )
+
+
+def _evict_old_entries():
+    entries = sorted(
+        (entry for entry in TOKEN_CACHE_PATH.iterdir() if entry.is_dir() and not entry.name.endswith(".tmp")),
+        key=lambda entry: entry.stat().st_mtime_ns
+    )
+    for entry in entries[:max(0, len(entries) - TOKEN_CACHE_MAX_ENTRIES)]:
+        log.info(f"** evicting cached tokens {str(entry)}")
+        shutil.rmtree(entry)
+
+
+def _tokenize(tokenizer: Tokenizer, strings: Sequence[ModelStr], dtype, desc: str) -> RaggedTokens:
+    ids_chunks = []
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    for start in logging_progress(
+            range(0, len(strings), TOKENIZE_CHUNK_SIZE),
+            desc=desc,
+            total=(len(strings) + TOKENIZE_CHUNK_SIZE - 1) // TOKENIZE_CHUNK_SIZE):
+        # Indexed instead of sliced, since strings may be an example store's (lazily decoded) column
+        chunk = [strings[i] for i in range(start, min(start + TOKENIZE_CHUNK_SIZE, len(strings)))]
+        chunk_ids = tokenizer(chunk, truncation=True)["input_ids"]
+        ids_chunks.append(np.fromiter(chain.from_iterable(chunk_ids), dtype=dtype))
+        offsets[start + 1:start + 1 + len(chunk_ids)] = [len(ids) for ids in chunk_ids]
+    np.cumsum(offsets, out=offsets)
+    ids = np.concatenate(ids_chunks) if len(ids_chunks) > 0 else np.zeros(0, dtype=dtype)
+    return RaggedTokens(ids, offsets)
+
+
+def _cache_key(tokenizer: Tokenizer, store_path: Path) -> str:
+    key = {
+        "version": TOKEN_CACHE_VERSION,
+        "examples": _file_hash(store_path),
+        "tokenizer": f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:{len(tokenizer)}",
+        "truncation": True,
+        "max_length": tokenizer.model_max_length
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def _file_hash(path: Path) -> str:
+    """sha256 of the file. Memoized by path, size and mtime, since examples files are large"""
+    hashes_path = TOKEN_CACHE_PATH / "file-hashes.json"
+    hashes = {}
+    if hashes_path.exists():
+        with hashes_path.open() as hashes_file:
+            hashes = json.load(hashes_file)
+    stat = path.stat()
+    memo_key = str(path.resolve())
+    memo = hashes.get(memo_key)
+    if memo is not None and memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+        return memo["sha256"]
+
+    log.info(f"** hashing {str(path)}")
+    sha256 = hashlib.sha256()
+    with path.open("rb") as file:
+        while chunk := file.read(1024 * 1024):
+            sha256.update(chunk)
+    hashes[memo_key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+    hashes_path.parent.mkdir(parents=True, exist_ok=True)
+    with hashes_path.open("w") as hashes_file:
+        json.dump(hashes, hashes_file)
+    return hashes[memo_key]["sha256"]
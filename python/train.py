@@ -1,13 +1,15 @@
 import gc
+from functools import partial
 from pathlib import Path
+from typing import Optional
 
-import evaluate
-import numpy as np
 import torch
-from transformers import TrainingArguments, Trainer
+from torch.utils.data import DataLoader
+from transformers import TrainingArguments, Trainer, TrainerCallback, DataCollatorForSeq2Seq
 
 from code_types import CODE_TYPES
-from dataset import ModelData, ModelDataset
+from dataset import ModelData, ModelDataset, TokenBudgetBatchSampler
+from metrics import compute_metrics, preprocess_logits_for_metrics
 from model import get_model, get_tokenizer
 from utils import mk_empty_dir
 
@@ -19,7 +21,8 @@ def train(
         langs: str,
         count: int,
         force: bool,
-        resume: bool):
+        resume: bool,
+        max_batch_tokens: int):
     if resume:
         model_dir.mkdir(parents=True, exist_ok=True)
     else:
@@ -35,29 +38,28 @@ def train(
         count
     )
     do_eval = eval_dataset is not None
-    metric = evaluate.load("accuracy") if do_eval else None
-
-    def compute_metrics(eval_pred):
-        logits, labels = eval_pred
-        predictions = np.argmax(logits[0], axis=-1)
-        return np.average(np.vectorize(metric.compute)(predictions=predictions, references=labels))
 
     training_args = TrainingArguments(
         output_dir=str(model_dir),
         save_steps=1000,
         save_total_limit=10,
+        # Ignored: batches are sized by max_batch_tokens instead
         per_device_train_batch_size=1,
         per_device_eval_batch_size=1 if do_eval else None,
         evaluation_strategy="epoch" if do_eval else "no",
         do_eval=do_eval
     )
 
-    trainer = Trainer(
+    trainer = _TokenBudgetTrainer(
+        max_batch_tokens,
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
-        compute_metrics=compute_metrics if do_eval else None,
+        # Examples aren't padded, so pad each batch (labels are padded with -100 so they're ignored by the loss)
+        data_collator=DataCollatorForSeq2Seq(tokenizer, model=model),
+        compute_metrics=partial(compute_metrics, pad_token_id=tokenizer.pad_token_id) if do_eval else None,
+        preprocess_logits_for_metrics=preprocess_logits_for_metrics if do_eval else None,
     )
 
     gc.collect()
@@ -66,6 +68,52 @@ def train(
     trainer.train()
 
 
+class _TokenBudgetTrainer(Trainer):
+    """Trainer which batches similar-length examples up to a token budget (see TokenBudgetBatchSampler)"""
+    def __init__(self, max_batch_tokens: int, **kwargs):
+        super().__init__(**kwargs)
+        self.max_batch_tokens = max_batch_tokens
+        self.train_batch_sampler: Optional[TokenBudgetBatchSampler] = None
+        self.add_callback(_SamplerEpochCallback(self))
+
+    def get_train_dataloader(self) -> DataLoader:
+        self.train_batch_sampler = self._get_token_budget_batch_sampler(self.train_dataset, shuffle=True)
+        return self._get_token_budget_dataloader(self.train_dataset, self.train_batch_sampler)
+
+    def get_eval_dataloader(self, eval_dataset: Optional[ModelDataset] = None) -> DataLoader:
+        eval_dataset = eval_dataset or self.eval_dataset
+        return self._get_token_budget_dataloader(
+            eval_dataset,
+            self._get_token_budget_batch_sampler(eval_dataset, shuffle=False)
+        )
+
+    def _get_token_budget_batch_sampler(self, dataset: ModelDataset, shuffle: bool) -> TokenBudgetBatchSampler:
+        return TokenBudgetBatchSampler(dataset.lengths(), self.max_batch_tokens, self.args.seed, shuffle)
+
+    def _get_token_budget_dataloader(self, dataset: ModelDataset, batch_sampler: TokenBudgetBatchSampler) -> DataLoader:
+        return DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory
+        )
+
+
+class _SamplerEpochCallback(TrainerCallback):
+    """
+    Sets the train batch sampler's epoch at the start of each epoch from the trainer state, which is loaded from the
+    checkpoint when resuming, so the resumed epoch's batches are in the same order as the interrupted one's
+    (and the batches skipped on resume are the ones which were already trained on)
+    """
+    def __init__(self, trainer: _TokenBudgetTrainer):
+        self.trainer = trainer
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        if self.trainer.train_batch_sampler is not None:
+            self.trainer.train_batch_sampler.set_epoch(int(state.epoch or 0))
+
+
 def get_datasets(
         tokenizer,
         train_path: Path,
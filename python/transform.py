@@ -1,23 +1,16 @@
 from pathlib import Path
-from tokenizers import Tokenizer
+from typing import Optional
 
 from code_type import CodeType, TransformStr
 from transform_gen import gen_transform
-from transform_ir import transform_ir_code
 
 
-def _transform_code1(tokenizer: Tokenizer, model, input: TransformStr) -> TransformStr:
-    match input.type:
-        case TransformStr.REGULAR:
-            return TransformStr.regular(transform_ir_code(tokenizer, model, input.string))
-        case TransformStr.PASS_THROUGH:
-            return TransformStr.pass_through(input.string)
+def read_decompiled(code_type: CodeType, src: Path) -> list[TransformStr]:
+    return list(code_type.process_decompiled(src))
 
 
-def transform_code(tokenizer: Tokenizer, code_type: CodeType, model, src: Path) -> str | bytes:
-    model_inputs = code_type.process_decompiled(src)
-    model_outputs = (_transform_code1(tokenizer, model, model_input) for model_input in model_inputs)
-    return code_type.process_source(model_outputs)
+def write_source(code_type: CodeType, outputs: list[TransformStr]) -> str | bytes:
+    return code_type.process_source(iter(outputs))
 
 
 def transform(
@@ -26,5 +19,23 @@ def transform(
         model_dir: Path,
         langs: str,
         count: int,
-        force: bool):
-    gen_transform(transform_code, indir, outdir, model_dir, langs, count, force)
+        force: bool,
+        batch_size: int,
+        cache_path: Optional[Path],
+        num_read_workers: int,
+        incremental: bool,
+        backend: str):
+    gen_transform(
+        read_decompiled, write_source,
+        indir,
+        outdir,
+        model_dir,
+        langs,
+        count,
+        force,
+        batch_size,
+        cache_path,
+        num_read_workers,
+        incremental,
+        backend
+    )
@@ -1,40 +1,184 @@
-import shutil
-from itertools import chain
+import json
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, islice
+from os import cpu_count
 from pathlib import Path
-from typing import Callable, Any
+from time import time
+from typing import Callable, Any, Optional
 
 from tokenizers import Tokenizer
 
-from code_type import CodeType
+from code_type import CodeType, TransformStr
 from code_types import CODE_TYPES
+from inference_cache import InferenceCache, INFERENCE_CACHE_SIZE
 from log import log
-from model import get_tokenizer, get_model
-from utils import check_dir, mk_empty_dir
+from model import get_tokenizer, get_model, generate_batch, get_model_fingerprint, GENERATION_PARAMS
+from utils import check_dir, mk_empty_dir, write_atomic, copy_atomic
+
+# Reads a file into segments: regular segments are transformed by the model, pass-through segments are kept as-is.
+# Runs in a separate process, so must be picklable (e.g. a module-level function)
+ReadInputs = Callable[[CodeType, Path], list[TransformStr]]
+# Combines the (transformed) segments of a file into the output file's contents
+WriteOutputs = Callable[[CodeType, list[TransformStr]], str | bytes]
+
+# Files in flight in each stage of the transform pipeline
+PIPELINE_QUEUE_SIZE = 64
+NUM_WRITE_WORKERS = 2
+# We run the model once we have this many batches of regular segments, so they can be sorted by length
+# (segments in a batch have similar length, so there's less padding)
+NUM_BATCHES_PER_RUN = 8
+
+
+class _PendingFile:
+    """a file whose regular segments are waiting to be transformed"""
+    def __init__(self, code_type: CodeType, src: Path, dest: Path, segments: list[TransformStr]):
+        self.code_type = code_type
+        self.src = src
+        self.dest = dest
+        self.segments = segments
+
+    def regular_segment_indices(self) -> list[int]:
+        return [i for i, segment in enumerate(self.segments) if segment.type == TransformStr.REGULAR]
+
+
+def _generate_cached(
+        tokenizer: Tokenizer,
+        model: Any,
+        codes: list[str],
+        batch_size: int,
+        cache: Optional[InferenceCache]) -> list[str]:
+    """generate_batch, but outputs are looked up in and added to the cache, and duplicate codes are only run once"""
+    if cache is None:
+        return generate_batch(tokenizer, model, codes, batch_size)
+    outputs = [cache.get(code) for code in codes]
+    missing_indices_by_key: dict[bytes, list[int]] = {}
+    for i, output in enumerate(outputs):
+        if output is None:
+            missing_indices_by_key.setdefault(cache.key(codes[i]), []).append(i)
+    missing_indices = list(missing_indices_by_key.values())
+    missing_outputs = generate_batch(tokenizer, model, [codes[indices[0]] for indices in missing_indices], batch_size)
+    for indices, output in zip(missing_indices, missing_outputs):
+        cache.put(codes[indices[0]], output)
+        for i in indices:
+            outputs[i] = output
+    cache.commit()
+    return outputs
+
+
+class _StageTimes:
+    """total time each stage of gen_transform_dir spent working, to report utilization"""
+    def __init__(self):
+        self.read = 0.0
+        self.infer = 0.0
+        self.write = 0.0
+
+
+def _timed_read(read_inputs: ReadInputs, code_type: CodeType, src: Path) -> tuple[list[TransformStr], float]:
+    """read_inputs in a read worker process, also returning how long it took"""
+    start_time = time()
+    segments = read_inputs(code_type, src)
+    return segments, time() - start_time
+
+
+def _timed_write(write_outputs: WriteOutputs, file: _PendingFile) -> float:
+    """writes the transformed file in a write worker thread, returning how long it took"""
+    start_time = time()
+    write_atomic(file.dest, write_outputs(file.code_type, file.segments))
+    return time() - start_time
+
+
+class TransformManifest:
+    """
+    Records which files in an output directory are transforms of which inputs (by input size and mtime)
+    and with which model, so that incremental runs skip files which are up-to-date
+    """
+    FILE_NAME = ".transform-manifest.json"
+    VERSION = 1
+    # Save after this many files are transformed, so we don't lose much progress if interrupted
+    SAVE_INTERVAL = 32
+
+    def __init__(self, src_root: Path, dest_root: Path, fingerprint: str):
+        self.src_root = src_root
+        self.dest_root = dest_root
+        self.fingerprint = fingerprint
+        self.path = dest_root / self.FILE_NAME
+        self.entries: dict[str, dict] = {}
+        if self.path.exists():
+            with self.path.open() as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest["version"] == self.VERSION:
+                self.entries = manifest["entries"]
+        self.num_unsaved = 0
+
+    def _entry(self, src: Path, dest: Path) -> dict:
+        stat = src.stat()
+        return {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "fingerprint": self.fingerprint,
+            "output": str(dest.relative_to(self.dest_root))
+        }
+
+    def is_up_to_date(self, src: Path, dest: Path) -> bool:
+        entry = self.entries.get(str(src.relative_to(self.src_root)))
+        return entry is not None and entry == self._entry(src, dest) and dest.exists()
+
+    def record(self, src: Path, dest: Path):
+        self.entries[str(src.relative_to(self.src_root))] = self._entry(src, dest)
+        self.num_unsaved += 1
+        if self.num_unsaved >= self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        write_atomic(self.path, json.dumps({"version": self.VERSION, "entries": self.entries}))
+        self.num_unsaved = 0
+
+
+def _copy_if_changed(src: Path, dest: Path):
+    """copies src to dest, unless dest is already a copy (copies preserve mtime)"""
+    if dest.exists():
+        src_stat = src.stat()
+        dest_stat = dest.stat()
+        if src_stat.st_size == dest_stat.st_size and src_stat.st_mtime_ns == dest_stat.st_mtime_ns:
+            return
+    copy_atomic(src, dest)
 
 
 def gen_transform_dir(
-        do_transform: Callable[[Tokenizer, CodeType, Any, Path], str],
+        read_inputs: ReadInputs,
+        write_outputs: WriteOutputs,
         tokenizer: Tokenizer,
         code_types: list[CodeType],
         model: Any,
         count: int,
+        batch_size: int,
+        cache: Optional[InferenceCache],
+        num_read_workers: int,
+        manifest: Optional[TransformManifest],
         src_root: Path,
         dest: Path):
-    num_transformed = [0]
+    """
+    Transforms the first count code files under src_root into dest, and copies the other files.
+    Code files are transformed in a pipeline, so the model doesn't wait on parsing or writing:
+    read_inputs runs in num_read_workers processes (0 = one per CPU), the model runs in this thread on batches of
+    regular segments collected across files, and write_outputs runs in NUM_WRITE_WORKERS threads.
+    Each stage is bounded to PIPELINE_QUEUE_SIZE files in flight.
+    If manifest is given, dest may already contain outputs, and code files it has up-to-date outputs for are skipped
+    (and don't count towards count). Outputs are written atomically, so an interrupted run never leaves partial files
+    """
+    code_files: list[tuple[CodeType, Path, Path]] = []
 
     # noinspection PyShadowingNames
     def transform_code_file(code_type: CodeType, src: Path, dest: Path):
-        if num_transformed[0] >= count:
+        if manifest is not None and manifest.is_up_to_date(src, dest):
+            log.debug(f"Skipping transforming file {str(src)} as it's up-to-date")
+            return
+        if len(code_files) >= count:
             log.info(f"Skipping transforming file {str(src)} as we exceeded count, just copying...")
-            shutil.copy(src, dest)
+            _copy_if_changed(src, dest)
             return
-        
-        log.info(f"Transforming file {str(src)}")
-
-        with dest.open("w", encoding="utf8") as dest:
-            transformed_code = do_transform(tokenizer, code_type, model, src)
-            dest.write(transformed_code)
-            num_transformed[0] += 1
+        code_files.append((code_type, src, dest))
 
     # noinspection PyShadowingNames
     def transform_file(src: Path, dest: Path):
@@ -47,7 +191,7 @@ def gen_transform_dir(
                     return
         # Fallback
         log.debug(f"Copying non-code file {str(src)}")
-        shutil.copy(src, dest)
+        _copy_if_changed(src, dest)
 
     # noinspection PyShadowingNames
     def transform_sub_dir(src: Path, dest: Path, exist_ok: bool):
@@ -57,26 +201,138 @@ def gen_transform_dir(
 
             dest.mkdir(exist_ok=exist_ok)
             for child in src.iterdir():
-                transform_sub_dir(child, dest.joinpath(child.name), exist_ok=False)
+                transform_sub_dir(child, dest.joinpath(child.name), exist_ok=manifest is not None)
         else:
             transform_file(src, dest)
 
+    # Creates directories and copies other files, so that code files can be written in any order
     transform_sub_dir(src_root, dest, exist_ok=True)
 
+    start_time = time()
+    times = _StageTimes()
+    num_read_workers = num_read_workers if num_read_workers > 0 else cpu_count()
+    with ProcessPoolExecutor(num_read_workers) as read_pool, ThreadPoolExecutor(NUM_WRITE_WORKERS) as write_pool:
+        code_files_iter = iter(code_files)
+        reads: deque[tuple[CodeType, Path, Path, Future]] = deque()
+        writes: deque[tuple[_PendingFile, Future]] = deque()
+        # Regular segments are collected across files and transformed in batches
+        pending_files: list[_PendingFile] = []
+        num_pending_segments = [0]
+
+        def submit_reads():
+            for code_type, src, dest in islice(code_files_iter, PIPELINE_QUEUE_SIZE - len(reads)):
+                log.info(f"Transforming file {str(src)}")
+                reads.append((code_type, src, dest, read_pool.submit(_timed_read, read_inputs, code_type, src)))
+
+        def finish_write():
+            written_file, write = writes.popleft()
+            times.write += write.result()
+            if manifest is not None:
+                manifest.record(written_file.src, written_file.dest)
+
+        def submit_write(file: _PendingFile):
+            while len(writes) >= PIPELINE_QUEUE_SIZE:
+                finish_write()
+            writes.append((file, write_pool.submit(_timed_write, write_outputs, file)))
+
+        def run_pending():
+            infer_start_time = time()
+            regular_segments = [(file, i) for file in pending_files for i in file.regular_segment_indices()]
+            log.info(f"Transforming {len(regular_segments)} segments from {len(pending_files)} files")
+            outputs = _generate_cached(
+                tokenizer,
+                model,
+                [file.segments[i].string for file, i in regular_segments],
+                batch_size,
+                cache
+            )
+            for (file, i), output in zip(regular_segments, outputs):
+                file.segments[i] = TransformStr.regular(output)
+            times.infer += time() - infer_start_time
+            for file in pending_files:
+                submit_write(file)
+            pending_files.clear()
+            num_pending_segments[0] = 0
+
+        submit_reads()
+        while len(reads) > 0:
+            code_type, src, dest, read = reads.popleft()
+            segments, read_time = read.result()
+            times.read += read_time
+            submit_reads()
+            file = _PendingFile(code_type, src, dest, segments)
+            pending_files.append(file)
+            num_pending_segments[0] += len(file.regular_segment_indices())
+            if num_pending_segments[0] >= batch_size * NUM_BATCHES_PER_RUN:
+                run_pending()
+        if len(pending_files) > 0:
+            run_pending()
+        while len(writes) > 0:
+            finish_write()
+
+    duration = time() - start_time
+    if duration > 0:
+        log.info(f"Transformed {len(code_files)} files ({'%.2f' % duration} seconds). Utilization: "
+                 f"read {'%.1f' % (times.read / (duration * num_read_workers) * 100)}% of {num_read_workers} "
+                 f"processes, infer {'%.1f' % (times.infer / duration * 100)}%, "
+                 f"write {'%.1f' % (times.write / (duration * NUM_WRITE_WORKERS) * 100)}% of "
+                 f"{NUM_WRITE_WORKERS} threads")
+
 
 def gen_transform(
-        do_transform: Callable[[Tokenizer, CodeType, Any, Path], str],
+        read_inputs: ReadInputs,
+        write_outputs: WriteOutputs,
         indir: Path,
         outdir: Path,
         model_dir: Path,
         langs: str,
         count: int,
-        force: bool):
+        force: bool,
+        batch_size: int,
+        cache_path: Optional[Path],
+        num_read_workers: int,
+        incremental: bool,
+        backend: str):
     check_dir(indir)
-    mk_empty_dir(outdir, force)
+    if incremental:
+        outdir.mkdir(parents=True, exist_ok=True)
+    else:
+        mk_empty_dir(outdir, force)
 
     tokenizer = get_tokenizer()
     code_types = [CODE_TYPES[lang] for lang in langs.split(",")]
-    model = get_model(model_dir)
+    model = get_model(model_dir, backend)
+
+    manifest = TransformManifest(indir, outdir, json.dumps({
+        "transform": read_inputs.__name__,
+        "model": get_model_fingerprint(model_dir, backend),
+        "generation": GENERATION_PARAMS
+    }, sort_keys=True)) if incremental else None
+    cache = InferenceCache(
+        cache_path,
+        get_model_fingerprint(model_dir, backend),
+        GENERATION_PARAMS,
+        INFERENCE_CACHE_SIZE
+    ) if cache_path is not None else None
 
-    gen_transform_dir(do_transform, tokenizer, code_types, model, count, indir, outdir)
+    try:
+        gen_transform_dir(
+            read_inputs,
+            write_outputs,
+            tokenizer,
+            code_types,
+            model,
+            count,
+            batch_size,
+            cache,
+            num_read_workers,
+            manifest,
+            indir,
+            outdir
+        )
+    finally:
+        if manifest is not None:
+            manifest.save()
+        if cache is not None:
+            cache.close()
+            log.info(str(cache))
@@ -1,22 +1,17 @@
 from pathlib import Path
+from typing import Optional
 
-from tokenizers import Tokenizer
-
-from code_type import CodeType
-from model import tokenize_encode, tokenize_decode
+from code_type import CodeType, TransformStr
 from transform_gen import gen_transform
 
 
-def transform_raw_ir_code(tokenizer: Tokenizer, _code_type: CodeType, model, src: Path) -> str:
+def read_raw_ir(_code_type: CodeType, src: Path) -> list[TransformStr]:
     with src.open(encoding="utf8") as src:
-        code = src.read()
-    return transform_ir_code(tokenizer, model, code)
+        return [TransformStr.regular(src.read())]
 
 
-def transform_ir_code(tokenizer: Tokenizer, model, code: str) -> str:
-    input_ids = tokenize_encode(tokenizer, code)
-    outputs = model.generate(input_ids, max_new_tokens=512)
-    return tokenize_decode(tokenizer, outputs[0])
+def write_raw_ir(_code_type: CodeType, outputs: list[TransformStr]) -> str:
+    return "".join(output.string for output in outputs)
 
 
 def transform_ir(
@@ -25,5 +20,23 @@ def transform_ir(
         model_dir: Path,
         langs: str,
         count: int,
-        force: bool):
-    gen_transform(transform_raw_ir_code, indir, outdir, model_dir, langs, count, force)
+        force: bool,
+        batch_size: int,
+        cache_path: Optional[Path],
+        num_read_workers: int,
+        incremental: bool,
+        backend: str):
+    gen_transform(
+        read_raw_ir, write_raw_ir,
+        indir,
+        outdir,
+        model_dir,
+        langs,
+        count,
+        force,
+        batch_size,
+        cache_path,
+        num_read_workers,
+        incremental,
+        backend
+    )
@@ -1,28 +1,48 @@
+import hashlib
+from collections import OrderedDict
 from glob import glob
-from itertools import chain, islice
-from os import environ, path
+from itertools import chain
+from os import environ, path, scandir, stat, walk
 from pathlib import Path
 from typing import Iterable, Optional
 
 from tree_sitter import Language, Parser, Tree
 from tree_sitter.binding import Node
 
-from utils import PROJECT_PATH, chunk2, walk_files_up_to_depth, all_but_last
+from utils import PROJECT_PATH, chunk2, all_but_last
 
 # region init
 TREE_SITTER_SO_PATH = PROJECT_PATH / "local/tree-sitter-languages.so"
 TREE_SITTER_VENDOR_PATH = PROJECT_PATH / "vendor"
+TREE_SITTER_STAMP_PATH = TREE_SITTER_SO_PATH.with_name(TREE_SITTER_SO_PATH.name + ".stamp")
+TREE_SITTER_GRAMMAR_PATHS = [TREE_SITTER_VENDOR_PATH / "tree-sitter-c", TREE_SITTER_VENDOR_PATH / "tree-sitter-cpp"]
+
+
+def _grammar_sources_stamp() -> str:
+    """hash of the path, size and mtime of every grammar source file, which changes iff they need to be rebuilt"""
+    stamp = hashlib.sha256()
+    for grammar_path in TREE_SITTER_GRAMMAR_PATHS:
+        if not (grammar_path / "src").is_dir():
+            # Otherwise the stamp would be of no sources, and could match a library built from none
+            raise ValueError(f"tree-sitter grammar sources not found in {str(grammar_path)} "
+                             f"(run `git submodule update --init`)")
+        for dir_path, dir_names, file_names in walk(grammar_path / "src"):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_stat = stat(path.join(dir_path, file_name))
+                stamp.update(f"{dir_path}/{file_name}:{file_stat.st_size}:{file_stat.st_mtime_ns}\n".encode("utf-8"))
+    return stamp.hexdigest()
 
 
 def setup():
+    """builds the tree-sitter library, unless it's already built from the current grammar sources"""
+    stamp = _grammar_sources_stamp()
+    if TREE_SITTER_SO_PATH.exists() and TREE_SITTER_STAMP_PATH.exists() and \
+            TREE_SITTER_STAMP_PATH.read_text() == stamp:
+        return
     TREE_SITTER_SO_PATH.parent.mkdir(parents=True, exist_ok=True)
-    Language.build_library(
-        str(TREE_SITTER_SO_PATH),
-        [
-            str(TREE_SITTER_VENDOR_PATH / "tree-sitter-c"),
-            str(TREE_SITTER_VENDOR_PATH / "tree-sitter-cpp")
-        ]
-    )
+    Language.build_library(str(TREE_SITTER_SO_PATH), [str(grammar_path) for grammar_path in TREE_SITTER_GRAMMAR_PATHS])
+    TREE_SITTER_STAMP_PATH.write_text(stamp)
 
 
 setup()
@@ -40,9 +60,67 @@ class _TreeSitterQueries:
 
 
 class TreeSitterFunction:
-    def __init__(self, name: str, text: str):
+    """
+    A function definition, as a byte range of the source it's in (so extracting it doesn't copy or decode the source).
+    The body range is that of the function's compound_statement, if it has one
+    """
+    def __init__(self, name: str, source: bytes, start: int, end: int, body_start: int, body_end: int):
         self.name = name
-        self.text = text
+        self.source = source
+        self.start = start
+        self.end = end
+        self.body_start = body_start
+        self.body_end = body_end
+
+    @staticmethod
+    def from_node(source: bytes, fn: Node, fn_name: Node) -> "TreeSitterFunction":
+        body = fn.child_by_field_name("body")
+        return TreeSitterFunction(
+            _decode(memoryview(source)[fn_name.start_byte:fn_name.end_byte]),
+            source,
+            fn.start_byte,
+            fn.end_byte,
+            body.start_byte if body is not None else -1,
+            body.end_byte if body is not None else -1
+        )
+
+    @property
+    def has_body(self) -> bool:
+        return self.body_start != -1 and self.source[self.body_start:self.body_start + 1] == b"{"
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+    @property
+    def text(self) -> str:
+        return _decode(memoryview(self.source)[self.start:self.end])
+
+    def _body_ranges(self) -> tuple[int, int]:
+        """(start of body interior, start of tail): tail starts at the closing brace, if there is one"""
+        body_end = self.body_end
+        if self.source[body_end - 1:body_end] == b"}" and body_end - 1 > self.body_start:
+            body_end -= 1
+        return self.body_start + 1, body_end
+
+    def body(self) -> str:
+        """text inside the body's braces. Requires has_body"""
+        body_start, body_end = self._body_ranges()
+        return _decode(memoryview(self.source)[body_start:body_end])
+
+    def split(self) -> tuple[str, str, str]:
+        """(head up to and including "{", body(), "}" and anything after). Requires has_body"""
+        body_start, body_end = self._body_ranges()
+        source = memoryview(self.source)
+        return (
+            _decode(source[self.start:body_start]),
+            _decode(source[body_start:body_end]),
+            _decode(source[body_end:self.end])
+        )
+
+
+def _decode(text: memoryview) -> str:
+    return str(text, "utf-8", errors="ignore")
 
 
 _QUERIES: dict[Language, _TreeSitterQueries] = {
@@ -104,38 +182,38 @@ _QUERIES: dict[Language, _TreeSitterQueries] = {
 
 
 def scrape_functions(source_path: Path, lang: Language, parser: Parser) -> Iterable[TreeSitterFunction]:
+    source, tree = _parse(source_path, lang, parser)
+    queries = _QUERIES[lang]
+    return _scrape_functions(source_path, lang, parser, source, tree, queries)
+
+
+def _parse(source_path: Path, lang: Language, parser: Parser) -> tuple[bytes, Tree]:
     parser.set_language(lang)
     with source_path.open("rb") as source_file:
         source_bytes = source_file.read()
-    queries = _QUERIES[lang]
-    tree: Tree = parser.parse(source_bytes)
-    return _scrape_functions(source_path, lang, parser, tree, queries)
+    return source_bytes, parser.parse(source_bytes)
 
 
 def _scrape_functions(
         source_path: Path,
         lang: Language,
         parser: Parser,
+        source: bytes,
         tree: Tree,
         queries: _TreeSitterQueries) -> Iterable[TreeSitterFunction]:
     return chain(
-        _scrape_local_functions(tree, queries),
+        _scrape_local_functions(source, tree, queries),
         _scrape_imported_functions(source_path, lang, parser, tree, queries)
     )
 
 
-def _scrape_local_functions(tree: Tree, queries: _TreeSitterQueries) -> Iterable[TreeSitterFunction]:
+def _scrape_local_functions(source: bytes, tree: Tree, queries: _TreeSitterQueries) -> Iterable[TreeSitterFunction]:
     captures: list[tuple[Node, str]] = queries.function.captures(tree.root_node)
     if len(captures) % 2 == 0 and \
             all(fn[1] == "fn" and fn_name[1] == "fn_name" for fn, fn_name in chunk2(captures)):
         # Fastpath, all files should follow this but there is some weird bug or edge case I don't get
         for fn, fn_name in chunk2(captures):
-            fn2 = fn[0]
-            fn_name2 = fn_name[0]
-            yield TreeSitterFunction(
-                fn_name2.text.decode("utf-8", errors="ignore"),
-                fn2.text.decode("utf-8", errors="ignore"),
-            )
+            yield TreeSitterFunction.from_node(source, fn[0], fn_name[0])
     else:
         # Slowpath
         fn = None
@@ -145,11 +223,7 @@ def _scrape_local_functions(tree: Tree, queries: _TreeSitterQueries) -> Iterable
             else:
                 assert capture[1] == "fn_name"
                 assert fn is not None
-                fn_name = capture[0]
-                yield TreeSitterFunction(
-                    fn_name.text.decode("utf-8", errors="ignore"),
-                    fn.text.decode("utf-8", errors="ignore"),
-                )
+                yield TreeSitterFunction.from_node(source, fn, capture[0])
 
 
 def _scrape_imported_functions(
@@ -158,14 +232,135 @@ def _scrape_imported_functions(
         parser: Parser,
         tree: Tree,
         queries: _TreeSitterQueries) -> Iterable[TreeSitterFunction]:
+    """
+    functions in every header transitively included by the source (depth-first, in include order).
+    Each header is visited at most once per source, which also breaks include cycles
+    """
+    visited = {source_path}
+    stack = list(reversed(_scrape_include_paths(source_path, tree, queries)))
+    while len(stack) > 0:
+        include_path = stack.pop()
+        if include_path in visited:
+            INCLUDE_CACHE.num_revisits += 1
+            continue
+        visited.add(include_path)
+        header = INCLUDE_CACHE.get(include_path, lang, parser)
+        yield from header.functions
+        stack.extend(reversed(header.include_paths))
+
+
+def _scrape_include_paths(source_path: Path, tree: Tree, queries: _TreeSitterQueries) -> list[Path]:
+    """resolved paths of the headers directly included by the source"""
     captures: list[tuple[Node, str]] = queries.include.captures(tree.root_node)
+    include_paths = []
     for capture in captures:
         is_system_include = capture[1] == "system_include"
-        include_path_str = capture[0].text.decode("utf-8", errors="ignore")
-        include_path = _resolve_include_path(source_path, include_path_str, is_system_include)
+        # The capture includes the delimiters ("foo.h" or <foo.h>)
+        include_path_str = capture[0].text[1:-1].decode("utf-8", errors="ignore")
+        # The resolved path is normalized, so the same header has the same key regardless of how it was included
+        include_path = _INCLUDE_RESOLVER.resolve(source_path, include_path_str, is_system_include)
         if include_path is not None:
-            yield from scrape_functions(include_path, lang, parser)
+            include_paths.append(include_path)
+    return include_paths
+
+
+# region include cache
+# Approximate bytes of memory used by a cached header besides its source (its key, functions and include paths)
+_INCLUDED_HEADER_OVERHEAD = 1024
+
+
+class _IncludedHeader:
+    """a parsed header: the functions defined in it, and the headers it directly includes"""
+    def __init__(self, functions: list[TreeSitterFunction], include_paths: list[Path], source_size: int):
+        self.functions = functions
+        self.include_paths = include_paths
+        # Functions reference the header's whole source. Every header is charged for it and the overhead, so headers
+        # without functions (e.g. which only include others) still count towards the cache's size
+        self.size = source_size + _INCLUDED_HEADER_OVERHEAD
+
+
+class IncludeCacheStats:
+    def __init__(self, num_hits: int = 0, num_misses: int = 0, num_evictions: int = 0, num_revisits: int = 0):
+        self.num_hits = num_hits
+        self.num_misses = num_misses
+        self.num_evictions = num_evictions
+        self.num_revisits = num_revisits
+
+    def __add__(self, other: "IncludeCacheStats") -> "IncludeCacheStats":
+        return IncludeCacheStats(
+            self.num_hits + other.num_hits,
+            self.num_misses + other.num_misses,
+            self.num_evictions + other.num_evictions,
+            self.num_revisits + other.num_revisits
+        )
+
+    def __sub__(self, other: "IncludeCacheStats") -> "IncludeCacheStats":
+        return IncludeCacheStats(
+            self.num_hits - other.num_hits,
+            self.num_misses - other.num_misses,
+            self.num_evictions - other.num_evictions,
+            self.num_revisits - other.num_revisits
+        )
+
+    def __str__(self):
+        num_lookups = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / num_lookups * 100 if num_lookups > 0 else 0
+        return f"{self.num_hits}/{num_lookups} header cache hits ({'%.2f' % hit_rate}%), " \
+               f"{self.num_evictions} evictions, {self.num_revisits} repeated or cyclic includes skipped"
+
+
+class IncludeCache:
+    """
+    LRU cache of parsed headers, so that a header included by many sources is only read, parsed and queried once.
+    Bounded by the total size of the cached headers' sources (which their functions reference).
+    Each process has its own (INCLUDE_CACHE)
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.headers: OrderedDict[tuple[Path, Language], _IncludedHeader] = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_revisits = 0
+
+    def get(self, header_path: Path, lang: Language, parser: Parser) -> _IncludedHeader:
+        key = (header_path, lang)
+        header = self.headers.get(key)
+        if header is not None:
+            self.num_hits += 1
+            self.headers.move_to_end(key)
+            return header
+        self.num_misses += 1
+        header = self._parse_header(header_path, lang, parser)
+        if header.size <= self.max_size:
+            self.headers[key] = header
+            self.size += header.size
+            while self.size > self.max_size:
+                _, evicted = self.headers.popitem(last=False)
+                self.size -= evicted.size
+                self.num_evictions += 1
+        return header
+
+    @staticmethod
+    def _parse_header(header_path: Path, lang: Language, parser: Parser) -> _IncludedHeader:
+        source, tree = _parse(header_path, lang, parser)
+        queries = _QUERIES[lang]
+        return _IncludedHeader(
+            list(_scrape_local_functions(source, tree, queries)),
+            _scrape_include_paths(header_path, tree, queries),
+            len(source)
+        )
+
+    def stats(self) -> IncludeCacheStats:
+        return IncludeCacheStats(self.num_hits, self.num_misses, self.num_evictions, self.num_revisits)
+
+
+INCLUDE_CACHE_SIZE = int(environ.get("INCLUDE_CACHE_SIZE", str(256 * 1024 * 1024)))
+INCLUDE_CACHE = IncludeCache(INCLUDE_CACHE_SIZE)
+
 
+# endregion
 
 _LIBRARY_DIRS: list[Path] = [Path(path_str) for path_str in chain(
     environ.get("LIBRARY_DIRS", "").split(","),
@@ -186,42 +381,111 @@ _LIBRARY_DIRS: list[Path] = [Path(path_str) for path_str in chain(
 LOCAL_INCLUDE_CHILD_DEPTH = int(environ.get("LOCAL_INCLUDE_CHILD_DEPTH", "0"))
 
 
-def _resolve_include_path(source_path: Path, include_path_str: str, is_system_include: bool) -> Optional[Path]:
-    include_path = Path(include_path_str)
+class _DirIndex:
+    """
+    In-memory index of directory listings. Each directory is scanned at most once,
+    so checking whether a file exists doesn't stat the filesystem (slow on network filesystems)
+    """
+    def __init__(self):
+        self._listings: dict[str, Optional[dict[str, bool]]] = {}
 
-    # Root dir is not going to be a parent
-    def reasonable_parents() -> Iterable[Path]:
-        return all_but_last(source_path.parents)
-
-    if not is_system_include:
-        # Resolve locally
-        # First try just parents
-        for parent in reasonable_parents():
+    def listing(self, dir_path: str) -> Optional[dict[str, bool]]:
+        """entry name -> whether the entry is a directory, or None if dir_path is not a readable directory"""
+        if dir_path not in self._listings:
             try:
-                full_include_path = parent / include_path
-                if full_include_path.exists():
-                    return full_include_path
-            except PermissionError:
-                pass
-        # If it fails, try children of parents (relatives...uncles/aunts/cousins?)
-        if LOCAL_INCLUDE_CHILD_DEPTH > 0:
+                with scandir(dir_path) as entries:
+                    self._listings[dir_path] = {entry.name: entry.is_dir() for entry in entries}
+            except OSError:
+                self._listings[dir_path] = None
+        return self._listings[dir_path]
+
+    def is_file(self, file_path: str) -> bool:
+        dir_path, name = path.split(file_path)
+        listing = self.listing(dir_path)
+        return listing is not None and listing.get(name) is False
+
+    def clear(self):
+        self._listings.clear()
+
+
+class _IncludeResolver:
+    """Resolves include paths using a _DirIndex, and memoizes (source dir, include) -> resolved path"""
+    def __init__(self, library_dirs: list[Path], local_include_child_depth: int):
+        self.library_dirs = [str(library_dir) for library_dir in library_dirs]
+        self.local_include_child_depth = local_include_child_depth
+        self.dir_index = _DirIndex()
+        self._resolved: dict[tuple[Path, str, bool], Optional[Path]] = {}
+        self._relative_dirs: dict[str, list[str]] = {}
+
+    def resolve(self, source_path: Path, include_path_str: str, is_system_include: bool) -> Optional[Path]:
+        """Returns the normalized path of the included file, or None if it wasn't found"""
+        key = (source_path.parent, include_path_str, is_system_include)
+        if key not in self._resolved:
+            resolved = self._resolve(source_path, include_path_str, is_system_include)
+            self._resolved[key] = Path(resolved) if resolved is not None else None
+        return self._resolved[key]
+
+    def clear(self):
+        """forgets the directory listings and resolved includes, so files created or removed since are seen"""
+        self.dir_index.clear()
+        self._resolved.clear()
+        self._relative_dirs.clear()
+
+    def _resolve(self, source_path: Path, include_path_str: str, is_system_include: bool) -> Optional[str]:
+        # Root dir is not going to be a parent
+        def reasonable_parents() -> Iterable[str]:
+            return (str(parent) for parent in all_but_last(source_path.parents))
+
+        if not is_system_include:
+            # Resolve locally
+            # First try just parents
             for parent in reasonable_parents():
-                # note that the first returned is the parent itself
-                try:
-                    for relative in islice(walk_files_up_to_depth(parent, LOCAL_INCLUDE_CHILD_DEPTH), 1, None):
-                        # also note that not all relatives are directories
-                        if relative.is_dir():
-                            full_include_path = relative / include_path
-                            if full_include_path.exists():
-                                return full_include_path
-                except PermissionError:
-                    pass
-    # Resolve from system
-    for library_dir in _LIBRARY_DIRS:
-        try:
-            full_include_path = library_dir / include_path
-            if full_include_path.exists():
+                full_include_path = self._file_in(parent, include_path_str)
+                if full_include_path is not None:
+                    return full_include_path
+            # If it fails, try children of parents (relatives...uncles/aunts/cousins?)
+            if self.local_include_child_depth > 0:
+                for parent in reasonable_parents():
+                    for relative in self._relatives(parent):
+                        full_include_path = self._file_in(relative, include_path_str)
+                        if full_include_path is not None:
+                            return full_include_path
+        # Resolve from system
+        for library_dir in self.library_dirs:
+            full_include_path = self._file_in(library_dir, include_path_str)
+            if full_include_path is not None:
                 return full_include_path
-        except PermissionError:
-            pass
-    return None
+        return None
+
+    def _file_in(self, dir_path: str, include_path_str: str) -> Optional[str]:
+        full_include_path = path.normpath(path.join(dir_path, include_path_str))
+        return full_include_path if self.dir_index.is_file(full_include_path) else None
+
+    def _relatives(self, parent: str) -> list[str]:
+        """directories under parent up to LOCAL_INCLUDE_CHILD_DEPTH deep, excluding parent itself"""
+        if parent not in self._relative_dirs:
+            relatives = []
+
+            def add_relatives(dir_path: str, depth: int):
+                listing = self.dir_index.listing(dir_path)
+                if depth == 0 or listing is None:
+                    return
+                for name in sorted(name for name, is_dir in listing.items() if is_dir):
+                    child = path.join(dir_path, name)
+                    relatives.append(child)
+                    add_relatives(child, depth - 1)
+
+            add_relatives(parent, self.local_include_child_depth)
+            self._relative_dirs[parent] = relatives
+        return self._relative_dirs[parent]
+
+
+_INCLUDE_RESOLVER = _IncludeResolver(_LIBRARY_DIRS, LOCAL_INCLUDE_CHILD_DEPTH)
+
+
+def clear_include_index():
+    """
+    forgets the directories scanned to resolve includes. Call before scraping a repo, since artifacts may have been
+    added or changed since the last one (e.g. when adding decompiled artifacts as they're built)
+    """
+    _INCLUDE_RESOLVER.clear()
@@ -7,10 +7,17 @@ T = TypeVar('T')
 
 PROJECT_PATH = Path(__file__).parent.parent
 DEFAULT_DATASET_PATH = PROJECT_PATH.parent / "UnderstandableBinary-data"
-DEFAULT_EXAMPLES_PATH = PROJECT_PATH.parent / "UnderstandableBinary-examples.pickle"
+DEFAULT_EXAMPLES_PATH = PROJECT_PATH.parent / "UnderstandableBinary-examples.bin"
 DEFAULT_MODEL_PATH = PROJECT_PATH.parent / "UnderstandableBinary-model"
 
 INT32_MAX = 2_147_483_647  # 2^31 - 1
+# Default -l (languages) argument
+ALL_LANGS = "cpp"
+# How model.get_model runs the model (on CPU, int8 and onnx are faster than torch):
+# - torch: the checkpoint as-is (full precision PyTorch)
+# - int8: the checkpoint with linear layers dynamically quantized to int8
+# - onnx: the checkpoint exported to ONNX (encoder and decoder with KV cache), run with onnxruntime
+BACKENDS = ["torch", "int8", "onnx"]
 
 
 def path_or_float(arg) -> Path | float:
@@ -29,15 +36,6 @@ def walk_files(root_dir: Path) -> Iterable[Path]:
             yield Path(dir, filename)
 
 
-def walk_files_up_to_depth(root_dir: Path, max_depth: int) -> Iterable[Path]:
-    """Walk a directory, yielding paths to all files up to a certain depth (including the root; depth 0 = only root)"""
-    yield root_dir
-    if max_depth == 0 or not root_dir.is_dir():
-        return
-    for child in root_dir.iterdir():
-        yield from walk_files_up_to_depth(child, max_depth - 1)
-
-
 # From https://stackoverflow.com/questions/2425096/how-to-write-a-generator-that-returns-all-but-last-items-in-the-iterable-in-pyth
 def all_but_last(iterable: Iterable[T]) -> Iterable[T]:
     it = iter(iterable)
@@ -75,6 +73,36 @@ def mk_empty_binary_file(path: Path, force: bool) -> BinaryIO:
     return path.open("wb")
 
 
+def _tmp_path_for(path: Path) -> Path:
+    return path.with_name(f".{path.name}.tmp")
+
+
+def write_atomic(path: Path, data: str | bytes):
+    """write the file so that it's never partially written, even if we crash (writes a temporary file then renames)"""
+    tmp_path = _tmp_path_for(path)
+    try:
+        if isinstance(data, bytes):
+            tmp_path.write_bytes(data)
+        else:
+            tmp_path.write_text(data, encoding="utf8")
+        os.replace(tmp_path, path)
+    except BaseException:
+        # e.g. disk full or interrupted: don't leave the partial file, which could be mistaken for an output
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def copy_atomic(src: Path, dest: Path):
+    """copy the file (and its mtime) so that dest is never partially written, even if we crash"""
+    tmp_path = _tmp_path_for(dest)
+    try:
+        shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
 def chunk2(iterable: Iterable[T]) -> Iterable[tuple[T, T]]:
     """Chunk an iterable into pairs"""
     it = iter(iterable)